@@ -0,0 +1,76 @@
+"""Time downloading the data and exporting the sounds from the zip.
+
+    $ python -m pytest benchmarks/bench_download.py --scales 500
+
+The bucket is a LocalBucket holding a synthetic game, with a wav for every
+message in the zip.
+"""
+import importlib
+import json
+
+import pytest
+from unipath import Path
+
+from tasks.transfer import download_objects, LocalBucket
+from synthetic import GAME, write_sounds_zip
+
+MAX_SOUNDS = 5000
+
+
+@pytest.fixture(scope='session')
+def bucket_dir(tmpdir_factory, dump_dir, n_messages):
+    """A local bucket with the message dump and the zip of its sounds."""
+    if n_messages > MAX_SOUNDS:
+        pytest.skip('{} sounds is too many to write'.format(n_messages))
+    bucket_dir = Path(str(tmpdir_factory.mktemp('bucket-{}'.format(
+        n_messages))))
+    game_dir = Path(bucket_dir, GAME)
+    game_dir.mkdir()
+    with open(Path(dump_dir, 'grunt.Message.json')) as f:
+        dump = json.load(f)
+    Path(dump_dir, 'grunt.Message.json').copy(
+        Path(game_dir, 'grunt.Message.json'))
+    write_sounds_zip(Path(game_dir, '{}.zip'.format(GAME)), dump,
+                     str(tmpdir_factory.mktemp('wavs')))
+    return bucket_dir
+
+
+def bench_download_objects(benchmark, bucket_dir, tmpdir):
+    bucket = LocalBucket(bucket_dir)
+    keys = ['{}/{}.zip'.format(GAME, GAME),
+            '{}/grunt.Message.json'.format(GAME)]
+    manifest = str(tmpdir.join('manifest.json'))
+    benchmark.pedantic(download_objects, rounds=3,
+                       args=(bucket, keys, str(tmpdir), manifest),
+                       kwargs=dict(overwrite=True))
+
+
+@pytest.fixture
+def unpacked(downloads, bucket_dir, monkeypatch, tmpdir):
+    """Export sounds into tmpdir, from the zip in the bucket."""
+    download = importlib.import_module('tasks.download')
+    messages = importlib.import_module('tasks.edges.messages')
+    Path(bucket_dir, GAME, '{}.zip'.format(GAME)).copy(
+        Path(downloads, '{}.zip'.format(GAME)))
+    monkeypatch.setattr(download, 'DOWNLOAD_DIR', downloads)
+    monkeypatch.setattr(download, 'SOUNDS_MANIFEST',
+                        Path(str(tmpdir), 'sounds.json'))
+    monkeypatch.setattr(messages, 'SOUNDS_DIR', str(tmpdir))
+    return download
+
+
+def bench_unpack_and_cleanup_zip(benchmark, unpacked):
+    manifest = Path(unpacked.SOUNDS_MANIFEST)
+
+    def unpack_all():
+        if manifest.exists():
+            manifest.remove()
+        unpacked.unpack_and_cleanup_zip()
+
+    benchmark.pedantic(unpack_all, rounds=3)
+
+
+def bench_unpack_unchanged_zip(benchmark, unpacked):
+    """Time checking a zip that has already been unpacked."""
+    unpacked.unpack_and_cleanup_zip()
+    benchmark.pedantic(unpacked.unpack_and_cleanup_zip, rounds=3)
@@ -0,0 +1,68 @@
+"""Compare the batched DTW kernel against acousticsim's DTW.
+
+    $ pytest benchmarks/bench_dtw.py
+
+Throughput is reported as pairs per second in the benchmark's extra info.
+"""
+import numpy
+import pandas
+import pytest
+from unipath import Path
+
+from tasks.dtw import dtw_distances
+from tasks.settings import SIMILARITIES_DIR, SOUNDS_DIR
+
+N_PAIRS = 64
+
+
+@pytest.fixture(scope='module')
+def mfcc_pairs():
+    # Roughly the size of our sounds: 1-2 seconds at a 10 ms time step.
+    random = numpy.random.RandomState(0)
+    queries = [random.randn(random.randint(100, 200), 12)
+               for _ in range(N_PAIRS)]
+    references = [random.randn(random.randint(100, 200), 12)
+                  for _ in range(N_PAIRS)]
+    return queries, references
+
+
+def bench_batched_dtw(benchmark, mfcc_pairs):
+    queries, references = mfcc_pairs
+    benchmark(dtw_distances, queries, references)
+    benchmark.extra_info['pairs_per_second'] = N_PAIRS / benchmark.stats['mean']
+
+
+def bench_acousticsim_dtw(benchmark, mfcc_pairs):
+    dtw = pytest.importorskip('acousticsim.distance.dtw')
+    queries, references = mfcc_pairs
+
+    def score_pairs():
+        return [dtw.dtw_distance(q, r) for q, r in zip(queries, references)]
+
+    benchmark(score_pairs)
+    benchmark.extra_info['pairs_per_second'] = N_PAIRS / benchmark.stats['mean']
+
+
+def bench_batched_dtw_matches_acousticsim(mfcc_pairs):
+    dtw = pytest.importorskip('acousticsim.distance.dtw')
+    queries, references = mfcc_pairs
+    expected = [dtw.dtw_distance(q, r) for q, r in zip(queries, references)]
+    assert numpy.allclose(dtw_distances(queries, references), expected)
+
+
+def bench_batched_dtw_matches_published_similarities():
+    """Rescore a sample of the within-category edges used in the paper."""
+    published = Path(SIMILARITIES_DIR, 'within.csv')
+    if not Path(SOUNDS_DIR, '34.wav').exists():
+        pytest.skip('sounds have not been downloaded')
+    from tasks.features import load_features
+
+    kwargs = dict(rep='mfcc', num_coeffs=12)
+    edges = pandas.read_csv(published).sample(200, random_state=0)
+    wav = lambda message_id: Path(SOUNDS_DIR, '{}.wav'.format(message_id))
+    sounds_x = [wav(x) for x in edges.sound_x]
+    sounds_y = [wav(y) for y in edges.sound_y]
+    features = load_features(sounds_x + sounds_y, **kwargs)
+    distances = dtw_distances([features[x] for x in sounds_x],
+                              [features[y] for y in sounds_y])
+    assert numpy.allclose(1/distances, edges.similarity, rtol=1e-6)
@@ -0,0 +1,67 @@
+"""Time parsing messages, labeling branches and making edges.
+
+    $ python -m pytest benchmarks/bench_edges.py --scales 500,5000
+
+Each benchmark runs on synthetic games of every size given by --scales.
+"""
+import importlib
+
+import numpy
+from invoke import Context
+from unipath import Path
+
+from tasks.edges.messages import (parse_downloaded_messages, label_branches,
+                                  read_downloaded_messages)
+from tasks.edges.within import get_all_within_edges
+from tasks.edges.between import get_all_between_edges
+from tasks.matrix import SimilarityMatrix
+from synthetic import GAME, count_pairs, skip_if_too_many
+
+
+def bench_parse_downloaded_messages(benchmark, downloads):
+    src = Path(downloads, 'grunt.Message.json')
+    benchmark(parse_downloaded_messages, src, GAME)
+
+
+def bench_label_branches(benchmark, downloads):
+    messages = read_downloaded_messages()
+    branches = benchmark(label_branches, messages)
+    benchmark.extra_info['n_branches'] = len(branches)
+
+
+def bench_get_all_within_edges(benchmark, downloads):
+    within, _ = count_pairs(read_downloaded_messages())
+    skip_if_too_many(within)
+    edges = benchmark.pedantic(get_all_within_edges, rounds=3)
+    benchmark.extra_info['n_edges'] = len(edges)
+    benchmark.extra_info['edges_per_second'] = \
+        len(edges) / benchmark.stats['mean']
+
+
+def bench_get_all_between_edges(benchmark, downloads):
+    _, between = count_pairs(read_downloaded_messages())
+    skip_if_too_many(between)
+    edges = benchmark.pedantic(get_all_between_edges, rounds=3)
+    benchmark.extra_info['n_edges'] = len(edges)
+    benchmark.extra_info['edges_per_second'] = \
+        len(edges) / benchmark.stats['mean']
+
+
+def bench_edge_types(benchmark, downloads, monkeypatch, tmpdir):
+    messages = read_downloaded_messages()
+    skip_if_too_many(sum(count_pairs(messages)))
+
+    # Give every pair of messages a similarity, as if all were scored.
+    compare_sounds = importlib.import_module('tasks.compare_sounds')
+    kwargs = compare_sounds.scoring_kwargs()
+    matrix = SimilarityMatrix(str(tmpdir), **kwargs)
+    matrix.add_messages(messages.message_id.values)
+    random = numpy.random.RandomState(0)
+    for row in range(len(matrix.values)):
+        matrix.values[row] = random.rand(len(matrix.values))
+    matrix.close()
+
+    monkeypatch.setattr(compare_sounds, 'MATRICES_DIR', str(tmpdir))
+    monkeypatch.setattr(compare_sounds, 'DATA_DIR', str(tmpdir))
+    benchmark.pedantic(compare_sounds.edge_types, args=(Context(), ),
+                       rounds=3)
@@ -0,0 +1,65 @@
+"""Time starting and running headless similarity judgment sessions.
+
+    $ python -m pytest benchmarks/bench_judgments.py
+
+Sessions run the within category edges, about 18,000 trials, with a
+simulated responder instead of a PsychoPy window.
+"""
+import itertools
+
+import pytest
+from unipath import Path
+
+PROJ_ROOT = Path(__file__).absolute().ancestor(2)
+EDGES = '../data/within_category.csv'
+
+
+@pytest.fixture
+def experiment(monkeypatch):
+    """Import the experiment from the judgments dir, where it's run."""
+    judgments_dir = Path(PROJ_ROOT, 'judgments')
+    monkeypatch.chdir(judgments_dir)
+    monkeypatch.syspath_prepend(judgments_dir)
+    import judgments
+    import engine
+    return judgments, engine
+
+
+def make_session(judgments, engine, store_path, seed=0):
+    store = judgments.JudgmentStore(store_path,
+                                    judgments.SimilarityJudgments.DATA_COLS)
+    trials = judgments.Trials(seed=seed, store=store, edges=EDGES)
+    presenter = engine.HeadlessPresenter(engine.SimulatedResponder(seed=seed))
+    return engine.JudgmentEngine(dict(name='sim', datetime='now'), store,
+                                 trials, presenter)
+
+
+def bench_simulated_session(benchmark, experiment, tmpdir):
+    judgments, engine = experiment
+    counter = itertools.count()
+
+    def setup():
+        store_path = str(tmpdir.join('{}.sqlite'.format(next(counter))))
+        return (make_session(judgments, engine, store_path), ), {}
+
+    def run(session):
+        session.run()
+        return session.cur_trial_index
+
+    n_trials = benchmark.pedantic(run, setup=setup, rounds=3)
+    benchmark.extra_info['n_trials'] = n_trials
+    benchmark.extra_info['trials_per_second'] = \
+        n_trials / benchmark.stats['mean']
+
+
+def bench_resume_session(benchmark, experiment, tmpdir):
+    """Time making the trials left after half a session."""
+    judgments, engine = experiment
+    store_path = str(tmpdir.join('half.sqlite'))
+    session = make_session(judgments, engine, store_path)
+    session.presenter.responder.p_quit = 2.0 / session.trials.n_trials
+    session.run()
+    benchmark.extra_info['n_judged'] = session.cur_trial_index
+
+    store = session.store
+    benchmark(judgments.Trials, seed=1, store=store, edges=EDGES)
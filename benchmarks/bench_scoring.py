@@ -0,0 +1,51 @@
+"""Time scoring edges between synthetic sounds for each representation.
+
+    $ python -m pytest benchmarks/bench_scoring.py
+
+Features are computed in the warmup round and read from the feature store
+after that, so the timings are for scoring with a warm store.
+"""
+import pandas
+import pytest
+from unipath import Path
+
+from synthetic import write_wav
+
+N_SOUNDS = 20
+
+REPRESENTATIONS = {
+    'mfcc': {'rep': 'mfcc', 'num_coeffs': 12, 'output_sim': True},
+    'envelopes': {'rep': 'envelopes', 'num_filters': 8, 'output_sim': True},
+}
+
+
+@pytest.fixture(scope='module')
+def sounds(tmpdir_factory):
+    sounds_dir = tmpdir_factory.mktemp('sounds')
+    wavs = []
+    for message_id in range(1, N_SOUNDS + 1):
+        wav = str(Path(str(sounds_dir), '{}.wav'.format(message_id)))
+        write_wav(wav, seconds=1.0, seed=message_id)
+        wavs.append(wav)
+    return wavs
+
+
+@pytest.mark.parametrize('rep', sorted(REPRESENTATIONS))
+def bench_calculate_similarities(benchmark, sounds, rep, monkeypatch,
+                                 tmpdir):
+    pytest.importorskip('acousticsim')
+    from tasks import features
+    from tasks.compare_sounds import calculate_similarities
+    monkeypatch.setattr(features, 'FEATURES_DIR', str(tmpdir))
+
+    edges = pandas.DataFrame([(x, y) for i, x in enumerate(sounds)
+                              for y in sounds[i+1:]],
+                             columns=['sound_x', 'sound_y'])
+
+    def score():
+        return calculate_similarities(edges.copy(),
+                                      **REPRESENTATIONS[rep])
+
+    benchmark.pedantic(score, rounds=3, warmup_rounds=1)
+    benchmark.extra_info['pairs_per_second'] = \
+        len(edges) / benchmark.stats['mean']
@@ -0,0 +1,36 @@
+import importlib
+
+import pytest
+from unipath import Path
+
+from synthetic import write_message_dump
+
+
+def pytest_addoption(parser):
+    parser.addoption('--scales', default='500,5000,50000',
+                     help='Comma separated numbers of messages per game.')
+
+
+def pytest_generate_tests(metafunc):
+    if 'n_messages' in metafunc.fixturenames:
+        scales = metafunc.config.getoption('scales').split(',')
+        metafunc.parametrize('n_messages', [int(n) for n in scales],
+                             scope='session')
+
+
+@pytest.fixture(scope='session')
+def dump_dir(tmpdir_factory, n_messages):
+    """A downloads dir with the message dump of a synthetic game."""
+    dump_dir = tmpdir_factory.mktemp('downloads-{}'.format(n_messages))
+    write_message_dump(str(dump_dir), n_messages)
+    return Path(str(dump_dir))
+
+
+@pytest.fixture
+def downloads(monkeypatch, dump_dir):
+    """Read messages from the synthetic game instead of the real one."""
+    messages = importlib.import_module('tasks.edges.messages')
+    monkeypatch.setattr(messages, 'DOWNLOAD_DIR', dump_dir)
+    monkeypatch.setattr(messages, '_message_tables', {})
+    return dump_dir
+
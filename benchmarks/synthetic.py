@@ -0,0 +1,109 @@
+"""Synthetic telephone games for the benchmarks.
+
+Games are shaped like the real one: a few seeds in each category, each
+message imitating a random earlier message from the same tree, and about
+one message in ten rejected.
+"""
+import json
+import wave
+import zipfile
+
+import numpy
+import pytest
+from unipath import Path
+
+GAME = 'words-in-transition'
+CATEGORIES = ['glass', 'tear', 'water', 'zipper']
+MAX_GENERATION = 8
+MEDIA_ROOT = 'webapps/telephone/media'
+
+# Edge types are all pairs within some group of messages, so the biggest
+# games have far more edges than can be made in memory. Benchmarks that
+# would make more edges than this are skipped.
+MAX_EDGES = 5 * 10**6
+
+
+def message_dump(n_messages, seed=0):
+    """Make the django dump of a game with n_messages messages."""
+    random = numpy.random.RandomState(seed)
+    n_seeds = max(len(CATEGORIES), n_messages // 32)
+
+    messages = []
+    for pk in range(1, n_messages + 1):
+        if pk <= n_seeds:
+            parent = None
+            category = CATEGORIES[pk % len(CATEGORIES)]
+            generation = 0
+        else:
+            parent = messages[random.randint(len(messages))]
+            while parent['generation'] == MAX_GENERATION:
+                parent = messages[random.randint(len(messages))]
+            category = parent['category']
+            generation = parent['generation'] + 1
+        messages.append(dict(pk=pk, parent=parent and parent['pk'],
+                             category=category, generation=generation,
+                             rejected=bool(random.rand() < 0.1)))
+
+    return [{'model': 'grunt.message', 'pk': message['pk'], 'fields': {
+                'parent': message['parent'],
+                'generation': message['generation'],
+                'rejected': message['rejected'],
+                'start_at': None,
+                'end_at': None,
+                'audio': '{}/{}/{}.wav'.format(GAME, message['category'],
+                                               message['pk'])}}
+            for message in messages]
+
+
+def write_message_dump(dst_dir, n_messages, seed=0):
+    with open(Path(dst_dir, 'grunt.Message.json'), 'w') as f:
+        json.dump(message_dump(n_messages, seed), f)
+
+
+def write_wav(dst, seconds=0.5, rate=16000, seed=0):
+    """Write a noisy tone with a fade in and out, like a short vocalization."""
+    random = numpy.random.RandomState(seed)
+    t = numpy.arange(int(seconds * rate)) / float(rate)
+    pitch = random.uniform(100, 400)
+    samples = (numpy.sin(2 * numpy.pi * pitch * t) +
+               0.3 * random.randn(len(t)))
+    samples *= numpy.hanning(len(t))
+    samples = (samples / numpy.abs(samples).max() * 16000).astype('<i2')
+
+    f = wave.open(dst, 'wb')
+    f.setnchannels(1)
+    f.setsampwidth(2)
+    f.setframerate(rate)
+    f.writeframes(samples.tobytes())
+    f.close()
+
+
+def write_sounds_zip(dst, dump, tmp_dir):
+    """Zip a wav for every message in a dump, like the media backup."""
+    with zipfile.ZipFile(dst, 'w') as archive:
+        for message in dump:
+            wav = Path(tmp_dir, '{}.wav'.format(message['pk']))
+            write_wav(wav, seed=message['pk'])
+            archive.write(wav, '{}/{}'.format(MEDIA_ROOT,
+                                              message['fields']['audio']))
+            wav.remove()
+
+
+def count_pairs(messages):
+    """Count the within category and between fixed edges of a game."""
+    messages = messages[(messages.generation > 0) & (~messages.rejected)]
+
+    def n_pairs(sizes):
+        return int((sizes * (sizes - 1) // 2).sum())
+
+    within = n_pairs(messages.groupby('category').size().values)
+    between = 0
+    for _, generation in messages.groupby('generation'):
+        sizes = generation.groupby('category').size().values
+        between += n_pairs(numpy.array([sizes.sum()])) - n_pairs(sizes)
+    return within, between
+
+
+def skip_if_too_many(n_edges):
+    if n_edges > MAX_EDGES:
+        pytest.skip('{} edges is too many to make in memory'.format(n_edges))
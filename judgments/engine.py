@@ -0,0 +1,319 @@
+"""Run similarity judgment trials without depending on how they are shown.
+
+The JudgmentEngine runs the blocks of trials, writes each response and
+handles repeated trials, reported errors and quitting. Showing the trials
+and getting the responses is left to a presenter. PsychoPyPresenter in
+judgments.py shows trials in a PsychoPy window. HeadlessPresenter shows
+nothing and takes its keypresses from a responder, so whole sessions can be
+simulated or replayed in a fraction of the time.
+
+    engine = JudgmentEngine(session, store, trials,
+                            HeadlessPresenter(SimulatedResponder(seed=0)))
+    engine.run()
+"""
+import string
+
+import numpy
+import pandas
+from unipath import Path
+
+try:
+    from psychopy import logging
+except ImportError:
+    import logging
+
+RATING_VALUES = range(1, 8)
+RATING_KEYS = dict(q='quit', e='error', r='repeat')
+RATING_KEYS.update({str(i): i for i in RATING_VALUES})
+
+TEXT_KEYS = string.ascii_lowercase + string.digits
+
+# Columns of a judgment csv needed to get a rater's ratings.
+RATING_COLUMNS = ['name', 'sound_x', 'sound_y', 'similarity', 'repeat']
+
+
+class JudgmentEngine(object):
+    """Run blocks of trials, writing a response for each one.
+
+    Args:
+        session: Data to write with every trial, e.g. name and datetime.
+        store: Where to write each trial, e.g. a JudgmentStore.
+        trials: The trials to run, e.g. Trials or AdaptiveTrials.
+        presenter: Shows the trials and gets the responses.
+        after_block: Optional function to call after each block, even one
+            the participant quit, e.g. to export the judgments so far.
+    """
+    PREFETCH_TRIALS = 5  # number of upcoming trials to load sounds for
+
+    def __init__(self, session, store, trials, presenter, after_block=None):
+        self.session = session
+        self.store = store
+        self.trials = trials
+        self.presenter = presenter
+        self.after_block = after_block
+        self.cur_trial_index = 0
+        self.cur_total_trials = trials.n_trials
+
+    def run(self):
+        """Run all the blocks of trials, unless the participant quits."""
+        self.presenter.show_instructions()
+        for block in self.trials.blocks():
+            try:
+                self.run_block(block)
+            except QuitExperiment:
+                logging.critical('Participant requested to quit the experiment')
+                break
+            else:
+                self.presenter.show_break()
+            finally:
+                if self.after_block is not None:
+                    self.after_block()
+
+    def run_block(self, block):
+        """Run a block of trials.
+
+        While each trial runs, the presenter can load the sounds for the
+        next few trials in the block.
+        """
+        block = list(block)
+        for i, trial in enumerate(block):
+            upcoming = block[i:i+self.PREFETCH_TRIALS+1]
+            self.presenter.prefetch([name for t in upcoming
+                                     for name in (t.sound_x, t.sound_y)])
+            while True:
+                try:
+                    self.run_trial(trial)
+                except RepeatTrial:
+                    pass
+                else:
+                    self.cur_trial_index += 1
+                    logging.critical('Completed trial {} out of {}: {} - {}'.format(
+                        self.cur_trial_index, self.cur_total_trials, trial.sound_x, trial.sound_y))
+                    break
+
+    def run_trial(self, trial):
+        """Run a single trial."""
+        self.presenter.present(trial)
+
+        response = dict(similarity=-1, notes='None', repeat=0)
+        response.update(**trial._asdict())
+
+        try:
+            response['similarity'] = self.presenter.get_rating(trial)
+        except ReportError:
+            logging.critical('Reporting error on this trial')
+            response['notes'] = self.presenter.get_notes(trial)
+        except RepeatTrial:
+            logging.critical('Repeating this trial')
+            response['repeat'] = 1
+            self.write_trial(**response)
+            raise
+
+        self.write_trial(**response)
+
+    def write_trial(self, **trial_data):
+        data = self.session.copy()
+        data.update(trial_data)
+        row = {}
+        for name in self.store.columns:
+            value = data.get(name, '')
+            if value == '':
+                logging.warning('Data for col {} not found'.format(name))
+            elif name in ['sound_x', 'sound_y']:
+                value = get_message_id_from_path(value)
+            row[name] = value
+
+        for x in trial_data.keys():
+            if x not in self.store.columns:
+                logging.warning('Data for {} not saved'.format(x))
+        self.store.add(row)
+
+
+def get_message_id_from_path(sound_path):
+    # e.g., 'path/to/sound/filename.wav' -> 'filename'
+    # Also needs to be able to handle sound_path == numpy.int64
+    try:
+        message_id = Path(sound_path).stem
+    except TypeError:
+        message_id = Path(str(int(sound_path))).stem
+
+    return message_id
+
+
+def canonical_edges(sound_x, sound_y):
+    """Get the (min id, max id) of the sounds of each edge.
+
+    Sounds can be given as message ids or as paths to wav files.
+    """
+    def message_ids(sounds):
+        ids = pandas.Series(sounds).astype(str).str.extract(
+            r'(\d+)(?:\.wav)?$', expand=False)
+        return ids.astype(numpy.int64).values
+
+    x, y = message_ids(sound_x), message_ids(sound_y)
+    return numpy.minimum(x, y), numpy.maximum(x, y)
+
+
+def read_final_ratings(src, chunksize=10000):
+    """Read the final rating of each edge by each rater in a judgment csv.
+
+    Repeated trials and trials with errors are dropped. Returns a frame
+    with name, edge_x, edge_y and similarity columns, where edges are
+    given as (min id, max id) so ratings of the same pair in either order
+    are combined.
+
+    The experiment and the aggregate_judgments task both read ratings
+    with this, so they always agree on which rating counts.
+    """
+    chunks = []
+    for chunk in pandas.read_csv(src, usecols=RATING_COLUMNS,
+                                 chunksize=chunksize):
+        chunk = chunk[(chunk.repeat != 1) & (chunk.similarity != -1)]
+        edge_x, edge_y = canonical_edges(chunk.sound_x, chunk.sound_y)
+        chunks.append(pandas.DataFrame({
+            'name': chunk['name'].values,
+            'edge_x': edge_x,
+            'edge_y': edge_y,
+            'similarity': chunk.similarity.values,
+        }, columns=['name', 'edge_x', 'edge_y', 'similarity']))
+    ratings = pandas.concat(chunks, ignore_index=True)
+    return ratings.drop_duplicates(['name', 'edge_x', 'edge_y'], keep='last')
+
+
+def rating_from_key(key):
+    """Get the rating for a key, or raise the exception for a command key."""
+    response = RATING_KEYS.get(key)
+    if response == 'quit':
+        raise QuitExperiment
+    elif response == 'error':
+        raise ReportError
+    elif response == 'repeat':
+        raise RepeatTrial
+    return response
+
+
+def type_key(text, key):
+    """Edit the text of a form with a key, like TextEntryForm.
+
+    Returns the new text, and whether the key finished the form.
+    """
+    if key in ['enter', 'return']:
+        return text, True
+    elif key == 'backspace' and len(text) > 0:
+        text = text[:-1]
+    elif key in TEXT_KEYS:
+        text += key
+    elif key == 'space':
+        text += ' '
+    return text, False
+
+
+class HeadlessPresenter(object):
+    """Present trials without a window, taking keys from a responder."""
+    def __init__(self, responder):
+        self.responder = responder
+
+    def show_instructions(self):
+        pass
+
+    def show_break(self):
+        pass
+
+    def prefetch(self, names):
+        pass
+
+    def present(self, trial):
+        pass
+
+    def get_rating(self, trial):
+        return rating_from_key(self.responder.rating_key(trial))
+
+    def get_notes(self, trial):
+        text = ''
+        for key in self.responder.note_keys(trial):
+            text, done = type_key(text, key)
+            if done:
+                break
+        return text
+
+    def close(self):
+        pass
+
+
+class SimulatedResponder(object):
+    """Press random keys, with some repeats, errors and quitting."""
+    NOTES = 'simulated error'
+
+    def __init__(self, seed=None, p_repeat=0.05, p_error=0.01, p_quit=0.0):
+        self.random = numpy.random.RandomState(seed)
+        self.p_quit = p_quit
+        self.p_error = p_error
+        self.p_repeat = p_repeat
+
+    def rating_key(self, trial):
+        draw = self.random.rand()
+        if draw < self.p_quit:
+            return 'q'
+        elif draw < self.p_quit + self.p_error:
+            return 'e'
+        elif draw < self.p_quit + self.p_error + self.p_repeat:
+            return 'r'
+        return str(self.random.choice(RATING_VALUES))
+
+    def note_keys(self, trial):
+        keys = ['space' if char == ' ' else char for char in self.NOTES]
+        return keys + ['return']
+
+
+class ReplayResponder(object):
+    """Press the keys a rater pressed, from a csv of their judgments.
+
+    Each time an edge is presented, the next response to it is replayed,
+    in either order of the sounds. Presenting an edge that has no
+    responses left quits the experiment, so trials should be made from
+    the edges the rater judged:
+
+        responder = ReplayResponder('../data/judgments/zoe.csv')
+        trials = Trials(edges=responder.edges)
+    """
+    def __init__(self, judgments_csv):
+        judgments = pandas.read_csv(judgments_csv, dtype=str,
+                                    keep_default_na=False)
+        self.edges = (judgments[['sound_x', 'sound_y']]
+                      .astype(numpy.int64).drop_duplicates()
+                      .reset_index(drop=True))
+        self.responses = {}
+        for judgment in judgments.itertuples():
+            edge = frozenset([judgment.sound_x, judgment.sound_y])
+            self.responses.setdefault(edge, []).append(judgment)
+
+    def next_response(self, trial):
+        edge = frozenset([get_message_id_from_path(trial.sound_x),
+                          get_message_id_from_path(trial.sound_y)])
+        responses = self.responses.get(edge)
+        return responses.pop(0) if responses else None
+
+    def rating_key(self, trial):
+        response = self.next_response(trial)
+        if response is None:
+            return 'q'
+        elif response.repeat == '1':
+            return 'r'
+        elif response.similarity == '-1':
+            self.notes = response.notes
+            return 'e'
+        return response.similarity
+
+    def note_keys(self, trial):
+        keys = ['space' if char == ' ' else char for char in self.notes]
+        return keys + ['return']
+
+
+class QuitExperiment(Exception):
+    pass
+
+class ReportError(Exception):
+    pass
+
+class RepeatTrial(Exception):
+    pass
@@ -1,14 +1,32 @@
 #!/usr/bin/env python
+import argparse
+from collections import Counter, OrderedDict
 from datetime import datetime
+import sqlite3
+import threading
 import webbrowser
-import string
-
-from psychopy import visual, core, event, sound, logging, gui
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from psychopy import visual, core, event, sound, logging, gui
+except ImportError:
+    # Trials can still be run headless, see engine.py.
+    import logging
+    visual = core = event = sound = gui = None
 from unipath import Path
 import pandas
 import numpy
 
+from engine import (JudgmentEngine, RATING_KEYS, RATING_VALUES,
+                    canonical_edges, read_final_ratings, rating_from_key,
+                    type_key, QuitExperiment, ReportError, RepeatTrial)
+
 DATA_DIR = Path('../data/judgments')
+SIMILARITIES_DIR = Path('../data/similarities')
+SOUND_PATH = '../data/sounds/{}.wav'
 
 TITLE = "Judge the similarity between two sounds"
 INSTRUCTIONS = """\
@@ -25,82 +43,96 @@ ERROR_FORM_TITLE = "Describe why you were unable to judge the similarity between
 
 
 class SimilarityJudgments(object):
-    """Collect similarity judgments comparing two sounds."""
+    """Collect similarity judgments comparing two sounds.
+
+    Trials are shown in a PsychoPy window unless another presenter is
+    given, e.g. a HeadlessPresenter from engine.py. The trials are made
+    from a csv of edges, by default the linear edges. With adaptive, the
+    most informative trials are run first, and block_size limits the
+    number of trials in each block (see AdaptiveTrials).
+    """
     DATA_COLS = ('name datetime block_ix trial_ix sound_x sound_y '
                  'reversed category similarity notes repeat').split()
-    if not DATA_DIR.isdir():
-        DATA_DIR.mkdir()
-    DATA_FILE = Path(DATA_DIR, '{name}.csv')
+    DATA_FILE = '{name}.csv'
+    STORE_FILE = '{name}.sqlite'
     LOG_FILE = Path('{name}.log')
 
-    PRE_DELAY = 0.5
-    BETWEEN_DELAY = 0.8  # time between sounds
-
-    def __init__(self, player, overwrite=False):
-        self.session = player.copy()
+    def __init__(self, player, overwrite=False, adaptive=False,
+                 presenter=None, data_dir=DATA_DIR, import_csv=False,
+                 edges='linear_edges.csv', block_size=None):
+        session = player.copy()
         start_time = datetime.now()
-        self.session['datetime'] = start_time
+        session['datetime'] = start_time
         seed = start_time.toordinal()
 
-        fname = self.DATA_FILE.format(**player)
-        fmode = 'w' if overwrite else 'a'
-        write_header = ((not Path(fname).exists()) or fmode == 'w')
-        self.data_file = open(fname, fmode, 0)
-        if write_header:
-            self.write_trial()
+        # Judgments are stored in a database, and exported to the csv
+        # after each block. A new database starts from the csv. With
+        # import_csv, judgments in the csv that aren't in an existing
+        # database, e.g. ones made on another machine, are added to it.
+        data_dir = Path(data_dir)
+        if not data_dir.isdir():
+            data_dir.mkdir()
+        self.data_file = Path(data_dir, self.DATA_FILE.format(**player))
+        self.store = JudgmentStore(
+            Path(data_dir, self.STORE_FILE.format(**player)),
+            self.DATA_COLS, overwrite=overwrite, import_csv=self.data_file)
+        if import_csv and not overwrite and self.data_file.exists():
+            self.store.import_csv(self.data_file)
         self.log_file = self.LOG_FILE.format(**player)
 
         # Make the trials for this participant.
-        self.trials = Trials(seed=seed, completed_csv=fname)
-        logging.critical('Created {} trials'.format(len(self.trials.trials)))
-        self.cur_total_trials = len(self.trials.trials)
+        if adaptive:
+            self.trials = AdaptiveTrials(seed=seed, store=self.store,
+                                         edges=edges, block_size=block_size)
+        else:
+            assert block_size is None, 'block_size needs adaptive trials'
+            self.trials = Trials(seed=seed, store=self.store, edges=edges)
+        logging.critical('Created {} trials'.format(self.trials.n_trials))
         self.trials.trials.to_csv('trials-remaining-{}.csv'.format(player['name']), index=False)
 
-        # Create the trial objects.
+        self.presenter = presenter or PsychoPyPresenter()
+        self.engine = JudgmentEngine(session, self.store, self.trials,
+                                     self.presenter,
+                                     after_block=self.export)
+
+    def run(self):
+        """Run the experiment."""
+        try:
+            self.engine.run()
+        finally:
+            # Also export the judgments of a block that didn't finish.
+            self.export()
+            self.store.close()
+        logging.critical('Experiment is closing down')
+        self.presenter.close()
+
+    def export(self):
+        """Write all the judgments so far to the csv."""
+        self.store.export_csv(self.data_file)
+
+
+class PsychoPyPresenter(object):
+    """Show trials in a full screen window and get responses by keyboard."""
+    PRE_DELAY = 0.5
+    BETWEEN_DELAY = 0.8  # time between sounds
+
+    def __init__(self):
         self.win = visual.Window(fullscr=True, units='pix', allowGUI=False)
         self.text_kwargs = dict(win=self.win, font='Consolas',
                                 wrapWidth=self.win.size[0] * 0.7)
         self.scale = RatingScale(self.text_kwargs)
         self.form = TextEntryForm(self.text_kwargs)
-        self.sounds = {}
+        self.sounds = SoundPool()
         self.icon = visual.ImageStim(self.win, 'stimuli/speaker_icon.png')
         self.icon_label = visual.TextStim(pos=(0, 110), color="black",
                                           height=50, **self.text_kwargs)
 
-    def run(self):
-        """Run the experiment."""
-        self.show_instructions()
-        self.cur_trial_index = 0
-        for block in self.trials.blocks():
-            try:
-                self.run_block(block)
-            except QuitExperiment:
-                logging.critical('Participant requested to quit the experiment')
-                break
-            else:
-                self.show_break_screen()
-
-        self.data_file.close()
-        logging.critical('Experiment is closing down')
-        core.quit()
-
-    def run_block(self, block):
-        """Run a block of trials."""
-        for trial in block:
-            while True:
-                try:
-                    self.run_trial(trial)
-                except RepeatTrial:
-                    pass
-                else:
-                    self.cur_trial_index += 1
-                    logging.critical('Completed trial {} out of {}: {} - {}'.format(
-                        self.cur_trial_index, self.cur_total_trials, trial.sound_x, trial.sound_y))
-                    break
-
+    def prefetch(self, names):
+        self.sounds.prefetch(names)
 
-    def run_trial(self, trial):
-        """Run a single trial."""
+    def present(self, trial):
+        """Play the sounds of a trial and show the rating scale."""
+        trial_start = core.getTime()
         first, second = self.get_or_create_sounds(trial.sound_x, trial.sound_y)
         if trial.reversed:
             first, second = second, first
@@ -109,26 +141,21 @@ class SimilarityJudgments(object):
         event.clearEvents()
 
         core.wait(self.PRE_DELAY)
+        # Time from the start of the trial to the first sound, beyond the
+        # planned delay. Loading sounds on the trial shows up here.
+        latency = core.getTime() - trial_start - self.PRE_DELAY
+        logging.critical('Trial onset latency: {:.1f} ms'.format(
+            latency * 1000))
         self.play_and_wait(first, '1')
         core.wait(self.BETWEEN_DELAY)
         self.play_and_wait(second, '2')
         self.scale.draw(flip=True)
 
-        response = dict(similarity=-1, notes='None', repeat=0)
-        response.update(**trial._asdict())
+    def get_rating(self, trial):
+        return self.scale.get_response()
 
-        try:
-            response['similarity'] = self.scale.get_response()
-        except ReportError:
-            logging.critical('Reporting error on this trial')
-            response['notes'] = self.form.get_response()
-        except RepeatTrial:
-            logging.critical('Repeating this trial')
-            response['repeat'] = 1
-            self.write_trial(**response)
-            raise
-
-        self.write_trial(**response)
+    def get_notes(self, trial):
+        return self.form.get_response()
 
     def show_instructions(self):
         gap = 80
@@ -142,15 +169,14 @@ class SimilarityJudgments(object):
         self.win.flip()
         event.waitKeys(keyList=['space'])
 
-    def show_break_screen(self):
+    def show_break(self):
         visual.TextStim(text=BREAK, **self.text_kwargs).draw()
         self.win.flip()
         event.waitKeys(keyList=['space'])
 
     def get_or_create_sounds(self, *args):
-        """Get sounds by name or create them if they don't exist."""
-        return [self.sounds.setdefault(name, sound.Sound(name))
-                for name in args]
+        """Get sounds by name, waiting for any that are still loading."""
+        return [self.sounds.get(name) for name in args]
 
     def play_and_wait(self, snd, text=''):
         duration = snd.getDuration()
@@ -162,52 +188,210 @@ class SimilarityJudgments(object):
         core.wait(duration)
         self.win.flip()
 
-    def write_trial(self, **trial_data):
-        data = self.session.copy()
-        if not trial_data:
-            # Write header for data file
-            row = self.DATA_COLS
-        else:
-            data.update(trial_data)
-            row = []
-            for name in self.DATA_COLS:
-                value = data.get(name, '')
-                if value == '':
-                    logging.warning('Data for col {} not found'.format(name))
-                elif name in ['sound_x', 'sound_y']:
-                    value = SimilarityJudgments.get_message_id_from_path(value)
-                row.append(value)
-
-            for x in trial_data.keys():
-                if x not in self.DATA_COLS:
-                    logging.warning('Data for {} not saved'.format(x))
-        self.data_file.write(','.join(map(str, row))+'\n')
+    def close(self):
+        self.sounds.close()
+        core.quit()
 
-    @staticmethod
-    def get_message_id_from_path(sound_path):
-        # e.g., 'path/to/sound/filename.wav' -> 'filename'
-        # Also needs to be able to handle sound_path == numpy.int64
-        try:
-            message_id = Path(sound_path).stem
-        except TypeError:
-            message_id = Path(int(sound_path)).stem
 
-        return message_id
+class SoundPool(object):
+    """Load sounds in a background thread and keep the recent ones.
+
+    Sounds are loaded in the order they are prefetched. Once more than
+    `size` sounds are loaded, the least recently used ones are dropped.
+    Call close to stop the thread once the sounds are no longer needed.
+    """
+    STOP = object()  # put in the queue to stop the worker
+
+    def __init__(self, size=20, load=None):
+        self.size = size
+        self.load = load or sound.Sound
+        self.sounds = OrderedDict()
+        self.loading = {}
+        self.lock = threading.Lock()
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self.work)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def prefetch(self, names):
+        """Start loading any sounds that aren't loaded or loading."""
+        for name in names:
+            with self.lock:
+                if name in self.sounds or name in self.loading:
+                    continue
+                self.loading[name] = threading.Event()
+            self.requests.put(name)
+
+    def get(self, name):
+        """Get a sound, loading it now if it wasn't prefetched."""
+        while True:
+            self.prefetch([name])
+            with self.lock:
+                if name in self.sounds:
+                    snd = self.sounds.pop(name)
+                    self.sounds[name] = snd  # most recently used
+                    break
+                loaded = self.loading[name]
+            loaded.wait()
+
+        if isinstance(snd, Exception):
+            with self.lock:
+                del self.sounds[name]
+            raise snd
+        return snd
+
+    def close(self):
+        """Stop the worker after it loads the sounds already requested."""
+        self.requests.put(self.STOP)
+        self.worker.join()
+
+    def work(self):
+        while True:
+            name = self.requests.get()
+            if name is self.STOP:
+                break
+            try:
+                snd = self.load(name)
+            except Exception as err:
+                snd = err  # raised when the sound is needed
+            with self.lock:
+                self.sounds[name] = snd
+                while len(self.sounds) > self.size:
+                    self.sounds.popitem(last=False)
+                self.loading.pop(name).set()
+
+
+class JudgmentStore(object):
+    """Judgments of one participant in a SQLite database.
+
+    Each judgment is committed as soon as it is added. The database is in
+    WAL mode, so a commit appends to the log instead of rewriting pages.
+    Judgments are indexed by their edge, as (min id, max id) of the two
+    sounds, so they can be matched to edges in either order.
+
+    A new database is filled from import_csv, if it exists. The database
+    isn't shared between machines, but the csv it's exported to is, so
+    judgments made elsewhere can be added to an existing database with
+    import_csv, before it's exported over the csv.
+    """
+    INTEGER_COLUMNS = ('block_ix trial_ix sound_x sound_y reversed '
+                       'similarity repeat').split()
+
+    def __init__(self, path, columns, overwrite=False, import_csv=None):
+        self.columns = list(columns)
+        is_new = not Path(path).exists()
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        columns = ['"{}" {}'.format(name, 'INTEGER' if name in
+                                   self.INTEGER_COLUMNS else 'TEXT')
+                   for name in self.columns]
+        self.db.execute('CREATE TABLE IF NOT EXISTS judgments ({}, '
+                        'edge_x INTEGER, edge_y INTEGER)'.format(
+                            ', '.join(columns)))
+        self.db.execute('CREATE INDEX IF NOT EXISTS judgments_edge '
+                        'ON judgments (edge_x, edge_y)')
+        if overwrite:
+            self.db.execute('DELETE FROM judgments')
+        elif is_new and import_csv and Path(import_csv).exists():
+            self.import_csv(import_csv)
+        self.db.commit()
+
+    def add(self, row):
+        """Add a judgment given as a dict of columns."""
+        self.insert([row])
+        self.db.commit()
+
+    def insert(self, rows, table='judgments'):
+        records = []
+        for row in rows:
+            edge = sorted([int(row['sound_x']), int(row['sound_y'])])
+            values = [row.get(name, '') for name in self.columns] + edge
+            records.append([sql_value(value) for value in values])
+        self.db.executemany('INSERT INTO {} VALUES ({})'.format(
+            table, ', '.join('?' * (len(self.columns) + 2))), records)
+
+    def import_csv(self, src):
+        """Add the judgments in a csv that aren't in the database yet.
+
+        Judgments are matched on all of their columns, and are added in
+        the order they are in the csv.
+        """
+        previous = pandas.read_csv(src, dtype=str, keep_default_na=False)
+        # Read into a table with the same column types, so the judgments
+        # in the csv compare equal to the ones in the database.
+        self.db.execute('CREATE TEMP TABLE IF NOT EXISTS imported AS '
+                        'SELECT * FROM judgments WHERE 0')
+        self.db.execute('DELETE FROM imported')
+        self.insert(previous.to_dict('records'), table='imported')
+
+        n_columns = len(self.columns)
+        stored = Counter(row[:n_columns] for row in
+                         self.db.execute('SELECT * FROM judgments'))
+        missing = []
+        for row in self.db.execute('SELECT * FROM imported ORDER BY rowid'):
+            if stored[row[:n_columns]] > 0:
+                stored[row[:n_columns]] -= 1
+            else:
+                missing.append(row)
+        if missing:
+            logging.critical('Importing {} of {} judgments from {}'.format(
+                len(missing), len(previous), src))
+            self.db.executemany('INSERT INTO judgments VALUES ({})'.format(
+                ', '.join('?' * (n_columns + 2))), missing)
+        self.db.commit()
+
+    def unfinished(self, edges):
+        """Select the edges that haven't been judged.
+
+        An edge is done if it has any judgment, in either order.
+        """
+        edge_x, edge_y = canonical_edges(edges.sound_x, edges.sound_y)
+        self.db.execute('CREATE TEMP TABLE IF NOT EXISTS candidates '
+                        '(edge_ix INTEGER PRIMARY KEY, edge_x INTEGER, '
+                        'edge_y INTEGER)')
+        self.db.execute('DELETE FROM candidates')
+        self.db.executemany('INSERT INTO candidates VALUES (?, ?, ?)',
+                            zip(range(len(edges)), edge_x.tolist(),
+                                edge_y.tolist()))
+        unfinished = [edge_ix for edge_ix, in self.db.execute(
+            'SELECT edge_ix FROM candidates AS c WHERE NOT EXISTS '
+            '(SELECT 1 FROM judgments AS j '
+            ' WHERE j.edge_x = c.edge_x AND j.edge_y = c.edge_y) '
+            'ORDER BY edge_ix')]
+        return edges.iloc[unfinished]
+
+    def export_csv(self, dst):
+        """Write the judgments to a csv, in the order they were made."""
+        judgments = pandas.read_sql_query(
+            'SELECT {} FROM judgments ORDER BY rowid'.format(', '.join(
+                '"{}"'.format(name) for name in self.columns)), self.db)
+        judgments.to_csv(dst, index=False)
+
+    def close(self):
+        self.db.close()
+
+
+def sql_value(value):
+    if isinstance(value, datetime):
+        return str(value)
+    elif isinstance(value, numpy.generic):
+        return value.item()
+    return value
 
 
 class Trials(object):
-    def __init__(self, seed=None, completed_csv=None):
+    def __init__(self, seed=None, store=None, edges='linear_edges.csv'):
         # Start with info for (gen i, gen i + 1) edges.
-        edges = pandas.read_csv('linear_edges.csv')
+        edges = Trials.read_edges(edges)
 
-        try:
-            previous_data = pandas.read_csv(completed_csv)
-            completed_edges = Trials.edges_to_sets(previous_data)
-        except ValueError, IOError:
-            logging.critical('Could not find existing data. Running all trials.')
+        if store is None:
             trials = edges  # all trials are new
         else:
-            trials = Trials.remove_completed_trials(edges, completed_edges)
+            trials = store.unfinished(edges).copy()
+            logging.critical('Already completed {} of {} total trials ({} left)'.format(
+                len(edges) - len(trials), len(edges), len(trials)
+            ))
 
         self.random = numpy.random.RandomState(seed)
         trials['reversed'] = self.random.choice(range(2), len(trials))
@@ -223,6 +407,7 @@ class Trials(object):
         trials.insert(0, 'trial_ix', range(1, len(trials)+1))
 
         self.trials = trials
+        self.n_trials = len(trials)
 
     def blocks(self):
         blocks = [block.itertuples()
@@ -230,21 +415,20 @@ class Trials(object):
         return blocks
 
     @staticmethod
-    def remove_completed_trials(edges, completed_edges):
-        is_unfinished = (pandas.Series(Trials.edges_to_sets(edges),
-                                       index=edges.index)
-                               .apply(lambda x: x not in completed_edges))
-        unfinished = edges[is_unfinished]
-        logging.critical('Already completed {} of {} total trials ({} left)'.format(
-            (~is_unfinished).sum(), len(edges), len(unfinished)
-        ))
-        return unfinished
-
-    @staticmethod
-    def edges_to_sets(edges):
-        stem = lambda x: SimilarityJudgments.get_message_id_from_path(x)
-        return [{stem(edge.sound_x), stem(edge.sound_y)}
-                for edge in edges.itertuples()]
+    def read_edges(edges):
+        """Read a csv of edges, or take a DataFrame of them.
+
+        Sounds are given as paths relative to this directory. Any other
+        columns are dropped.
+        """
+        if not isinstance(edges, pandas.DataFrame):
+            edges = pandas.read_csv(edges)
+        edges = edges[['sound_x', 'sound_y']].copy()
+        for col in ['sound_x', 'sound_y']:
+            if edges[col].dtype.kind in 'iu':
+                edges[col] = [SOUND_PATH.format(message_id)
+                              for message_id in edges[col]]
+        return edges
 
     @staticmethod
     def determine_imitation_category(audio):
@@ -254,12 +438,108 @@ class Trials(object):
         return categories.reindex(audio).category.tolist()
 
 
+class AdaptiveTrials(Trials):
+    """Run the most informative trials first, within each category block.
+
+    Each edge gets a priority from the judgments already made by all the
+    raters in DATA_DIR:
+
+        disagreement: Difference between the mean rating of the edge and
+            its acoustic similarity, both scaled to [0, 1].
+        variance: Variance of the ratings of the edge, scaled to [0, 1].
+        count: 1 / (1 + the number of ratings of the edge).
+
+    Edges with too few ratings for a term get the average of that term
+    over the other edges. Priorities are computed once, when the trials
+    are made, and don't change during the session, so the trials in each
+    block are run in order of priority. Blocks can be limited to the
+    block_size highest priority trials.
+    """
+    WEIGHTS = dict(disagreement=1.0, variance=1.0, count=1.0)
+
+    def __init__(self, seed=None, store=None, edges='linear_edges.csv',
+                 block_size=None, ratings=None, similarities=None,
+                 weights=None):
+        super(AdaptiveTrials, self).__init__(seed=seed, store=store,
+                                             edges=edges)
+        if ratings is None:
+            ratings = read_ratings(DATA_DIR.listdir('*.csv'))
+        if similarities is None:
+            similarities = pandas.concat(
+                [pandas.read_csv(Path(SIMILARITIES_DIR, csv))
+                 for csv in ['within.csv', 'between.csv']],
+                ignore_index=True)
+        self.weights = dict(self.WEIGHTS, **(weights or {}))
+
+        priorities = edge_priorities(self.trials, ratings, similarities,
+                                     self.weights)
+        # Break ties in a different order for each session.
+        priorities = priorities + self.random.uniform(0, 1e-9,
+                                                      len(priorities))
+        self.trials['priority'] = priorities
+
+        self.block_size = block_size
+        block_sizes = self.trials.groupby('category').size()
+        if block_size is not None:
+            block_sizes = block_sizes.clip(upper=block_size)
+        self.n_trials = int(block_sizes.sum())
+
+    def blocks(self):
+        return [self.pick(list(block))
+                for block in super(AdaptiveTrials, self).blocks()]
+
+    def pick(self, trials):
+        """Order the trials in a block by priority, highest first."""
+        trials = sorted(trials, key=lambda trial: trial.priority,
+                        reverse=True)
+        return trials[:self.block_size]
+
+
+def read_ratings(paths):
+    """Read the final rating of each edge by each rater."""
+    frames = [read_final_ratings(path) for path in paths]
+    if not frames:
+        return pandas.DataFrame(columns=['name', 'edge_x', 'edge_y',
+                                         'similarity'])
+    ratings = pandas.concat(frames, ignore_index=True)
+    return ratings.drop_duplicates(['name', 'edge_x', 'edge_y'],
+                                   keep='last')
+
+
+def edge_priorities(edges, ratings, similarities, weights):
+    """Score how much is to be learned from a judgment of each edge."""
+    edge_x, edge_y = canonical_edges(edges.sound_x, edges.sound_y)
+    keys = pandas.MultiIndex.from_arrays([edge_x, edge_y],
+                                         names=['edge_x', 'edge_y'])
+
+    acoustic = similarities.similarity.rank(pct=True)
+    acoustic.index = pandas.MultiIndex.from_arrays(
+        canonical_edges(similarities.sound_x, similarities.sound_y),
+        names=['edge_x', 'edge_y'])
+    acoustic = acoustic[~acoustic.index.duplicated()].reindex(keys)
+    stats = (ratings.groupby(['edge_x', 'edge_y']).similarity
+                    .agg(['count', 'mean', 'var']).reindex(keys))
+
+    lowest, highest = min(RatingScale.VALUES), max(RatingScale.VALUES)
+    scale = float(highest - lowest)
+    disagreement = ((stats['mean'] - lowest) / scale - acoustic).abs()
+    variance = stats['var'] / (scale / 2)**2
+    count = 1.0 / (1 + stats['count'].fillna(0))
+
+    def fill(term):
+        return term.fillna(term.mean()).fillna(0.5)
+
+    priorities = (weights['disagreement'] * fill(disagreement) +
+                  weights['variance'] * fill(variance) +
+                  weights['count'] * count)
+    return priorities.values
+
+
 class RatingScale(object):
     QUESTION = "Rate the similarity between the two sounds"
     NOTES = "To hear the sounds again, press 'r'. If there was an error, press 'e' to report it. To quit the experiment, press 'q'. You can resume it later."
-    VALUES = range(1, 8)
-    KEYBOARD = dict(q='quit', e='error', r='repeat')
-    KEYBOARD.update({str(i): i for i in VALUES})
+    VALUES = RATING_VALUES
+    KEYBOARD = RATING_KEYS
     X_GUTTER = 80
     LABEL_Y = 50
     FONT_SIZE = 30
@@ -305,14 +585,8 @@ class RatingScale(object):
             self.flip()
 
     def get_response(self):
-        keyboard_responses = event.waitKeys(keyList=self.KEYBOARD.keys())
-        key = self.KEYBOARD.get(keyboard_responses[0])
-        if key == 'quit':
-            raise QuitExperiment
-        elif key == 'error':
-            raise ReportError
-        elif key == 'repeat':
-            raise RepeatTrial
+        keyboard_responses = event.waitKeys(keyList=list(self.KEYBOARD.keys()))
+        key = rating_from_key(keyboard_responses[0])
         self.highlight(key)
         return key
 
@@ -341,15 +615,10 @@ class TextEntryForm(object):
         typing = True
         while typing:
             for key in event.getKeys():
-                if key in ['enter', 'return']:
+                response, done = type_key(response, key)
+                if done:
                     typing = False
                     break
-                elif key == 'backspace' and len(response) > 0:
-                    response = response[:-1]
-                elif key in string.lowercase + string.digits:
-                    response += key
-                elif key == 'space':
-                    response += ' '
 
                 self.text_box_title.draw()
                 self.text_box.setText(response)
@@ -368,17 +637,28 @@ def get_player_info():
     return clean
 
 
-class QuitExperiment(Exception):
-    pass
-
-class ReportError(Exception):
-    pass
-
-class RepeatTrial(Exception):
-    pass
-
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=TITLE)
+    parser.add_argument('--import', dest='import_csv', action='store_true',
+                        help=('Add the judgments in the csv that aren\'t in '
+                              'the database, e.g. ones made on another '
+                              'machine.'))
+    parser.add_argument('--adaptive', action='store_true',
+                        help='Run the most informative trials first.')
+    parser.add_argument('--edges', default='linear_edges.csv',
+                        help=('Csv of the edges to judge, e.g. '
+                              '../data/within_category.csv.'))
+    parser.add_argument('--block-size', type=int,
+                        help=('Most trials to run in each category block. '
+                              'Needs --adaptive.'))
+    args = parser.parse_args()
+    if args.block_size is not None and not args.adaptive:
+        parser.error('--block-size needs --adaptive')
+
     player = get_player_info()
-    judgments = SimilarityJudgments(player, overwrite=False)
+    judgments = SimilarityJudgments(player, overwrite=False,
+                                    import_csv=args.import_csv,
+                                    adaptive=args.adaptive, edges=args.edges,
+                                    block_size=args.block_size)
     logging.LogFile(judgments.log_file, level=logging.CRITICAL)
     judgments.run()
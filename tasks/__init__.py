@@ -8,5 +8,9 @@ logger = logging.getLogger(__name__)
 logger.addHandler(logging.StreamHandler())
 
 from .download import download, create_info_for_judgments
+from .audio_store import normalize_sounds
 from .compare_sounds import compare_sounds, edge_types
 from .compare_words import compare_words
+from .nearest import nearest_sounds
+from .stats import similarity_stats
+from .ratings import aggregate_judgments
@@ -0,0 +1,156 @@
+"""Analysis-ready audio for every sound, in one memory-mapped array.
+
+Each wav in data/sounds is resampled to RATE, folded to mono, trimmed of
+leading and trailing silence, and stored as float32 samples back to back
+in a single file. An index gives the offset and length of each message's
+samples, so a sound can be read as a slice of the array without decoding
+its wav file again.
+"""
+import logging
+import multiprocessing
+import os
+
+from invoke import task
+import numpy
+import pandas
+import pydub
+from unipath import Path
+
+from .edges.messages import hash_file
+from .settings import *
+
+logger = logging.getLogger(__name__)
+
+RATE = 16000
+SILENCE_THRESHOLD = -50.0  # dBFS
+SILENCE_WINDOW = 0.01  # seconds
+
+
+@task(help=dict(
+    processes="Number of processes to decode with. Defaults to all cores.",
+))
+def normalize_sounds(ctx, processes=None):
+    """Store every sound as mono float32 audio at a common sample rate."""
+    wavs = sorted(Path(SOUNDS_DIR).listdir(pattern='*.wav'))
+    build_audio_store(wavs, processes=int(processes) if processes else None)
+
+
+def build_audio_store(wavs, store=AUDIO_STORE, index=AUDIO_INDEX,
+                      processes=None):
+    """Write the samples of each wav to the store, reusing unchanged ones.
+
+    A wav that can't be decoded is logged and left out of the store.
+    """
+    sounds = pandas.DataFrame({'wav': wavs})
+    sounds['message_id'] = sounds.wav.apply(lambda x: int(Path(x).stem))
+    sounds['source_hash'] = sounds.wav.apply(hash_file)
+
+    previous = None
+    if Path(store).exists() and Path(index).exists():
+        previous = AudioStore(store, index)
+        is_unchanged = sounds.set_index('message_id').source_hash.eq(
+            previous.index.source_hash.reindex(sounds.message_id)).values
+    else:
+        is_unchanged = numpy.zeros(len(sounds), dtype=bool)
+
+    changed = sounds.wav[~is_unchanged].tolist()
+    logger.info('Normalizing {} of {} sounds'.format(len(changed),
+                                                     len(sounds)))
+    decoded = {}
+    failed = []
+    pool = multiprocessing.Pool(processes)
+    try:
+        for wav, samples, error in pool.map(decode_wav, changed):
+            if error is not None:
+                failed.append('{} ({})'.format(Path(wav).name, error))
+                continue
+            decoded[wav] = samples
+    finally:
+        pool.close()
+        pool.join()
+
+    if failed:
+        logger.warning('{} sounds could not be normalized: {}'.format(
+            len(failed), ', '.join(sorted(failed))))
+        is_stored = is_unchanged | sounds.wav.isin(list(decoded)).values
+        sounds = sounds[is_stored].reset_index(drop=True)
+        is_unchanged = is_unchanged[is_stored]
+
+    def get_samples(sound, unchanged):
+        if unchanged:
+            return previous[sound.message_id]
+        return decoded[sound.wav]
+
+    lengths = [len(get_samples(sound, unchanged)) for sound, unchanged
+               in zip(sounds.itertuples(), is_unchanged)]
+    sounds['length'] = lengths
+    sounds['offset'] = numpy.cumsum(lengths) - lengths
+
+    tmp = '{}.{}.tmp'.format(store, os.getpid())
+    samples = numpy.memmap(tmp, dtype=numpy.float32, mode='w+',
+                           shape=(max(1, sum(lengths)), ))
+    for sound, unchanged in zip(sounds.itertuples(), is_unchanged):
+        samples[sound.offset:sound.offset+sound.length] = \
+            get_samples(sound, unchanged)
+    samples.flush()
+    del samples, previous
+    os.rename(tmp, store)
+
+    sounds[['message_id', 'offset', 'length', 'source_hash']].to_csv(
+        index, index=False)
+
+
+def decode_wav(wav):
+    """Normalize one wav. Runs in a worker process.
+
+    Errors are returned instead of raised, so one bad sound doesn't stop
+    the rest of the sounds from being stored.
+    """
+    try:
+        return wav, normalize_wav(wav), None
+    except Exception as e:
+        return wav, None, repr(e)
+
+
+def normalize_wav(wav):
+    """Decode a wav as mono float32 samples at RATE, trimming silence."""
+    audio = pydub.AudioSegment.from_wav(wav)
+    audio = audio.set_channels(1).set_frame_rate(RATE).set_sample_width(2)
+    samples = numpy.frombuffer(audio.raw_data, dtype='<i2')
+    samples = samples.astype(numpy.float32) / 32768
+    return trim_silence(samples)
+
+
+def trim_silence(samples, rate=RATE, threshold=SILENCE_THRESHOLD,
+                 window=SILENCE_WINDOW):
+    """Drop the windows before the first and after the last loud window."""
+    n = int(rate * window)
+    n_windows = len(samples) // n
+    if n_windows == 0:
+        return samples
+    windows = samples[:n_windows*n].reshape(n_windows, n)
+    rms = numpy.sqrt((windows.astype(numpy.float64)**2).mean(axis=1))
+    loud = numpy.flatnonzero(20 * numpy.log10(rms + 1e-10) > threshold)
+    if len(loud) == 0:
+        return samples
+    stop = len(samples) if loud[-1] == n_windows - 1 else (loud[-1] + 1) * n
+    return samples[loud[0]*n:stop]
+
+
+class AudioStore(object):
+    """Read normalized sounds as slices of the memory-mapped store."""
+    rate = RATE
+
+    def __init__(self, store=AUDIO_STORE, index=AUDIO_INDEX):
+        self.samples = numpy.memmap(store, dtype=numpy.float32, mode='r')
+        self.index = pandas.read_csv(index).set_index('message_id')
+
+    def __getitem__(self, message_id):
+        sound = self.index.loc[message_id]
+        return self.samples[sound.offset:sound.offset+sound.length]
+
+    def __contains__(self, message_id):
+        return message_id in self.index.index
+
+    def __len__(self):
+        return len(self.index)
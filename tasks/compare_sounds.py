@@ -1,46 +1,74 @@
 import sys
 import json
+import logging
+import re
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 
 from invoke import task
+import numpy
 import pandas
 from acousticsim.main import acoustic_similarity_mapping
 
-from . import edges
-from .edges.edge import create_edge_set
-from .edges import (create_single_edge, get_linear_edges,
-                    get_all_between_edges, get_all_within_edges,
+from . import edges, timing
+from .features import load_features, representation_fingerprint
+from .dtw import dtw_distances
+from .journal import SimilarityJournal
+from .matrix import SimilarityMatrix
+from .query import SimilarityQuery
+from .edges.lineage import LINEAGE_COLUMNS
+from .edges.edge import edge_keys, message_ids
+from .edges import (create_single_edge, iter_edge_batches,
                     message_id_from_wav)
 from .settings import *
 
+logger = logging.getLogger(__name__)
+
+DEFAULT_KWARGS = {'rep': 'mfcc', 'num_coeffs': 12, 'output_sim': True}
+
 
 @task(help=dict(
     type="Type of comparison. Provide --type=list to see available comparison types. Type determines which edges are compared. If no type is given, all types are compared",
     x="Path to first wav file to compare. Optional. If specified, arg y is required.",
     y="Path to second wav file. Optional.",
-    json_kwargs="Key word args to pass to acoustic_similarity_mapping function",
+    json_kwargs=("Key word args to pass to acoustic_similarity_mapping "
+                 "function. Give a list of them to score each config."),
+    jobs="Number of processes to use for scoring edges. Defaults to 1.",
+    restart="Score every edge again instead of resuming from the journal.",
+    batch_size="Number of edges to generate and score at a time.",
+    top_k="Only keep the k most similar edges of each type.",
+    min_similarity="Only keep edges at least this similar.",
+    trace="Write a Chrome trace of the time spent in each stage to a file.",
+    profile="Profile the comparisons with cProfile, dumping stats to a file.",
 ))
 def compare_sounds(ctx, type=None, x=None, y=None, json_kwargs=None,
-                   no_defaults=False):
+                   no_defaults=False, jobs=1, restart=False,
+                   batch_size=50000, top_k=None, min_similarity=None,
+                   trace=None, profile=None):
     """Compute acoustic similarity between .wav files.
 
     Run MFCC comparisons and return the distances:
 
         $ inv compare_sounds -j '{"rep": "mfcc", "num_coeffs": 12, "output_sim": true}'
 
+    Several configs can be scored in one pass over the edges by giving a
+    list of them. The results are a wide table with a similarity column
+    for each config, saved as "{type}_wide.csv":
+
+        $ inv compare_sounds -j '[{"num_coeffs": 12}, {"num_coeffs": 20}]'
+
     To see what other options are available via the json_kwargs argument,
     see:
 
         https://github.com/PhonologicalCorpusTools/CorpusTools/blob/master/corpustools/acousticsim/main.py#L48
 
     """
-    kwargs = json.loads(json_kwargs) if json_kwargs else {}
-
-    if not no_defaults:
-        kwargs.update({'rep': 'mfcc', 'num_coeffs': 12, 'output_sim': True})
+    configs = scoring_configs(json_kwargs, no_defaults)
 
     if x and y:
         edges = create_single_edge(x, y)
-        similarities = calculate_similarities(edges, **kwargs)
+        similarities = score_configs(edges, configs)
         similarities.to_csv(sys.stdout, index=False)
         return
     elif x or y:
@@ -60,77 +88,271 @@ def compare_sounds(ctx, type=None, x=None, y=None, json_kwargs=None,
         types = ['within', 'between']
 
     for edge_type in types:
-        if edge_type == 'linear':
-            edges = get_linear_edges()
-        elif edge_type == 'between':
-            edges = get_all_between_edges()
-        elif edge_type == 'within':
-            edges = get_all_within_edges()
-        else:
+        if edge_type not in available_types:
             raise NotImplementedError('edge type "{}"'.format(edge_type))
 
-        similarities = calculate_similarities(edges, **kwargs)
-        similarities.to_csv(Path(SIMILARITIES_DIR, '{}.csv'.format(edge_type)),
-                            index=False)
+    timing.show_timings()
+    with timing.instrumented('compare_sounds', trace, profile):
+        if top_k or min_similarity is not None:
+            assert len(configs) == 1, 'queries take a single config'
+            query_edge_types(types, top_k, min_similarity,
+                             batch_size=int(batch_size), **configs[0])
+        else:
+            score_edge_types(types, configs, jobs=int(jobs),
+                             restart=restart, batch_size=int(batch_size))
+
+
+def score_edge_types(types, configs, jobs=1, restart=False,
+                     batch_size=50000):
+    journals = [SimilarityJournal(SIMILARITIES_JOURNAL, **config)
+                for config in configs]
+    matrices = [SimilarityMatrix(MATRICES_DIR, **config)
+                for config in configs]
+    columns = similarity_columns(configs)
+    for edge_type in types:
+        # Results are written as each batch is scored, so only one batch
+        # of edges is held in memory at a time.
+        if len(configs) == 1:
+            output = Path(SIMILARITIES_DIR, '{}.csv'.format(edge_type))
+        else:
+            output = Path(SIMILARITIES_DIR, '{}_wide.csv'.format(edge_type))
+            with open(Path(SIMILARITIES_DIR,
+                           '{}_wide.json'.format(edge_type)), 'w') as f:
+                json.dump(dict(zip(columns, configs)), f, indent=2,
+                          sort_keys=True)
+
+        batches = timing.timed_iter(
+            'make {} edges'.format(edge_type),
+            iter_edge_batches(edge_type, batch_size=batch_size))
+        for i, edges in enumerate(batches):
+            with timing.span('batch {}'.format(i), edges=len(edges)):
+                # Hashed by the journal, which keeps them for looking up
+                # and recording the batch.
+                wavs = set(edges.sound_x) | set(edges.sound_y)
+                hashes = {message_id_from_wav(wav): journals[0].wav_hash(wav)
+                          for wav in wavs}
+                similarities = score_configs(
+                    edges, configs, jobs=jobs, journals=journals,
+                    resume=not restart)
+                with timing.span('write'):
+                    similarities.to_csv(output, index=False,
+                                        header=(i == 0),
+                                        mode='w' if i == 0 else 'a')
+                    for column, matrix in zip(columns, matrices):
+                        scored = similarities.ix[
+                            similarities[column].notnull()]
+                        matrix.record(scored.sound_x, scored.sound_y,
+                                      scored[column], hashes)
+    for journal, matrix in zip(journals, matrices):
+        journal.close()
+        matrix.close()
 
 
-@task
-def edge_types(ctx):
-    within = pandas.read_csv(Path(SIMILARITIES_DIR, 'within.csv'))
-    between = pandas.read_csv(Path(SIMILARITIES_DIR, 'between.csv'))
-    similarities = pandas.concat([within, between], ignore_index=True)
-    similarities = create_edge_set(similarities)
-    similarities = similarities[['edge_set', 'similarity']]
+def score_configs(edges, configs, jobs=1, journals=None, resume=True):
+    """Score the same edges with each config.
 
-    def merge_similarities(edges):
-        edges = edges.copy()
-        edges = create_edge_set(edges)
-        edges = edges.merge(similarities)
-        del edges['edge_set']
-        return edges
+    With a single config, this is the same as calculate_similarities.
+    With more than one, the result is a wide table with a similarity
+    column for each config, and edges that failed to score with a config
+    have a missing value in its column. Configs with the same
+    representation share the features loaded for the edges.
+    """
+    journals = journals or [None] * len(configs)
+    if len(configs) == 1:
+        return calculate_similarities(edges, jobs=jobs, journal=journals[0],
+                                      resume=resume, **configs[0])
+
+    wide = edges.copy()
+    wide['sound_x'] = wide.sound_x.apply(message_id_from_wav)
+    wide['sound_y'] = wide.sound_y.apply(message_id_from_wav)
+    features = {}
+    for config, column, journal in zip(configs, similarity_columns(configs),
+                                       journals):
+        shared = features.setdefault(representation_fingerprint(**config),
+                                     {})
+        with timing.span(column):
+            similarities = calculate_similarities(
+                edges.copy(), jobs=jobs, journal=journal, resume=resume,
+                features=shared, **config)
+        similarities = (similarities[['sound_x', 'sound_y', 'similarity']]
+                        .drop_duplicates(['sound_x', 'sound_y']))
+        wide = wide.merge(similarities.rename(columns={'similarity': column}),
+                          how='left')
+    return wide
 
-    # Within category edge types
 
-    linear_edges = edges.within.get_linear_edges()
-    linear_edges = edges.messages.get_message_ids_for_edge(linear_edges)
-    linear_edges = merge_similarities(linear_edges)
-    linear_edges.to_csv(Path(DATA_DIR, 'linear.csv'), index=False)
+def query_edge_types(types, top_k=None, min_similarity=None,
+                     batch_size=50000, **kwargs):
+    # Edges that can't be in the results are pruned with lower bounds
+    # on their DTW distance, so most edges are never fully scored.
+    for edge_type in types:
+        query = SimilarityQuery(top_k, min_similarity, **kwargs)
+        batches = timing.timed_iter(
+            'make {} edges'.format(edge_type),
+            iter_edge_batches(edge_type, batch_size=batch_size))
+        for i, edges in enumerate(batches):
+            with timing.span('query batch {}'.format(i), edges=len(edges)):
+                query.add(edges)
+        logger.info('{}: {}'.format(edge_type, query.report()))
+        output = Path(SIMILARITIES_DIR, '{}_query.csv'.format(edge_type))
+        query.results().to_csv(output, index=False)
+
 
-    chain_edges = edges.within.get_within_chain_edges()
-    chain_edges = edges.messages.get_message_ids_for_edge(chain_edges)
-    chain_edges = merge_similarities(chain_edges)
-    chain_edges.to_csv(Path(DATA_DIR, 'within_chain.csv'), index=False)
+def scoring_configs(json_kwargs=None, no_defaults=False):
+    """Parse one config or a list of configs, filling in the defaults."""
+    configs = json.loads(json_kwargs) if json_kwargs else {}
+    if isinstance(configs, dict):
+        configs = [configs]
+    assert configs, 'need at least one config'
+    defaults = {} if no_defaults else DEFAULT_KWARGS
+    return [dict(defaults, **config) for config in configs]
 
-    seed_edges = edges.within.get_within_seed_edges()
-    seed_edges = edges.messages.get_message_ids_for_edge(seed_edges)
-    seed_edges = merge_similarities(seed_edges)
-    seed_edges.to_csv(Path(DATA_DIR, 'within_seed.csv'), index=False)
 
-    category_edges = edges.within.get_within_category_edges()
-    category_edges = edges.messages.get_message_ids_for_edge(category_edges)
-    category_edges = merge_similarities(category_edges)
-    category_edges.to_csv(Path(DATA_DIR, 'within_category.csv'), index=False)
+def scoring_kwargs(json_kwargs=None, no_defaults=False):
+    configs = scoring_configs(json_kwargs, no_defaults)
+    assert len(configs) == 1, 'need a single config'
+    return configs[0]
 
-    # Between category edge types
 
-    between_edges = edges.between.get_between_category_fixed_edges()
-    between_edges = edges.messages.get_message_ids_for_edge(between_edges)
-    between_edges = merge_similarities(between_edges)
-    between_edges.to_csv(Path(DATA_DIR, 'between_fixed.csv'), index=False)
+def similarity_columns(configs):
+    """Name the similarity column for each config by how it differs."""
+    if len(configs) == 1:
+        return ['similarity']
+
+    def label(value):
+        value = json.dumps(value, sort_keys=True).strip('"')
+        return re.sub(r'[^0-9A-Za-z.]+', '-', value).strip('-')
+
+    keys = sorted(set(key for config in configs for key in config))
+    differing = [key for key in keys
+                 if len(set(label(config.get(key)) for config in configs)) > 1]
+    columns = ['similarity_' + '_'.join('{}_{}'.format(key,
+                                                       label(config.get(key)))
+                                        for key in differing)
+               for config in configs]
+    assert len(set(columns)) == len(columns), 'configs must differ'
+    return columns
+
+
+@task(help=dict(
+    json_kwargs="Key word args the similarities were calculated with",
+))
+def edge_types(ctx, json_kwargs=None, no_defaults=False):
+    """Label the similarities with each type of edge.
+
+    Each edge is also labeled with the lineage of its two messages: the
+    difference in their generations, the generation of their lowest common
+    ancestor, and whether they share a seed or a branch.
+
+    Similarities are looked up in the similarity matrix for the given
+    kwargs. If there isn't a matrix yet, it's filled from the within and
+    between similarities in data/similarities.
+    """
+    kwargs = scoring_kwargs(json_kwargs, no_defaults)
+    matrix = SimilarityMatrix(MATRICES_DIR, **kwargs)
+    if not matrix.exists():
+        logger.info('Filling the similarity matrix from {}'.format(
+            SIMILARITIES_DIR))
+        for edge_type in ['within', 'between']:
+            scored = pandas.read_csv(
+                Path(SIMILARITIES_DIR, '{}.csv'.format(edge_type)))
+            matrix.record(scored.sound_x, scored.sound_y,
+                          scored.similarity)
+
+    edges_by_type = edges.get_edges_by_type(lineage=True)
+    for edge_type, type_edges in edges_by_type.items():
+        type_edges = merge_similarities(type_edges, matrix)
+        # between_consecutive.csv has always been written with its index.
+        type_edges.to_csv(Path(DATA_DIR, '{}.csv'.format(edge_type)),
+                          index=(edge_type == 'between_consecutive'))
+
+
+def merge_similarities(edges, matrix):
+    """Label edges with their similarities in the matrix.
+
+    Edges that haven't been scored are dropped. Duplicate edges, in either
+    direction, are moved up to the first one, so the rows are in the same
+    order as merging the edges with the similarities on their edge key.
+    """
+    edges = edges.copy()
+    edges['similarity'] = matrix.lookup(edges.sound_x, edges.sound_y)
+    edges = edges.ix[edges.similarity.notnull()]
+
+    keys = edge_keys(message_ids(edges.sound_x), message_ids(edges.sound_y))
+    _, first, inverse = numpy.unique(keys, return_index=True,
+                                     return_inverse=True)
+    edges = edges.iloc[numpy.argsort(first[inverse], kind='mergesort')]
 
-    consecutive_edges = edges.between.get_between_category_consecutive_edges()
-    consecutive_edges = edges.messages.get_message_ids_for_edge(consecutive_edges)
-    consecutive_edges = merge_similarities(consecutive_edges)
-    consecutive_edges.to_csv(Path(DATA_DIR, 'between_consecutive.csv'))
+    # The lineage columns go after the ones the csvs always had.
+    lineage = [column for column in LINEAGE_COLUMNS if column in edges]
+    columns = [column for column in edges.columns
+               if column not in lineage] + lineage
+    return edges[columns].reset_index(drop=True)
 
 
-def calculate_similarities(edges, **kwargs):
+def calculate_similarities(edges, jobs=1, chunk_size=250, journal=None,
+                           resume=True, features=None, **kwargs):
+    """Score each unique edge, splitting the work across processes.
+
+    Edges are scored in chunks of `chunk_size` pairs. If scoring a chunk
+    fails, or it crashes its worker, the edges in that chunk are dropped
+    from the results and the rest of the run continues. Failed chunks are
+    not journaled, so running again with the journal scores them.
+
+    If a SimilarityJournal is given, each chunk is added to the journal as
+    soon as it finishes, and unless resume is False, edges that are already
+    in the journal are not scored again.
+
+    Features that are already loaded can be given as a dict by wav. Any
+    that are missing are loaded and added to it.
+    """
     unique_edges = edges[['sound_x', 'sound_y']].drop_duplicates()
+    cols = ['sound_x', 'sound_y', 'similarity']
+
+    if journal is not None and resume:
+        with timing.span('journal lookup'):
+            previous = journal.lookup(unique_edges.sound_x,
+                                      unique_edges.sound_y)
+            is_scored = numpy.zeros(len(unique_edges), dtype=bool)
+            is_scored[previous.index.values.astype(int)] = True
+            timing.count(cache_hits=len(previous),
+                         cache_misses=len(unique_edges) - len(previous))
+        logger.info('Found {} of {} edges in the journal'.format(
+            len(previous), len(unique_edges)))
+        unique_edges = unique_edges[~is_scored]
+    else:
+        previous = pandas.DataFrame(columns=cols)
+
     mapping = [(edge.sound_x, edge.sound_y)
                for edge in unique_edges.itertuples()]
-    results = acoustic_similarity_mapping(mapping, **kwargs)
-    records = [(x, y, score) for (x, y), score in results.items()]
-    cols = ['sound_x', 'sound_y', 'similarity']
+    features = {} if features is None else features
+    wavs = set(unique_edges.sound_x) | set(unique_edges.sound_y)
+    with timing.span('load features'):
+        features.update(load_features(
+            [wav for wav in wavs if wav not in features], **kwargs))
+
+    chunks = []
+    for chunk_ix, start in enumerate(range(0, len(mapping), chunk_size)):
+        chunk = mapping[start:start+chunk_size]
+        chunk_wavs = set(wav for pair in chunk for wav in pair)
+        chunk_features = {wav: features[wav] for wav in chunk_wavs
+                          if wav in features}
+        chunks.append((chunk_ix, chunk, chunk_features, kwargs))
+
+    with timing.span('score', pairs=len(mapping)):
+        if jobs > 1:
+            scored_chunks = record_chunks(score_chunks(chunks, jobs), chunks,
+                                          journal)
+        else:
+            scored_chunks = record_chunks(map(score_chunk, chunks), chunks,
+                                          journal)
+
+    # Merge chunks in the order they were made, regardless of the order
+    # in which the workers finished them.
+    records = []
+    for chunk_ix, chunk_records in sorted(scored_chunks):
+        records.extend(chunk_records)
+
     scored_edges = pandas.DataFrame.from_records(records, columns=cols)
 
     # The sound_x, sound_y output from acousticsim is the basename of the file,
@@ -141,6 +363,109 @@ def calculate_similarities(edges, **kwargs):
     edges['sound_y'] = edges.sound_y.apply(message_id_from_wav)
     scored_edges['sound_x'] = scored_edges.sound_x.apply(message_id_from_wav)
     scored_edges['sound_y'] = scored_edges.sound_y.apply(message_id_from_wav)
+    scored_edges = pandas.concat([previous, scored_edges], ignore_index=True)
     labeled = edges.merge(scored_edges)
 
     return labeled
+
+
+def record_chunks(scored_chunks, chunks, journal=None):
+    """Collect chunks as they are scored, journaling each one right away."""
+    recorded = []
+    lost = []
+    for chunk_ix, chunk_records, error in scored_chunks:
+        if error is not None:
+            logger.warning('Failed to score chunk {} ({} edges): {}'.format(
+                chunk_ix, len(chunks[chunk_ix][1]), error))
+            lost.append(chunk_ix)
+            continue
+        if journal is not None:
+            journal.record(input_records(chunk_records, chunks[chunk_ix][1]))
+        recorded.append((chunk_ix, chunk_records))
+    if lost:
+        n_lost = sum(len(chunks[chunk_ix][1]) for chunk_ix in lost)
+        timing.count(lost_edges=n_lost)
+        logger.warning('Lost {} edges in chunks {}, they will be scored '
+                       'on the next run'.format(n_lost, sorted(lost)))
+    return recorded
+
+
+def input_records(records, mapping):
+    """Give scored records the wav paths they were scored from.
+
+    acousticsim returns the basenames of the wavs, not their paths.
+    """
+    wavs = {message_id_from_wav(wav): wav for pair in mapping for wav in pair}
+    return [(wavs[message_id_from_wav(x)], wavs[message_id_from_wav(y)],
+             similarity) for x, y, similarity in records]
+
+
+def score_chunk(chunk):
+    """Score a chunk of edges. Runs in a worker process."""
+    chunk_ix, mapping, features, kwargs = chunk
+    try:
+        if kwargs.get('match_function', 'dtw') == 'dtw':
+            records = score_dtw(mapping, features, **kwargs)
+        else:
+            results = acoustic_similarity_mapping(mapping, cache=features,
+                                                  **kwargs)
+            records = [(x, y, score) for (x, y), score in results.items()]
+    except Exception as e:
+        return chunk_ix, None, repr(e)
+    return chunk_ix, records, None
+
+
+def score_chunks(chunks, jobs, score=score_chunk):
+    """Score chunks on a pool of processes, yielding each as it finishes.
+
+    A worker that dies breaks the pool, failing every chunk that was
+    running in it. Those chunks are run again one at a time in a new pool,
+    so only a chunk that breaks the pool on its own is lost. Lost chunks
+    are yielded with an error, the same as chunks that raised one.
+    """
+    pending = deque(chunks)
+    suspects = deque()
+    while pending or suspects:
+        executor = ProcessPoolExecutor(jobs)
+        running = {}
+        try:
+            while pending or suspects or running:
+                if suspects:
+                    if not running:
+                        chunk = suspects.popleft()
+                        running[executor.submit(score, chunk)] = (chunk, True)
+                else:
+                    while pending and len(running) < jobs:
+                        chunk = pending.popleft()
+                        running[executor.submit(score, chunk)] = (chunk, False)
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                broken = any(isinstance(future.exception(), BrokenProcessPool)
+                             for future in done)
+                if broken:
+                    # Every chunk left in the pool fails with it.
+                    done, _ = wait(running)
+                for future in done:
+                    chunk, alone = running.pop(future)
+                    error = future.exception()
+                    if error is None:
+                        yield future.result()
+                    elif isinstance(error, BrokenProcessPool) and not alone:
+                        suspects.append(chunk)
+                    else:
+                        yield chunk[0], None, repr(error)
+                if broken:
+                    break
+        finally:
+            executor.shutdown()
+        if suspects:
+            logger.warning('A worker died, running {} chunks again one at '
+                           'a time'.format(len(suspects)))
+
+
+def score_dtw(mapping, features, output_sim=False, **kwargs):
+    """Score a block of edges with one call to the batched DTW kernel."""
+    distances = dtw_distances([features[x] for x, _ in mapping],
+                              [features[y] for _, y in mapping])
+    scores = 1/distances if output_sim else distances
+    return [(x, y, score) for (x, y), score in zip(mapping, scores)]
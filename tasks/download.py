@@ -1,15 +1,22 @@
+import io
 import logging
+import multiprocessing
+import zipfile
 
 from os import environ
-from invoke import task, run
+from invoke import task
 import boto3
 from unipath import Path
 import pydub
 
 from .edges.messages import (read_downloaded_messages,
                              label_branch_id_list,
-                             label_seed_id, update_audio_filenames)
+                             label_seed_id, update_audio_filenames,
+                             new_audio_filenames, getattr_null)
 from .edges.within import get_linear_edges
+from . import timing
+from .transfer import (download_objects, read_manifest, write_manifest,
+                       LocalBucket)
 from .settings import *
 
 logger = logging.getLogger(__name__)
@@ -20,27 +27,42 @@ logger = logging.getLogger(__name__)
     profile="The name of the AWS profile to use. Optional.",
     overwrite="Overwrite existing files? Default is false.",
     verbose="Should all info be printed to stdout?",
+    jobs="Number of parts to download at the same time. Defaults to 8.",
+    bucket_dir=("Download from a local copy of the bucket instead of S3. "
+                "Optional."),
+    trace="Write a Chrome trace of the time spent in each stage to a file.",
+    profile_stats="Profile the download with cProfile, dumping stats to a file.",
 ))
-def download(ctx, filename=None, profile=None, overwrite=False, verbose=False):
+def download(ctx, filename=None, profile=None, overwrite=False, verbose=False,
+             jobs=8, bucket_dir=None, trace=None, profile_stats=None):
     """Download the data from the Telephone app."""
-    if verbose:
-        logger.setLevel(logging.INFO)
-
-    files = determine_files_to_download(filename, overwrite)
-
-    if profile:
-        environ['AWS_PROFILE'] = profile
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(BUCKET_NAME)
-
-    for filename in files:
-        src = Path(BUCKET_NAME, filename)
-        dst = Path(DOWNLOAD_DIR, filename)
-        bucket.download_file(src, dst)
-
-    format_messages()
-    if 'words-in-transition.zip' in files:
-        unpack_and_cleanup_zip()
+    if verbose or trace or profile_stats:
+        timing.show_timings()
+
+    manifest = read_manifest(DOWNLOAD_MANIFEST)
+    files = determine_files_to_download(filename, overwrite, manifest)
+
+    if bucket_dir:
+        bucket = LocalBucket(bucket_dir)
+    else:
+        if profile:
+            environ['AWS_PROFILE'] = profile
+        s3 = boto3.resource('s3')
+        bucket = s3.Bucket(BUCKET_NAME)
+
+    keys = ['{}/{}'.format(BUCKET_NAME, filename) for filename in files]
+    with timing.instrumented('download', trace, profile_stats):
+        with timing.span('download objects'):
+            downloaded = download_objects(bucket, keys, DOWNLOAD_DIR,
+                                          DOWNLOAD_MANIFEST, jobs=int(jobs),
+                                          overwrite=overwrite)
+        downloaded = [Path(key).name for key in downloaded]
+
+        with timing.span('format messages'):
+            format_messages()
+        if 'words-in-transition.zip' in downloaded:
+            with timing.span('unpack zip'):
+                unpack_and_cleanup_zip()
 
 
 @task
@@ -63,15 +85,18 @@ def create_info_for_judgments(ctx):
     messages.to_csv('judgments/messages.csv', index=False)
 
 
-def determine_files_to_download(filename, overwrite):
-    # Create a list of files and remove the ones that exist unless overwriting
-    files = [filename] if filename else ALL_FILES
-
-    for filename in files:
-        if Path(DOWNLOAD_DIR, filename).exists() and not overwrite:
-            files.remove(filename)
+def determine_files_to_download(filename, overwrite, manifest=None):
+    """List the files to download.
 
-    return files
+    Files that were downloaded before are checked against the bucket and
+    only downloaded again if they changed. Files that exist but aren't in
+    the manifest are left alone unless overwriting.
+    """
+    files = [filename] if filename else ALL_FILES
+    manifest = manifest or {}
+    return [filename for filename in files
+            if overwrite or filename in manifest or
+            not Path(DOWNLOAD_DIR, filename).exists()]
 
 
 def format_messages():
@@ -88,33 +113,101 @@ def format_messages():
     messages.to_csv(Path(DATA_DIR, 'sounds.csv'), index=False)
 
 
-def unpack_and_cleanup_zip():
-    # Unpack and cleanup zip
-    run('unzip -o {}/words-in-transition.zip'.format(DOWNLOAD_DIR))
-    messages = read_downloaded_messages()
+def unpack_and_cleanup_zip(processes=None):
+    """Decode, trim and export the sound for each message.
+
+    Sounds are read straight out of the zip on a pool of processes.
+    Sounds whose source audio and trim points haven't changed since they
+    were last exported are skipped. A sound that can't be exported, or
+    isn't in the zip, is logged and left out of the manifest, so it's
+    tried again next time.
+    """
+    src = Path(DOWNLOAD_DIR, 'words-in-transition.zip')
     nginx_media_root = 'webapps/telephone/media'
-    messages['src'] = messages.audio.apply(lambda x: Path(nginx_media_root, x))
+    messages = read_downloaded_messages()
+    messages['member'] = messages.audio.apply(
+        lambda x: '{}/{}'.format(nginx_media_root, x))
     messages['dst'] = new_audio_filenames(messages.message_id)
 
+    manifest = read_manifest(SOUNDS_MANIFEST)
+    with zipfile.ZipFile(src) as archive:
+        members = {info.filename: info for info in archive.infolist()}
+
+    jobs = []
+    failed = []
     for message in messages.itertuples():
+        if message.member not in members:
+            failed.append('{} (not in the zip)'.format(
+                Path(message.member).name))
+            continue
+        info = members[message.member]
+        start_at = getattr_null(message, 'start_at', None)
+        end_at = getattr_null(message, 'end_at', None)
+        source_hash = '{:08x}-{}-{}-{}'.format(info.CRC, info.file_size,
+                                               start_at, end_at)
+        key = str(message.message_id)
+        if manifest.get(key) == source_hash and Path(message.dst).exists():
+            continue
+        jobs.append((src, message.member, message.dst, start_at, end_at,
+                     key, source_hash))
+    logger.info('Exporting {} of {} sounds'.format(len(jobs), len(messages)))
+
+    too_short = []
+    pool = multiprocessing.Pool(processes)
+    try:
+        # Sounds are added to the manifest as they finish, and the
+        # manifest is written even if the export is interrupted.
+        for key, source_hash, duration, name, error in \
+                pool.imap_unordered(export_sound, jobs):
+            if error is not None:
+                failed.append('{} ({})'.format(name, error))
+                continue
+            manifest[key] = source_hash
+            if duration < 0.4:
+                too_short.append('{} ({:.2f}s)'.format(name, duration))
+    finally:
+        pool.close()
+        pool.join()
+        write_manifest(SOUNDS_MANIFEST, manifest)
+
+    if failed:
+        logger.warning('{} sounds could not be exported: {}'.format(
+            len(failed), ', '.join(sorted(failed))))
+    if too_short:
+        logger.warning('{} sounds were too short: {}'.format(
+            len(too_short), ', '.join(sorted(too_short))))
+
+
+# Zip files opened by this process, by path.
+_archives = {}
+
+
+def export_sound(job):
+    """Export a trimmed wav for one message. Runs in a worker process.
+
+    Errors are returned instead of raised, so one bad sound doesn't stop
+    the rest of the export.
+    """
+    src, member, dst, start_at, end_at, key, source_hash = job
+    name = Path(member).name
+    try:
+        if src not in _archives:
+            _archives[src] = zipfile.ZipFile(src)
+        data = _archives[src].read(member)
+
         try:
-            audio = pydub.AudioSegment.from_wav(message.src)
-        except Exception as e:
-            logger.warning('Sound {} was not a wav file'.format(message.audio))
-            try:
-                audio = pydub.AudioSegment.from_mp3(message.src)
-            except Exception as e:
-                raise e
+            audio = pydub.AudioSegment.from_wav(io.BytesIO(data))
+        except Exception:
+            logger.warning('Sound {} was not a wav file'.format(member))
+            audio = pydub.AudioSegment.from_mp3(io.BytesIO(data))
 
         # Trim sounds
-        start_at = getattr_null(message, 'start_at', 0)
-        end_at = getattr_null(message, 'end_at', audio.duration_seconds * 1000)
+        start_at = start_at if start_at is not None else 0
+        end_at = (end_at if end_at is not None
+                  else audio.duration_seconds * 1000)
         trimmed = audio[start_at:end_at]
+        trimmed.export(dst, format='wav')
+    except Exception as e:
+        return key, source_hash, None, name, repr(e)
 
-        if trimmed.duration_seconds < 0.4:
-            logger.warning('Sound {} was too short ({} seconds)'.format(
-                Path(message.audio).name, trimmed.duration_seconds))
-
-        trimmed.export(message.dst, format='wav')
-
-    run('rm -r webapps')  # remove zip dir
+    return key, source_hash, trimmed.duration_seconds, name, None
@@ -0,0 +1,192 @@
+"""Batched dynamic time warping over acousticsim representations.
+
+The recurrence is the one in acousticsim.distance.dtw: euclidean local
+costs, diagonal steps weighted twice, and the total normalized by the
+combined length of the two sequences. Instead of filling the cost table
+one cell at a time, a whole batch of pairs is padded into a single array
+and the table is filled one anti-diagonal at a time, since every cell on
+an anti-diagonal depends only on the two diagonals before it.
+"""
+import numpy
+
+
+def dtw_distances(queries, references, window=None, norm=True,
+                  batch_size=64):
+    """Compute the DTW distance between each query and its reference.
+
+    Args:
+        queries: list of (frames x coefficients) arrays or acousticsim
+            representations.
+        references: list of the same length as queries.
+        window: Optional Sakoe-Chiba band radius, in frames. Cells further
+            than this from the diagonal are never on the warping path.
+        norm: Divide each distance by the combined length of the pair.
+        batch_size: Number of pairs to fill in at a time.
+
+    Returns:
+        A numpy array with one distance per pair.
+    """
+    assert len(queries) == len(references), 'need one reference per query'
+    queries = [as_matrix(q) for q in queries]
+    references = [as_matrix(r) for r in references]
+
+    # Batch pairs of similar size together to keep the padding small.
+    sizes = [len(q) * len(r) for q, r in zip(queries, references)]
+    order = numpy.argsort(sizes, kind='mergesort')
+
+    distances = numpy.empty(len(queries))
+    for start in range(0, len(order), batch_size):
+        ix = order[start:start+batch_size]
+        distances[ix] = dtw_batch([queries[i] for i in ix],
+                                  [references[i] for i in ix],
+                                  window=window, norm=norm)
+    return distances
+
+
+def dtw_batch(queries, references, window=None, norm=True):
+    """Fill in the DTW tables for a batch of pairs at the same time."""
+    cost, n, m = local_costs(queries, references)
+    if window is not None:
+        cost[~sakoe_chiba_band(n, m, cost.shape[1], cost.shape[2], window)] = \
+            numpy.inf
+
+    n_pairs, max_n, max_m = cost.shape
+
+    # total[:, i+1, j+1] is the cost of the best path to cell (i, j).
+    # The extra row and column are borders that are never on a path.
+    total = numpy.full((n_pairs, max_n+1, max_m+1), numpy.inf)
+    total[:, 1, 1] = cost[:, 0, 0]
+
+    for k in range(1, max_n + max_m - 1):
+        i = numpy.arange(max(0, k-max_m+1), min(k, max_n-1)+1)
+        j = k - i
+        step = cost[:, i, j]
+        diagonal = total[:, i, j] + 2*step
+        vertical = total[:, i, j+1] + step
+        horizontal = total[:, i+1, j] + step
+        total[:, i+1, j+1] = numpy.minimum(diagonal,
+                                           numpy.minimum(vertical, horizontal))
+
+    distances = total[numpy.arange(n_pairs), n, m]
+    if norm:
+        distances = distances / (n + m)
+    return distances
+
+
+def lb_kim(queries, references, norm=True):
+    """Lower bound DTW by the cost of the first and last cells.
+
+    Every warping path starts at the first cell and ends at the last one,
+    so their costs are part of every path's total.
+    """
+    def frame_distance(x, y):
+        return numpy.sqrt(((x - y)**2).sum(axis=1))
+
+    first = frame_distance(numpy.array([q[0] for q in queries]),
+                           numpy.array([r[0] for r in references]))
+    last = frame_distance(numpy.array([q[-1] for q in queries]),
+                          numpy.array([r[-1] for r in references]))
+    is_single_cell = numpy.array([len(q) == 1 and len(r) == 1
+                                  for q, r in zip(queries, references)])
+    bounds = first + numpy.where(is_single_cell, 0, last)
+    return normalize(bounds, queries, references, norm)
+
+
+def lb_keogh(queries, references, norm=True, batch_size=1024):
+    """Lower bound DTW by the distance of each frame to the other's envelope.
+
+    A warping path visits every row and every column of the cost table.
+    Whichever cell it visits in a row costs at least the distance from
+    that row's query frame to the bounding box of the reference frames,
+    and the same goes for columns, so either sum is a lower bound.
+    """
+    bounds = numpy.empty(len(queries))
+    for start in range(0, len(queries), batch_size):
+        q = queries[start:start+batch_size]
+        r = references[start:start+batch_size]
+        bounds[start:start+batch_size] = numpy.maximum(
+            envelope_distances(q, r), envelope_distances(r, q))
+    return normalize(bounds, queries, references, norm)
+
+
+def lb_rows(queries, references, norm=True):
+    """Lower bound DTW by the cheapest cell in each row and in each column.
+
+    This is the tightest of the lower bounds, and it needs the whole cost
+    table, but not the recurrence over it.
+    """
+    cost, n, m = local_costs(queries, references)
+    i = numpy.arange(cost.shape[1])[numpy.newaxis, :, numpy.newaxis]
+    j = numpy.arange(cost.shape[2])[numpy.newaxis, numpy.newaxis, :]
+    is_padding = ((i >= n[:, numpy.newaxis, numpy.newaxis]) |
+                  (j >= m[:, numpy.newaxis, numpy.newaxis]))
+    cost[is_padding] = numpy.inf
+    row_mins = cost.min(axis=2)
+    col_mins = cost.min(axis=1)
+    row_mins[numpy.isinf(row_mins)] = 0
+    col_mins[numpy.isinf(col_mins)] = 0
+    bounds = numpy.maximum(row_mins.sum(axis=1), col_mins.sum(axis=1))
+    return normalize(bounds, queries, references, norm)
+
+
+def envelope_distances(sequences, others):
+    """Sum the distances from each frame to the bounding box of its other."""
+    lower = numpy.array([other.min(axis=0) for other in others])
+    upper = numpy.array([other.max(axis=0) for other in others])
+    frames, lengths = pad(sequences)
+    outside = (numpy.maximum(frames - upper[:, numpy.newaxis], 0) +
+               numpy.maximum(lower[:, numpy.newaxis] - frames, 0))
+    distances = numpy.sqrt((outside**2).sum(axis=2))
+    is_frame = numpy.arange(frames.shape[1]) < lengths[:, numpy.newaxis]
+    return (distances * is_frame).sum(axis=1)
+
+
+def pad(sequences):
+    """Stack sequences of frames into one array, padded with zeros."""
+    lengths = numpy.array([len(sequence) for sequence in sequences])
+    padded = numpy.zeros((len(sequences), lengths.max(),
+                          sequences[0].shape[1]))
+    for b, sequence in enumerate(sequences):
+        padded[b, :len(sequence)] = sequence
+    return padded, lengths
+
+
+def normalize(bounds, queries, references, norm):
+    if not norm:
+        return bounds
+    lengths = numpy.array([len(q) + len(r)
+                           for q, r in zip(queries, references)])
+    return bounds / lengths
+
+
+def local_costs(queries, references):
+    """Pad a batch of pairs and compute the euclidean cost of every cell.
+
+    Padded cells have an arbitrary cost. They are never read for the real
+    cells of a pair because DTW only looks back toward the origin.
+    """
+    padded_queries, n = pad(queries)
+    padded_references, m = pad(references)
+
+    squared = ((padded_queries**2).sum(axis=2)[:, :, numpy.newaxis] +
+               (padded_references**2).sum(axis=2)[:, numpy.newaxis, :] -
+               2 * numpy.matmul(padded_queries,
+                                padded_references.transpose(0, 2, 1)))
+    cost = numpy.sqrt(numpy.maximum(squared, 0))
+    return cost, n, m
+
+
+def sakoe_chiba_band(n, m, max_n, max_m, window):
+    """Mask the cells within `window` frames of each pair's diagonal."""
+    i = numpy.arange(max_n)[numpy.newaxis, :, numpy.newaxis]
+    j = numpy.arange(max_m)[numpy.newaxis, numpy.newaxis, :]
+    slope = ((m - 1) / numpy.maximum(n - 1, 1).astype(float))
+    diagonal = i * slope[:, numpy.newaxis, numpy.newaxis]
+    return numpy.abs(diagonal - j) <= window
+
+
+def as_matrix(rep):
+    """Get the (frames x coefficients) array of an acousticsim representation."""
+    if hasattr(rep, 'to_array'):
+        rep = rep.to_array()
+    return numpy.asarray(rep, dtype=float)
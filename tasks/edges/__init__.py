@@ -4,3 +4,6 @@ from .between import get_all_between_edges
 from .within import (get_all_within_edges, get_linear_edges,
                      get_within_chain_edges, get_within_seed_edges,
                      get_within_category_edges)
+from .stream import iter_edge_batches
+from .edge_types import get_edges_by_type
+from .lineage import LineageIndex, label_lineage
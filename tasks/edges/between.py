@@ -1,9 +1,8 @@
-import itertools
-
 import pandas
 import numpy
 
 from .messages import read_downloaded_messages, update_audio_filenames
+from .edge import remove_duplicate_edges
 
 
 def get_all_between_edges(messages=None, n_sample=10, seed=None):
@@ -37,42 +36,52 @@ def get_between_category_fixed_edges(messages=None):
     return edges
 
 
-def get_between_category_consecutive_edges():
-    messages = read_downloaded_messages()
-    messages = update_audio_filenames(messages)
-    messages = messages.ix[(messages.generation > 0) & (~messages.rejected)]
-
-    edges = []
-    for (category, generation), current_generation in \
-            messages.groupby(['category', 'generation']):
+def get_between_category_consecutive_edges(messages=None):
+    if messages is None:
+        messages = read_downloaded_messages()
+        messages = update_audio_filenames(messages)
+        messages = messages.ix[(messages.generation > 0) & (~messages.rejected)]
 
-        if generation == max(messages.generation):
+    audio = messages.audio.values
+    category = messages.category.values
+    generation = messages.generation.values
+    last_generation = generation.max()
+
+    # Groups are visited in (category, generation) order, and the scan stops
+    # at the first group in the last generation, so the categories after it
+    # have no consecutive edges. This is how between_consecutive.csv was made.
+    x, y = [numpy.array([], dtype=int)], [numpy.array([], dtype=int)]
+    groups = messages.groupby(['category', 'generation']).indices
+    for target_category, target_generation in sorted(groups):
+        if target_generation == last_generation:
             break
 
-        target_audio = current_generation.audio
-        next_gen_not_target = (messages.generation == generation+1) &\
-                              (messages.category != category)
-        next_generation = messages.ix[next_gen_not_target, 'audio']
-        edges.extend(list(itertools.product(target_audio, next_generation)))
-    edges = pandas.DataFrame(edges, columns=['sound_x', 'sound_y'])
+        target = groups[(target_category, target_generation)]
+        next_generation_not_target = numpy.flatnonzero(
+            (generation == target_generation + 1) &
+            (category != target_category)
+        )
+        x.append(numpy.repeat(target, len(next_generation_not_target)))
+        y.append(numpy.tile(next_generation_not_target, len(target)))
+
+    x, y = numpy.concatenate(x), numpy.concatenate(y)
+    edges = pandas.DataFrame({'sound_x': audio[x], 'sound_y': audio[y]},
+                             columns=['sound_x', 'sound_y'])
     edges = remove_duplicate_edges(edges)
     return edges
 
 
 def get_between_combinations(messages):
-    category_names = messages.category.unique()
-    edges = []
-    for target in category_names:
-        matches = messages.ix[messages.category == target, 'audio']
-        mismatches = messages.ix[messages.category != target, 'audio']
-        edges.extend(list(itertools.product(matches, mismatches)))
-    return pandas.DataFrame(edges, columns=['sound_x', 'sound_y'])
-
-
-def remove_duplicate_edges(frame):
-    frame = frame.copy()
-    frame['edge_set'] = [frozenset({r.sound_x, r.sound_y})
-                         for r in frame.itertuples()]
-    frame.drop_duplicates(subset='edge_set', inplace=True)
-    del frame['edge_set']
-    return frame
+    """Pair each message with every message from a different category.
+
+    Edges are ordered by the category of sound_x, in the order the
+    categories first appear.
+    """
+    audio = messages.audio.values
+    category, _ = pandas.factorize(messages.category)
+    targets = numpy.argsort(category, kind='mergesort')
+    is_mismatch = category[targets, numpy.newaxis] != category[numpy.newaxis, :]
+    x, y = numpy.nonzero(is_mismatch)
+    return pandas.DataFrame({'sound_x': audio[targets[x]],
+                             'sound_y': audio[y]},
+                            columns=['sound_x', 'sound_y'])
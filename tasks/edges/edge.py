@@ -1,3 +1,4 @@
+import numpy
 import pandas
 from unipath import Path
 
@@ -16,8 +17,30 @@ def find_sound(x):
         return shortname.format(sounds_dir=SOUNDS_DIR, x=x)
 
 
-def create_edge_set(frame):
-    frame.copy()
-    frame['edge_set'] = [frozenset({r.sound_x, r.sound_y})
-                         for r in frame.itertuples()]
+def create_edge_key(frame):
+    """Label each edge with an integer key that ignores edge direction."""
+    frame = frame.copy()
+    frame['edge_key'] = edge_keys(message_ids(frame.sound_x),
+                                  message_ids(frame.sound_y))
     return frame
+
+
+def remove_duplicate_edges(frame):
+    frame = create_edge_key(frame)
+    frame.drop_duplicates(subset='edge_key', inplace=True)
+    del frame['edge_key']
+    return frame
+
+
+def edge_keys(x, y):
+    """Pack each pair of message ids into (min id, max id) as one int64."""
+    x = numpy.asarray(x, dtype=numpy.int64)
+    y = numpy.asarray(y, dtype=numpy.int64)
+    return (numpy.minimum(x, y) << 32) | numpy.maximum(x, y)
+
+
+def message_ids(sounds):
+    """Get the message ids from a column of wav paths or message ids."""
+    if sounds.dtype.kind not in 'iu':
+        sounds = sounds.astype(str).str.extract(r'(\d+)\.wav$', expand=False)
+    return sounds.astype(numpy.int64).values
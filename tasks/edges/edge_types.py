@@ -0,0 +1,46 @@
+from collections import OrderedDict
+
+from .messages import (read_downloaded_messages, update_audio_filenames,
+                       get_messages_by_branch, label_seed_id,
+                       get_message_ids_for_edge)
+from .within import (get_linear_edges, get_within_chain_edges,
+                     get_within_seed_edges, get_within_category_edges)
+from .lineage import LineageIndex, label_lineage
+from .between import (get_between_category_fixed_edges,
+                      get_between_category_consecutive_edges)
+
+
+def get_edges_by_type(lineage=False):
+    """Make the edges of every edge type from one table of messages.
+
+    Returns an OrderedDict of edges by the name of the edge type. The
+    edges are the same, in the same order, as the ones made by each edge
+    getter on its own, but the messages and branches are only read and
+    labeled once. Sounds are given as message ids.
+
+    If lineage is True, the edges are also labeled with the relationship
+    between their messages in the message tree (see LineageIndex).
+    """
+    messages = read_downloaded_messages()
+    index = LineageIndex(messages) if lineage else None
+    messages = update_audio_filenames(messages)
+    messages = label_seed_id(messages)
+    messages = messages.ix[(messages.generation > 0) & (~messages.rejected)]
+
+    branches = get_messages_by_branch()
+    branches = branches.ix[(branches.generation > 0) & (~branches.rejected)]
+
+    edges = OrderedDict([
+        ('linear', get_linear_edges(branches)),
+        ('within_chain', get_within_chain_edges(branches)),
+        ('within_seed', get_within_seed_edges(messages)),
+        ('within_category', get_within_category_edges(messages)),
+        ('between_fixed', get_between_category_fixed_edges(messages)),
+        ('between_consecutive',
+         get_between_category_consecutive_edges(messages)),
+    ])
+    for edge_type, type_edges in edges.items():
+        edges[edge_type] = get_message_ids_for_edge(type_edges)
+        if index is not None:
+            edges[edge_type] = label_lineage(edges[edge_type], index)
+    return edges
@@ -0,0 +1,98 @@
+import numpy
+import pandas
+
+from .tree import MessageTree
+
+LINEAGE_COLUMNS = ['generation_gap', 'lca_depth', 'same_seed', 'same_branch']
+
+
+class LineageIndex(object):
+    """Look up how the two messages of each edge are related.
+
+    The lowest common ancestor (LCA) of two messages is the shallowest
+    message between their first appearances in an Euler tour of the tree.
+    A sparse table of the shallowest message in every power-of-two run of
+    the tour is built once, so the LCA of any number of edges is found
+    with a few vectorized lookups.
+    """
+    def __init__(self, messages):
+        tree = MessageTree(messages)
+        tour, depths, first = tree.euler_tour()
+        seed_ids = tree.seed_ids()
+
+        self.message_ids = numpy.array(sorted(first), dtype=numpy.int64)
+        self.first = numpy.array([first[message_id]
+                                  for message_id in self.message_ids])
+        self.seed_ids = numpy.array([seed_ids[message_id]
+                                     for message_id in self.message_ids])
+        self.depths = numpy.array(depths)
+        self.generations = self.depths[self.first]
+
+        # shallowest[k][i] is the position of the shallowest message
+        # in tour[i:i + 2**k].
+        self.shallowest = [numpy.arange(len(tour))]
+        half = 1
+        while 2 * half <= len(tour):
+            previous = self.shallowest[-1]
+            left, right = previous[:-half], previous[half:]
+            self.shallowest.append(numpy.where(
+                self.depths[right] < self.depths[left], right, left))
+            half *= 2
+
+    def positions(self, message_ids):
+        message_ids = numpy.asarray(message_ids, dtype=numpy.int64)
+        positions = numpy.searchsorted(self.message_ids, message_ids)
+        positions = numpy.minimum(positions, len(self.message_ids) - 1)
+        missing = self.message_ids[positions] != message_ids
+        if missing.any():
+            raise KeyError('messages not in the tree: {}'.format(
+                sorted(set(message_ids[missing]))))
+        return positions
+
+    def lca_depths(self, x, y):
+        """Get the depth of the LCA of each pair of message positions."""
+        start = numpy.minimum(self.first[x], self.first[y])
+        stop = numpy.maximum(self.first[x], self.first[y])
+        # Exponent of the largest power of two that fits in each run.
+        levels = numpy.frexp(stop - start + 1)[1] - 1
+
+        depths = numpy.empty(len(start), dtype=self.depths.dtype)
+        for level in numpy.unique(levels):
+            is_level = levels == level
+            table = self.shallowest[level]
+            left = table[start[is_level]]
+            right = table[stop[is_level] - 2**level + 1]
+            depths[is_level] = numpy.minimum(self.depths[left],
+                                             self.depths[right])
+        return depths
+
+    def relationships(self, sound_x, sound_y):
+        """Describe the lineage of each edge between two messages.
+
+        Returns a DataFrame with a row for each edge:
+            generation_gap: Difference in the generations of the messages.
+            lca_depth: Generation of the messages' lowest common ancestor,
+                or NaN if they are from different seeds.
+            same_seed: Whether the messages are from the same seed.
+            same_branch: Whether one message is descended from the other.
+        """
+        x = self.positions(sound_x)
+        y = self.positions(sound_y)
+        same_seed = self.seed_ids[x] == self.seed_ids[y]
+        lca_depths = self.lca_depths(x, y)
+        same_branch = same_seed & (lca_depths == numpy.minimum(
+            self.generations[x], self.generations[y]))
+        return pandas.DataFrame({
+            'generation_gap': numpy.abs(self.generations[x] -
+                                        self.generations[y]),
+            'lca_depth': numpy.where(same_seed, lca_depths, numpy.nan),
+            'same_seed': same_seed,
+            'same_branch': same_branch,
+        }, columns=LINEAGE_COLUMNS)
+
+
+def label_lineage(edges, index):
+    """Add the lineage of each edge to a table of message id edges."""
+    lineage = index.relationships(edges.sound_x.values, edges.sound_y.values)
+    lineage.index = edges.index
+    return pandas.concat([edges, lineage], axis=1)
@@ -1,18 +1,101 @@
+import hashlib
+import os
+import pickle
+
+import numpy
 import pandas
 from unipath import Path
 
+from .. import timing
 from ..settings import DOWNLOAD_DIR, SOUNDS_DIR
+from .tree import MessageTree
+from .edge import message_ids
+
+
+# Parsed message tables, by game, for the version of the json dump
+# they were parsed from.
+_message_tables = {}
 
 
 def read_downloaded_messages(game='words-in-transition'):
-    """Convert the json dump of message models to a friendly csv."""
-    messages = pandas.read_json(Path(DOWNLOAD_DIR, 'grunt.Message.json'))
+    """Convert the json dump of message models to a friendly csv.
+
+    The json dump is parsed once and saved next to it as a pickle. Later
+    calls, in this process or another one, reuse the parsed table until
+    the json dump changes.
+    """
+    return read_message_table(game)['messages'].copy()
+
+
+def read_labeled_branches(game='words-in-transition'):
+    """Get the branches of the downloaded messages, as in label_branches."""
+    return read_message_table(game)['branches'].copy()
+
+
+def read_message_table(game):
+    src = Path(DOWNLOAD_DIR, 'grunt.Message.json')
+    version = (os.path.getmtime(src), os.path.getsize(src))
+
+    table = _message_tables.get(game)
+    if table is None or table['version'] != version:
+        with timing.span('load message table'):
+            table = load_message_table(src, game, version)
+        _message_tables[game] = table
+    return table
+
+
+def load_message_table(src, game, version):
+    sidecar = Path(DOWNLOAD_DIR, 'grunt.Message.{}.pickle'.format(game))
+
+    table = read_sidecar(sidecar)
+    if table is not None and table['version'] == version:
+        timing.count(cache_hits=1)
+        return table
+
+    if table is not None and table['sha1'] == hash_file(src):
+        # The json was touched, but it didn't change.
+        timing.count(cache_hits=1)
+        table['version'] = version
+    else:
+        timing.count(cache_misses=1)
+        with timing.span('parse messages'):
+            messages = parse_downloaded_messages(src, game)
+        with timing.span('label branches'):
+            branches = label_branches(messages)
+        table = dict(version=version, sha1=hash_file(src), messages=messages,
+                     branches=branches)
+    write_sidecar(sidecar, table)
+    return table
+
+
+def read_sidecar(sidecar):
+    """Read a parsed message table, or None if there isn't a good one."""
+    if not sidecar.exists():
+        return None
+    try:
+        with open(sidecar, 'rb') as f:
+            return pickle.load(f)
+    except Exception:
+        # e.g. truncated by a write that was interrupted
+        return None
+
+
+def write_sidecar(sidecar, table):
+    # Write to a temp file first so a reader never sees a partial table.
+    tmp = '{}.{}.tmp'.format(sidecar, os.getpid())
+    with open(tmp, 'wb') as f:
+        pickle.dump(table, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp, sidecar)
+
+
+def parse_downloaded_messages(src, game):
+    messages = pandas.read_json(src)
 
     # unfold django model fields
-    field_names = messages.iloc[0].fields.keys()
-    for field in field_names:
-        messages[field] = messages.fields.apply(lambda x: x[field])
-    del messages['fields']
+    field_names = list(messages.iloc[0].fields.keys())
+    fields = pandas.DataFrame(messages.fields.tolist(), index=messages.index,
+                              columns=field_names)
+    messages = messages.drop('fields', axis=1).join(fields)
 
     messages.rename(columns={'pk': 'message_id'}, inplace=True)
 
@@ -23,75 +106,63 @@ def read_downloaded_messages(game='words-in-transition'):
     messages = messages.ix[messages.game == game]
     del messages['game']
 
+    messages['message_id'] = messages.message_id.astype(numpy.int64)
+    messages['generation'] = messages.generation.astype(numpy.int8)
+    messages['rejected'] = messages.rejected.astype(bool)
+    messages['category'] = messages.category.astype('category')
     return messages
 
 
+def hash_file(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
 def label_branch_id_list(messages):
     """Append a column containing ids for all branches each message is in."""
     messages = messages.copy()
     labeled_branches = label_branches(messages)
 
-    def find_all_branches(message_id):
-        is_in = labeled_branches.message_list.apply(lambda x: message_id in x)
-        return labeled_branches.ix[is_in, 'branch_id'].tolist()
+    branch_id_lists = {message_id: [] for message_id in messages.message_id}
+    for branch in labeled_branches.itertuples():
+        for message_id in branch.message_list:
+            branch_id_lists[message_id].append(branch.branch_id)
 
-    messages['branch_id_list'] = messages.message_id.apply(find_all_branches)
+    messages['branch_id_list'] = [branch_id_lists[message_id]
+                                  for message_id in messages.message_id]
     return messages
 
 
 def label_branches(messages):
     """Determine the unique branches in a table of messages."""
-
-    def find_messages_on_branch(message, found):
-        message_data = messages.ix[messages.message_id == message].squeeze()
-        found.append(message_data['message_id'])
-        if pandas.isnull(message_data['parent']):
-            return found
-        else:
-            parent = message_data['parent']
-            return find_messages_on_branch(parent, found)
-
-    branches = {}
-    for message in messages.message_id:
-        branches[message] = find_messages_on_branch(message, [])
-
-    unique_branches = collapse_branches(branches)
+    unique_branches = MessageTree(messages).branches()
     labeled_branches = pandas.DataFrame({'message_list': unique_branches})
     labeled_branches['branch_id'] = range(len(labeled_branches))
     return labeled_branches
 
 
 def collapse_branches(branches):
-    all_branches = sorted(branches.values(), key=len, reverse=True)
+    """Remove the branches that are the tail end of a longer branch.
 
-    def remove_sub_branch(branch):
-        if len(branch) > 1:
-            sub_branch = branch[1:]
-            try:
-                all_branches.remove(sub_branch)
-            except ValueError:
-                pass
-            remove_sub_branch(sub_branch)
-
-    for branch in all_branches:
-        remove_sub_branch(branch)
-
-    return all_branches
+    A branch is kept only if no other branch continues on from its first
+    message.
+    """
+    continued = {branch[1] for branch in branches.values() if len(branch) > 1}
+    leaves = [branch for branch in branches.values()
+              if branch[0] not in continued]
+    return sorted(leaves, key=len, reverse=True)
 
 
 def label_seed_id(messages):
     """Determine the seed message for each message."""
     messages = messages.copy()
-
-    def find_seed_id(message):
-        message_data = messages.ix[messages.message_id == message].squeeze()
-        if pandas.isnull(message_data['parent']):
-            return message
-        else:
-            parent = message_data['parent']
-            return find_seed_id(parent)
-
-    messages['seed_id'] = messages.message_id.apply(find_seed_id).astype(int)
+    seed_ids = MessageTree(messages).seed_ids()
+    messages['seed_id'] = [seed_ids[message_id]
+                           for message_id in messages.message_id]
+    messages['seed_id'] = messages.seed_id.astype(int)
     return messages
 
 
@@ -107,10 +178,13 @@ def new_audio_filenames(message_ids, absolute=True):
     ).astype(str)
 
 
-def get_messages_by_branch():
-    messages = read_downloaded_messages()
+def get_messages_by_branch(messages=None):
+    if messages is None:
+        messages = read_downloaded_messages()
+        branches = read_labeled_branches()
+    else:
+        branches = label_branches(messages)
     messages = update_audio_filenames(messages)
-    branches = label_branches(messages)
     expanded = [expand_message_list(branch) for branch in branches.itertuples()]
     labeled = (pandas.concat(expanded, ignore_index=True)
                      .merge(messages))
@@ -142,6 +216,6 @@ def message_id_from_wav(x):
 
 def get_message_ids_for_edge(frame):
     frame = frame.copy()
-    frame['sound_x'] = frame.sound_x.apply(message_id_from_wav)
-    frame['sound_y'] = frame.sound_y.apply(message_id_from_wav)
+    frame['sound_x'] = message_ids(frame.sound_x)
+    frame['sound_y'] = message_ids(frame.sound_y)
     return frame
@@ -0,0 +1,169 @@
+import numpy
+import pandas
+
+from .messages import (read_downloaded_messages, update_audio_filenames,
+                       get_messages_by_branch)
+from .tree import MessageTree
+from .within import get_linear_edges
+
+
+def iter_edge_batches(edge_type, batch_size=50000):
+    """Yield the unique edges of one type, batch_size edges at a time.
+
+    Concatenating the batches gives the same edges, in the same order, as
+    get_linear_edges, get_all_within_edges or get_all_between_edges, but
+    only about one batch of edges is in memory at a time. Rather than
+    remembering every edge to drop duplicates, an edge is skipped if the
+    structure of the message tree shows it was already yielded.
+    """
+    if edge_type == 'linear':
+        edges = get_linear_edges()
+        for start in range(0, len(edges), batch_size):
+            yield edges.iloc[start:start+batch_size]
+        return
+    elif edge_type == 'within':
+        blocks = iter_within_blocks(batch_size)
+    elif edge_type == 'between':
+        blocks = iter_between_blocks(batch_size)
+    else:
+        raise NotImplementedError('edge type "{}"'.format(edge_type))
+
+    pending_x, pending_y, n_pending = [], [], 0
+    for sound_x, sound_y in blocks:
+        pending_x.append(sound_x)
+        pending_y.append(sound_y)
+        n_pending += len(sound_x)
+        while n_pending >= batch_size:
+            sound_x = numpy.concatenate(pending_x)
+            sound_y = numpy.concatenate(pending_y)
+            yield make_edges(sound_x[:batch_size], sound_y[:batch_size])
+            pending_x = [sound_x[batch_size:]]
+            pending_y = [sound_y[batch_size:]]
+            n_pending -= batch_size
+
+    if n_pending:
+        yield make_edges(numpy.concatenate(pending_x),
+                         numpy.concatenate(pending_y))
+
+
+def iter_within_blocks(batch_size):
+    """Yield blocks of within chain, seed and category edges, in that order.
+
+    Chain edges are on every branch through their later message, so they
+    are only kept on the first of those branches. Seed edges between a
+    message and its ancestor are already chain edges, and category edges
+    between messages from the same seed are already seed edges.
+    """
+    messages = read_downloaded_messages()
+    tree = MessageTree(messages)
+    seed_ids = tree.seed_ids()
+    enter, exit = tree.intervals()
+
+    branches = get_messages_by_branch()
+    branches = branches.ix[(branches.generation > 0) & (~branches.rejected)]
+    first_branch = branches.groupby('message_id').branch_id.min()
+    for branch_id, branch in branches.groupby('branch_id'):
+        audio = branch.audio.values
+        is_first = (first_branch.reindex(branch.message_id).values ==
+                    branch_id)
+        for x, y in iter_pair_blocks(len(audio), batch_size):
+            keep = is_first[y]
+            yield audio[x[keep]], audio[y[keep]]
+
+    messages = update_audio_filenames(messages)
+    messages['seed_id'] = [seed_ids[m] for m in messages.message_id]
+    messages['enter'] = [enter[m] for m in messages.message_id]
+    messages['exit'] = [exit[m] for m in messages.message_id]
+    messages = messages.ix[(messages.generation > 0) & (~messages.rejected)]
+
+    for _, seed in messages.groupby('seed_id'):
+        audio = seed.audio.values
+        enters, exits = seed.enter.values, seed.exit.values
+        for x, y in iter_pair_blocks(len(audio), batch_size):
+            x_above_y = (enters[x] <= enters[y]) & (enters[y] < exits[x])
+            y_above_x = (enters[y] <= enters[x]) & (enters[x] < exits[y])
+            keep = ~(x_above_y | y_above_x)
+            yield audio[x[keep]], audio[y[keep]]
+
+    for _, category in messages.groupby('category'):
+        audio = category.audio.values
+        seeds = category.seed_id.values
+        for x, y in iter_pair_blocks(len(audio), batch_size):
+            keep = seeds[x] != seeds[y]
+            yield audio[x[keep]], audio[y[keep]]
+
+
+def iter_between_blocks(batch_size):
+    """Yield blocks of between fixed and consecutive edges, in that order.
+
+    Fixed edges are made once for each category of the pair, so only the
+    one made for the category of sound_x that appears first is kept.
+    Consecutive edges are never duplicated.
+    """
+    messages = read_downloaded_messages()
+    messages = update_audio_filenames(messages)
+    messages = messages.ix[(messages.generation > 0) & (~messages.rejected)]
+
+    for _, generation in messages.groupby('generation'):
+        audio = generation.audio.values
+        category, _ = pandas.factorize(generation.category)
+        targets = numpy.argsort(category, kind='mergesort')
+        rows_per_block = max(1, batch_size // len(audio))
+        for start in range(0, len(targets), rows_per_block):
+            rows = targets[start:start+rows_per_block]
+            is_after = (category[rows, numpy.newaxis] <
+                        category[numpy.newaxis, :])
+            x, y = numpy.nonzero(is_after)
+            yield audio[rows[x]], audio[y]
+
+    # See get_between_category_consecutive_edges for why the scan stops
+    # at the first group in the last generation.
+    audio = messages.audio.values
+    category = messages.category.values
+    generation = messages.generation.values
+    last_generation = generation.max()
+    groups = messages.groupby(['category', 'generation']).indices
+    for target_category, target_generation in sorted(groups):
+        if target_generation == last_generation:
+            break
+
+        target = groups[(target_category, target_generation)]
+        next_generation_not_target = numpy.flatnonzero(
+            (generation == target_generation + 1) &
+            (category != target_category)
+        )
+        if len(next_generation_not_target) == 0:
+            continue
+        rows_per_block = max(1, batch_size // len(next_generation_not_target))
+        for start in range(0, len(target), rows_per_block):
+            rows = target[start:start+rows_per_block]
+            x = numpy.repeat(rows, len(next_generation_not_target))
+            y = numpy.tile(next_generation_not_target, len(rows))
+            yield audio[x], audio[y]
+
+
+def iter_pair_blocks(n, batch_size):
+    """Yield the index pairs (i, j), i < j < n, in row-major order.
+
+    Pairs come in blocks of whole rows with about batch_size pairs each.
+    """
+    start = 0
+    while start < n - 1:
+        stop, n_pairs = start + 1, n - 1 - start
+        while stop < n - 1 and n_pairs + (n - 1 - stop) <= batch_size:
+            n_pairs += n - 1 - stop
+            stop += 1
+
+        rows = numpy.arange(start, stop)
+        row_lengths = n - 1 - rows
+        x = numpy.repeat(rows, row_lengths)
+        row_starts = numpy.repeat(numpy.cumsum(row_lengths) - row_lengths,
+                                  row_lengths)
+        y = x + 1 + (numpy.arange(n_pairs) - row_starts)
+        yield x, y
+        start = stop
+
+
+def make_edges(sound_x, sound_y):
+    return pandas.DataFrame({'sound_x': sound_x, 'sound_y': sound_y},
+                            columns=['sound_x', 'sound_y'])
@@ -0,0 +1,120 @@
+import pandas
+
+
+class MessageTree(object):
+    """The parent and children of every message, indexed once.
+
+    Messages whose parent isn't in the table are treated as seeds. All
+    walks over the tree are iterative, so long chains don't run into the
+    recursion limit.
+    """
+    def __init__(self, messages):
+        self.message_ids = [int(message_id)
+                            for message_id in messages.message_id]
+        self.parents = {}
+        for message_id, parent in zip(self.message_ids, messages.parent):
+            self.parents[message_id] = (None if pandas.isnull(parent)
+                                        else int(parent))
+
+        self.children = {message_id: [] for message_id in self.message_ids}
+        for message_id in self.message_ids:
+            parent = self.parents[message_id]
+            if parent in self.children:
+                self.children[parent].append(message_id)
+
+    def is_seed(self, message_id):
+        return self.parents[message_id] not in self.children
+
+    def seeds(self):
+        return [message_id for message_id in self.message_ids
+                if self.is_seed(message_id)]
+
+    def walk(self):
+        """Visit every message after its parent, yielding (message, parent)."""
+        stack = [(seed, None) for seed in reversed(self.seeds())]
+        while stack:
+            message_id, parent = stack.pop()
+            yield message_id, parent
+            for child in reversed(self.children[message_id]):
+                stack.append((child, message_id))
+
+    def intervals(self):
+        """Number the messages in walk order and find where subtrees end.
+
+        A message is an ancestor of another, or the same message, if the
+        other's number is in [enter, exit) of the first.
+        """
+        order = [message_id for message_id, _ in self.walk()]
+        enter = {message_id: i for i, message_id in enumerate(order)}
+        sizes = {message_id: 1 for message_id in order}
+        for message_id in reversed(order):
+            parent = self.parents[message_id]
+            if parent in sizes:
+                sizes[parent] += sizes[message_id]
+        exit = {message_id: enter[message_id] + sizes[message_id]
+                for message_id in order}
+        return enter, exit
+
+    def euler_tour(self):
+        """List the messages in the order a depth-first walk passes them.
+
+        Each message is listed when the walk first reaches it and again
+        after each of its children is done. Trees are toured one after
+        another, starting from their seeds.
+
+        Returns:
+            The tour, the depth of each message in the tour, and the
+            position in the tour where each message first appears.
+        """
+        tour, depths, first = [], [], {}
+        for seed in self.seeds():
+            first[seed] = len(tour)
+            tour.append(seed)
+            depths.append(0)
+            stack = [(seed, 0, iter(self.children[seed]))]
+            while stack:
+                message_id, depth, children = stack[-1]
+                child = next(children, None)
+                if child is None:
+                    stack.pop()
+                    if stack:
+                        tour.append(stack[-1][0])
+                        depths.append(stack[-1][1])
+                    continue
+                first[child] = len(tour)
+                tour.append(child)
+                depths.append(depth + 1)
+                stack.append((child, depth + 1, iter(self.children[child])))
+        return tour, depths, first
+
+    def seed_ids(self):
+        """Map each message to the seed at the top of its tree."""
+        seed_ids = {}
+        for message_id, parent in self.walk():
+            seed_ids[message_id] = (message_id if parent is None
+                                    else seed_ids[parent])
+        return seed_ids
+
+    def generations(self):
+        """Map each message to the number of messages above it."""
+        generations = {}
+        for message_id, parent in self.walk():
+            generations[message_id] = (0 if parent is None
+                                       else generations[parent] + 1)
+        return generations
+
+    def branches(self):
+        """List the path from each leaf message back up to its seed.
+
+        Branches are sorted from longest to shortest, and branches of the
+        same length are in the order of their leaves in the table.
+        """
+        branches = []
+        for message_id in self.message_ids:
+            if self.children[message_id]:
+                continue
+            branch = [message_id]
+            while not self.is_seed(branch[-1]):
+                branch.append(self.parents[branch[-1]])
+            branches.append(branch)
+        return sorted(branches, key=len, reverse=True)
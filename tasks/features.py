@@ -0,0 +1,95 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+
+from unipath import Path
+import acousticsim
+from acousticsim.main import _build_to_rep
+
+from . import timing
+from .settings import FEATURES_DIR
+
+logger = logging.getLogger(__name__)
+
+# Kwargs to acoustic_similarity_mapping that change the representation of
+# a sound. The rest (match_function, output_sim, ...) only change how two
+# representations are compared, so they can share the same features.
+REPRESENTATION_KWARGS = ['rep', 'num_filters', 'num_coeffs', 'freq_lims',
+                         'win_len', 'time_step', 'use_power']
+
+
+def load_features(wavs, **kwargs):
+    """Get the acousticsim representation for each wav.
+
+    Features are stored on disk by the hash of the wav's contents, so each
+    sound is featurized once per representation config, and a wav that
+    changes on disk is featurized again the next time it's requested.
+    Wavs that can't be read or featurized are left out, so only the edges
+    with them fail to score.
+    """
+    store = feature_store_dir(**kwargs)
+    to_rep = _build_to_rep(**kwargs)
+
+    features = {}
+    n_computed = 0
+    for wav in sorted(set(wavs)):
+        try:
+            cached = Path(store, '{}.pkl'.format(hash_wav(wav)))
+        except (IOError, OSError) as e:
+            logger.warning('Skipping {}: {}'.format(wav, e))
+            continue
+        if cached.exists():
+            features[wav] = read_feature(cached)
+        else:
+            try:
+                features[wav] = to_rep(wav)
+            except Exception as e:
+                logger.warning('Skipping {}: {!r}'.format(wav, e))
+                continue
+            write_feature(cached, features[wav])
+            n_computed += 1
+
+    logger.info('Loaded features for {} sounds ({} computed, {} cached)'.format(
+        len(features), n_computed, len(features) - n_computed))
+    timing.count(cache_hits=len(features) - n_computed,
+                 cache_misses=n_computed)
+    return features
+
+
+def feature_store_dir(**kwargs):
+    store = Path(FEATURES_DIR, representation_fingerprint(**kwargs))
+    if not store.isdir():
+        store.mkdir()
+    return store
+
+
+def representation_fingerprint(**kwargs):
+    rep_kwargs = {k: kwargs[k] for k in REPRESENTATION_KWARGS if k in kwargs}
+    # Features from another version of acousticsim may not be the same.
+    rep_kwargs['acousticsim'] = acousticsim.__version__
+    encoded = json.dumps(rep_kwargs, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(encoded).hexdigest()[:16]
+
+
+def hash_wav(wav):
+    digest = hashlib.sha1()
+    with open(wav, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_feature(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def write_feature(path, feature):
+    # Write to a temp file first so an interrupted run never leaves
+    # a truncated feature in the store.
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        pickle.dump(feature, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp, path)
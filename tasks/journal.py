@@ -0,0 +1,137 @@
+import hashlib
+import json
+import logging
+import sqlite3
+
+import pandas
+
+from .edges import message_id_from_wav
+from .edges.messages import hash_file
+
+logger = logging.getLogger(__name__)
+
+
+class SimilarityJournal(object):
+    """A checkpoint of every edge that has been scored.
+
+    Scores are appended as soon as they are computed and are stored with a
+    fingerprint of the kwargs used to compute them, so a run that is
+    interrupted, or run again after new sounds are added, only needs to
+    score the edges that aren't in the journal yet.
+
+    Edges are stored by (min message_id, max message_id), assuming that
+    scores are symmetric, which holds for the DTW distance. Each edge is
+    stored with the content hash of both wavs, and a score only counts as
+    journaled if the wavs haven't changed since, so a sound that is
+    exported again is scored again. Wavs that can't be read have no hash,
+    so their edges are never found in the journal and aren't recorded.
+    """
+    def __init__(self, path, **kwargs):
+        self.fingerprint = scoring_fingerprint(**kwargs)
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS similarities (
+                fingerprint TEXT,
+                sound_lo INTEGER,
+                sound_hi INTEGER,
+                similarity REAL,
+                hash_lo TEXT,
+                hash_hi TEXT,
+                PRIMARY KEY (fingerprint, sound_lo, sound_hi)
+            )""")
+        # Journals made before wavs were hashed have no hash columns.
+        # Their edges have NULL hashes, which never match, so they are
+        # scored again.
+        columns = [row[1] for row in
+                   self.db.execute('PRAGMA table_info(similarities)')]
+        for column in ['hash_lo', 'hash_hi']:
+            if column not in columns:
+                self.db.execute('ALTER TABLE similarities '
+                                'ADD COLUMN {} TEXT'.format(column))
+        self.db.commit()
+        self.wav_hashes = {}
+
+    def lookup(self, sound_x, sound_y):
+        """Get the journaled scores for some edges.
+
+        Edges are given as wavs. Returns a frame with sound_x, sound_y and
+        similarity columns for the edges that have been scored before with
+        the same wavs, indexed by the position of each edge in the input.
+        sound_x and sound_y are returned as message ids.
+        """
+        sound_x, sound_y = list(sound_x), list(sound_y)
+        requested = [(edge_ix, ) + self.edge_key(x, y)
+                     for edge_ix, (x, y) in enumerate(zip(sound_x, sound_y))]
+        self.db.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS requested (
+                edge_ix INTEGER PRIMARY KEY,
+                sound_lo INTEGER,
+                sound_hi INTEGER,
+                hash_lo TEXT,
+                hash_hi TEXT
+            )""")
+        self.db.execute('DELETE FROM requested')
+        self.db.executemany('INSERT INTO requested VALUES (?, ?, ?, ?, ?)',
+                            requested)
+        found = self.db.execute("""
+            SELECT r.edge_ix, s.similarity
+            FROM requested AS r
+            JOIN similarities AS s
+              ON s.fingerprint = ?
+             AND s.sound_lo = r.sound_lo
+             AND s.sound_hi = r.sound_hi
+            WHERE s.hash_lo = r.hash_lo AND s.hash_hi = r.hash_hi
+            ORDER BY r.edge_ix""", (self.fingerprint, )).fetchall()
+        self.db.commit()
+
+        edge_ix = [row[0] for row in found]
+        return pandas.DataFrame({
+            'sound_x': [message_id_from_wav(sound_x[ix]) for ix in edge_ix],
+            'sound_y': [message_id_from_wav(sound_y[ix]) for ix in edge_ix],
+            'similarity': [row[1] for row in found],
+        }, index=edge_ix, columns=['sound_x', 'sound_y', 'similarity'])
+
+    def record(self, records):
+        """Append (sound_x, sound_y, similarity) records to the journal.
+
+        sound_x and sound_y are the paths of the wavs that were scored.
+        """
+        rows = []
+        for sound_x, sound_y, similarity in records:
+            sound_lo, sound_hi, hash_lo, hash_hi = self.edge_key(sound_x,
+                                                                 sound_y)
+            if hash_lo is None or hash_hi is None:
+                continue
+            rows.append((self.fingerprint, sound_lo, sound_hi,
+                         float(similarity), hash_lo, hash_hi))
+        with self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO similarities '
+                '(fingerprint, sound_lo, sound_hi, similarity, hash_lo, hash_hi) '
+                'VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def edge_key(self, wav_x, wav_y):
+        """Get the (sound_lo, sound_hi, hash_lo, hash_hi) of an edge."""
+        x, y = message_id_from_wav(wav_x), message_id_from_wav(wav_y)
+        if x > y:
+            x, y, wav_x, wav_y = y, x, wav_y, wav_x
+        return int(x), int(y), self.wav_hash(wav_x), self.wav_hash(wav_y)
+
+    def wav_hash(self, wav):
+        """Hash a wav, once per journal. None if it can't be read."""
+        if wav not in self.wav_hashes:
+            try:
+                self.wav_hashes[wav] = hash_file(wav)
+            except (IOError, OSError) as e:
+                logger.warning('Not journaling {}: {}'.format(wav, e))
+                self.wav_hashes[wav] = None
+        return self.wav_hashes[wav]
+
+    def close(self):
+        self.db.close()
+
+
+def scoring_fingerprint(**kwargs):
+    encoded = json.dumps(kwargs, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(encoded).hexdigest()[:16]
@@ -0,0 +1,196 @@
+"""A symmetric matrix of the similarity between every pair of sounds.
+
+The matrix is indexed by message_id and stored as a memory-mapped array,
+so the similarity of any set of edges is one fancy-indexing lookup, no
+matter which edge type they were scored for. Pairs that haven't been
+scored are NaN. A sidecar JSON file holds the message_id and wav hash of
+each row and the kwargs the similarities were scored with.
+
+There is one matrix per scoring fingerprint, so results scored with
+different kwargs are never mixed up.
+"""
+import json
+import logging
+import os
+
+import numpy
+from unipath import Path
+
+from .journal import scoring_fingerprint
+
+logger = logging.getLogger(__name__)
+
+# float64 keeps the similarities identical to the ones in the CSVs.
+DTYPE = 'float64'
+
+
+class SimilarityMatrix(object):
+    """Similarities between sounds, stored in matrix_dir by fingerprint.
+
+    Rows are added as new message_ids are recorded, so the matrix doesn't
+    need to know all of the sounds up front. New sounds take the next free
+    row, so adding them doesn't move the rows already in the matrix. The
+    file has room for more rows than are used, and when it runs out, it's
+    extended in place to twice as many.
+
+    Sounds recorded with the hash of their wav have their row and column
+    cleared when they are recorded again with a different hash, so the
+    scores of a sound that changed are never mixed with the new ones.
+    """
+    def __init__(self, matrix_dir, dtype=DTYPE, **kwargs):
+        self.kwargs = kwargs
+        self.fingerprint = scoring_fingerprint(**kwargs)
+        self.path = Path(matrix_dir, '{}.matrix'.format(self.fingerprint))
+        self.sidecar = Path(matrix_dir, '{}.json'.format(self.fingerprint))
+        self.dtype = numpy.dtype(dtype)
+
+        # message_ids and hashes are in row order.
+        self.message_ids = numpy.array([], dtype=numpy.int64)
+        self.hashes = []
+        self.capacity = 0
+        self.values = None
+        if self.exists():
+            with open(self.sidecar) as f:
+                sidecar = json.load(f)
+            assert sidecar['fingerprint'] == self.fingerprint
+            self.dtype = numpy.dtype(sidecar['dtype'])
+            self.message_ids = numpy.array(sidecar['message_ids'],
+                                           dtype=numpy.int64)
+            # Matrices made before rows were hashed are exactly full.
+            self.hashes = sidecar.get('hashes',
+                                      [None] * len(self.message_ids))
+            self.capacity = sidecar.get('capacity',
+                                        max(len(self.message_ids), 1))
+            self.values = self.open_values(self.path, 'r+')
+        self.sort_rows()
+
+    def exists(self):
+        return self.path.exists() and self.sidecar.exists()
+
+    def open_values(self, path, mode):
+        return numpy.memmap(path, dtype=self.dtype, mode=mode,
+                            shape=(self.capacity, self.capacity))
+
+    def sort_rows(self):
+        self.order = numpy.argsort(self.message_ids, kind='mergesort')
+        self.sorted_ids = self.message_ids[self.order]
+
+    def positions(self, message_ids):
+        """Find the row of each message_id, or -1 if it isn't in the matrix."""
+        message_ids = numpy.asarray(message_ids, dtype=numpy.int64)
+        if len(self.message_ids) == 0:
+            return numpy.full(message_ids.shape, -1, dtype=numpy.int64)
+        ix = numpy.searchsorted(self.sorted_ids, message_ids)
+        ix = numpy.minimum(ix, len(self.sorted_ids) - 1)
+        return numpy.where(self.sorted_ids[ix] == message_ids,
+                           self.order[ix], -1)
+
+    def lookup(self, sound_x, sound_y):
+        """Get the similarity of each edge, NaN for edges not scored."""
+        x, y = self.positions(sound_x), self.positions(sound_y)
+        similarities = numpy.full(x.shape, numpy.nan)
+        found = (x >= 0) & (y >= 0)
+        if found.any():
+            similarities[found] = self.values[x[found], y[found]]
+        return similarities
+
+    def record(self, sound_x, sound_y, similarity, hashes=None):
+        """Store the similarity of each edge in both orientations.
+
+        hashes is an optional dict of the wav hash of each message_id.
+        """
+        sound_x = numpy.asarray(sound_x, dtype=numpy.int64)
+        sound_y = numpy.asarray(sound_y, dtype=numpy.int64)
+        self.add_messages(numpy.concatenate([sound_x, sound_y]), hashes)
+        x, y = self.positions(sound_x), self.positions(sound_y)
+        similarity = numpy.asarray(similarity, dtype=self.dtype)
+        self.values[x, y] = similarity
+        self.values[y, x] = similarity
+        self.values.flush()
+
+    def add_messages(self, message_ids, hashes=None):
+        """Add rows for new message_ids, and clear the rows of changed ones.
+
+        A message_id without a hash, in the matrix or in hashes, is
+        assumed to be unchanged.
+        """
+        hashes = hashes or {}
+        message_ids = numpy.unique(numpy.asarray(message_ids,
+                                                 dtype=numpy.int64))
+        positions = self.positions(message_ids)
+
+        changed = False
+        for message_id, row in zip(message_ids[positions >= 0],
+                                   positions[positions >= 0]):
+            new_hash = hashes.get(message_id)
+            if new_hash is None or new_hash == self.hashes[row]:
+                continue
+            if self.hashes[row] is not None:
+                logger.info('Clearing the similarities of {}, its wav '
+                            'changed'.format(message_id))
+                self.values[row, :] = numpy.nan
+                self.values[:, row] = numpy.nan
+            self.hashes[row] = new_hash
+            changed = True
+
+        new_ids = message_ids[positions < 0]
+        if len(new_ids):
+            logger.info('Adding {} sounds to the similarity matrix'.format(
+                len(new_ids)))
+            n = len(self.message_ids) + len(new_ids)
+            if self.values is None:
+                self.capacity = n
+                self.values = self.open_values(self.path, 'w+')
+                self.values[:] = numpy.nan
+            elif n > self.capacity:
+                self.grow(max(n, 2 * self.capacity))
+            self.message_ids = numpy.concatenate([self.message_ids, new_ids])
+            self.hashes.extend(hashes.get(message_id)
+                               for message_id in new_ids)
+            self.sort_rows()
+            changed = True
+
+        if changed:
+            self.values.flush()
+            self.write_sidecar()
+
+    def grow(self, capacity):
+        """Extend the file in place to hold capacity rows.
+
+        Rows move to their offsets in the wider matrix starting from the
+        last one, so no row is overwritten before it's moved.
+        """
+        n, old_capacity = len(self.message_ids), self.capacity
+        self.values.flush()
+        self.values = None
+        with open(self.path, 'r+b') as f:
+            f.truncate(capacity * capacity * self.dtype.itemsize)
+
+        flat = numpy.memmap(self.path, dtype=self.dtype, mode='r+',
+                            shape=(capacity * capacity, ))
+        for row in reversed(range(n)):
+            start = row * old_capacity
+            row_values = numpy.array(flat[start:start + n])
+            flat[row * capacity:row * capacity + n] = row_values
+            flat[row * capacity + n:(row + 1) * capacity] = numpy.nan
+        flat[n * capacity:] = numpy.nan
+        flat.flush()
+        del flat
+
+        self.capacity = capacity
+        self.values = self.open_values(self.path, 'r+')
+
+    def write_sidecar(self):
+        sidecar = dict(fingerprint=self.fingerprint, kwargs=self.kwargs,
+                       dtype=self.dtype.name, capacity=self.capacity,
+                       message_ids=self.message_ids.tolist(),
+                       hashes=self.hashes)
+        tmp = '{}.{}.tmp'.format(self.sidecar, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(sidecar, f)
+        os.rename(tmp, self.sidecar)
+
+    def close(self):
+        if self.values is not None:
+            self.values.flush()
+        self.values = None
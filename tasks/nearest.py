@@ -0,0 +1,142 @@
+"""Find the sounds most similar to a given sound without scoring every pair.
+
+Each sound is summarized by a fixed-length embedding, the mean and standard
+deviation of each of its coefficients over time. The embeddings are held in
+an index that finds the candidates closest to a query sound, either exactly
+(BruteForceIndex) or approximately with random-projection LSH (LSHIndex).
+Only the candidates are scored with the full DTW comparison.
+"""
+import logging
+import sys
+
+from invoke import task
+import numpy
+import pandas
+from unipath import Path
+
+from .compare_sounds import calculate_similarities, scoring_kwargs
+from .dtw import as_matrix
+from .edges.edge import find_sound
+from .features import load_features
+from .settings import *
+
+logger = logging.getLogger(__name__)
+
+
+@task(help=dict(
+    message_id="Id of the sound to find neighbors for.",
+    k="Number of most similar sounds to report.",
+    n_candidates="Number of candidates to score with DTW. Defaults to 5 * k.",
+    backend="Index of embeddings: 'brute' (exact, default) or 'lsh'.",
+    json_kwargs="Key word args to pass to acoustic_similarity_mapping function",
+    jobs="Number of processes to use for scoring candidates.",
+))
+def nearest_sounds(ctx, message_id, k=20, n_candidates=None, backend='brute',
+                   json_kwargs=None, no_defaults=False, jobs=1):
+    """Find the k sounds most similar to a sound, in any category.
+
+        $ inv nearest_sounds 34 --k 20
+    """
+    kwargs = scoring_kwargs(json_kwargs, no_defaults)
+    k = int(k)
+    n_candidates = int(n_candidates) if n_candidates else 5 * k
+
+    wavs = sorted(str(wav) for wav in Path(SOUNDS_DIR).listdir('*.wav'))
+    target = str(find_sound(message_id))
+    features = load_features(wavs + [target], **kwargs)
+
+    index = build_index(backend, [features[wav] for wav in wavs], wavs)
+    candidates = index.query(embed(features[target]), n_candidates + 1)
+    candidates = [wav for wav in candidates if wav != target][:n_candidates]
+    logger.info('Scoring {} candidates from the {} index'.format(
+        len(candidates), backend))
+
+    edges = pandas.DataFrame({'sound_x': target, 'sound_y': candidates},
+                             columns=['sound_x', 'sound_y'])
+    similarities = calculate_similarities(edges, jobs=int(jobs), **kwargs)
+    similarities = similarities.sort_values(
+        'similarity', ascending=not kwargs.get('output_sim', False))
+    similarities.head(k).to_csv(sys.stdout, index=False)
+
+
+def build_index(backend, features, labels):
+    embeddings = numpy.array([embed(feature) for feature in features])
+    if backend == 'brute':
+        return BruteForceIndex(embeddings, labels)
+    elif backend == 'lsh':
+        return LSHIndex(embeddings, labels)
+    raise NotImplementedError('index backend "{}"'.format(backend))
+
+
+def embed(feature):
+    """Pool a (frames x coefficients) representation to a fixed length."""
+    frames = as_matrix(feature)
+    return numpy.concatenate([frames.mean(axis=0), frames.std(axis=0)])
+
+
+class BruteForceIndex(object):
+    """Find the nearest embeddings by comparing the query to all of them.
+
+    Embeddings are standardized so that every dimension counts equally
+    in the euclidean distance.
+    """
+    def __init__(self, embeddings, labels):
+        embeddings = numpy.asarray(embeddings, dtype=numpy.float64)
+        self.center = embeddings.mean(axis=0)
+        self.scale = embeddings.std(axis=0)
+        self.scale[self.scale == 0] = 1
+        self.embeddings = self.standardize(embeddings)
+        self.labels = numpy.asarray(labels)
+
+    def standardize(self, embeddings):
+        return (embeddings - self.center) / self.scale
+
+    def query(self, embedding, k):
+        """Get the labels of the k nearest embeddings, nearest first."""
+        return self.nearest(self.standardize(embedding),
+                            numpy.arange(len(self.embeddings)), k)
+
+    def nearest(self, query, candidates, k):
+        distances = ((self.embeddings[candidates] - query)**2).sum(axis=1)
+        order = numpy.argsort(distances, kind='mergesort')[:k]
+        return self.labels[candidates[order]].tolist()
+
+
+class LSHIndex(BruteForceIndex):
+    """Find approximate nearest embeddings with random-projection LSH.
+
+    Each table hashes an embedding to the signs of its projection onto
+    n_bits random directions, so nearby embeddings tend to land in the
+    same bucket. A query is compared only to the embeddings that share
+    a bucket with it in any table. If that's fewer than k embeddings,
+    the query falls back to comparing all of them.
+    """
+    def __init__(self, embeddings, labels, n_tables=16, n_bits=6, seed=0):
+        super(LSHIndex, self).__init__(embeddings, labels)
+        random = numpy.random.RandomState(seed)
+        n_dims = self.embeddings.shape[1]
+        self.planes = random.randn(n_tables, n_dims, n_bits)
+        self.powers = 2 ** numpy.arange(n_bits)
+
+        self.tables = []
+        for codes in self.hash(self.embeddings).T:
+            table = {}
+            for i, code in enumerate(codes):
+                table.setdefault(code, []).append(i)
+            self.tables.append(table)
+
+    def hash(self, embeddings):
+        """Get the bucket of each embedding in each table."""
+        embeddings = numpy.atleast_2d(embeddings)
+        projections = numpy.einsum('nd,tdb->ntb', embeddings, self.planes)
+        return ((projections > 0) * self.powers).sum(axis=2)
+
+    def query(self, embedding, k):
+        query = self.standardize(embedding)
+        candidates = set()
+        for table, code in zip(self.tables, self.hash(query)[0]):
+            candidates.update(table.get(code, []))
+        if len(candidates) < k:
+            candidates = range(len(self.embeddings))
+        candidates = numpy.array(sorted(candidates), dtype=int)
+        return self.nearest(query, candidates, k)
@@ -0,0 +1,145 @@
+"""Find the most similar edges without computing DTW for all of them.
+
+A query keeps the top_k most similar edges, or the edges with a similarity
+of at least min_similarity, or both. Since similarity is 1/distance, a
+lower bound on the DTW distance of an edge is an upper bound on its
+similarity, and an edge whose upper bound can't qualify is pruned without
+computing DTW. The bounds are tried from cheapest to tightest: LB_Kim,
+LB_Keogh, then the row and column minimums of the cost table.
+
+The edges kept are exactly the ones an exhaustive run would keep.
+"""
+import logging
+from collections import OrderedDict
+
+import numpy
+import pandas
+
+from .dtw import dtw_distances, lb_kim, lb_keogh, lb_rows, as_matrix
+from .edges import message_id_from_wav
+from .features import load_features
+
+logger = logging.getLogger(__name__)
+
+# Bounds are shrunk a little so rounding error can never prune an edge
+# whose exact similarity would qualify.
+SLACK = 1 - 1e-9
+
+
+class SimilarityQuery(object):
+    """Score edges in batches, keeping only the ones that qualify."""
+    def __init__(self, top_k=None, min_similarity=None, chunk_size=256,
+                 **kwargs):
+        assert top_k or min_similarity is not None, \
+            'need top_k or min_similarity'
+        assert kwargs.get('match_function', 'dtw') == 'dtw', \
+            'lower bounds are only valid for the dtw match function'
+        assert kwargs.get('output_sim'), 'need output_sim to be true'
+        self.top_k = int(top_k) if top_k else None
+        self.min_similarity = (float(min_similarity)
+                               if min_similarity is not None else None)
+        self.chunk_size = chunk_size
+        self.kwargs = kwargs
+
+        self.n_edges = 0
+        self.n_pruned = OrderedDict([('lb_kim', 0), ('lb_keogh', 0),
+                                     ('lb_rows', 0)])
+        # With top_k, the kept edges are merged with each batch, so there
+        # are never more than top_k of them. Without it, every edge over
+        # min_similarity is kept, so batches are only sorted at the end.
+        self.kept = pandas.DataFrame(
+            columns=['edge_ix', 'sound_x', 'sound_y', 'similarity'])
+        self.batches = []
+
+    def threshold(self):
+        """Get the similarity an edge needs to be kept."""
+        threshold = -numpy.inf
+        if self.min_similarity is not None:
+            threshold = self.min_similarity
+        if self.top_k and len(self.kept) == self.top_k:
+            threshold = max(threshold, self.kept.similarity.min())
+        return threshold
+
+    def could_qualify(self, bounds):
+        with numpy.errstate(divide='ignore'):
+            best_similarity = 1 / (bounds * SLACK)
+        return best_similarity >= self.threshold()
+
+    def add(self, edges):
+        """Score a batch of edges, pruning the ones that can't qualify."""
+        edges = edges[['sound_x', 'sound_y']].drop_duplicates()
+        edge_ix = self.n_edges + numpy.arange(len(edges))
+        self.n_edges += len(edges)
+
+        sound_x, sound_y = edges.sound_x.values, edges.sound_y.values
+        features = load_features(list(sound_x) + list(sound_y),
+                                 **self.kwargs)
+        queries = [as_matrix(features[x]) for x in sound_x]
+        references = [as_matrix(features[y]) for y in sound_y]
+
+        # The cheap bounds are computed for the whole batch at once. Edges
+        # that could be the most similar are scored first, so the threshold
+        # for top_k rises as quickly as possible.
+        bounds = {'lb_kim': lb_kim(queries, references),
+                  'lb_keogh': lb_keogh(queries, references)}
+        order = numpy.argsort(bounds['lb_keogh'], kind='mergesort')
+        for start in range(0, len(order), self.chunk_size):
+            ix = order[start:start+self.chunk_size]
+            for name in self.n_pruned:
+                if name == 'lb_rows':
+                    ix_bounds = lb_rows([queries[i] for i in ix],
+                                        [references[i] for i in ix])
+                else:
+                    ix_bounds = bounds[name][ix]
+                keep = self.could_qualify(ix_bounds)
+                self.n_pruned[name] += int((~keep).sum())
+                ix = ix[keep]
+                if len(ix) == 0:
+                    break
+            if len(ix) == 0:
+                continue
+
+            distances = dtw_distances([queries[i] for i in ix],
+                                      [references[i] for i in ix])
+            self.keep(pandas.DataFrame({
+                'edge_ix': edge_ix[ix],
+                'sound_x': [message_id_from_wav(x) for x in sound_x[ix]],
+                'sound_y': [message_id_from_wav(y) for y in sound_y[ix]],
+                'similarity': 1/distances,
+            }, columns=self.kept.columns))
+
+    def keep(self, scored):
+        if self.min_similarity is not None:
+            scored = scored[scored.similarity >= self.min_similarity]
+        if not self.top_k:
+            self.batches.append(scored)
+            return
+        kept = most_similar(pandas.concat([self.kept, scored],
+                                          ignore_index=True))
+        self.kept = kept.head(self.top_k).reset_index(drop=True)
+
+    def results(self):
+        """Get the kept edges, most similar first."""
+        if self.batches:
+            self.kept = most_similar(pandas.concat(
+                [self.kept] + self.batches, ignore_index=True))
+            self.batches = []
+        return self.kept[['sound_x', 'sound_y', 'similarity']]
+
+    def report(self):
+        n_pruned = sum(self.n_pruned.values())
+        by_bound = ', '.join('{} by {}'.format(n, name)
+                             for name, n in self.n_pruned.items())
+        return 'Pruned {} of {} edges ({}), scored {}'.format(
+            n_pruned, self.n_edges, by_bound, self.n_edges - n_pruned)
+
+
+def most_similar(edges):
+    """Sort edges by similarity, most similar first.
+
+    Ties are broken by the order the edges were added in, the same as a
+    stable sort of the exhaustive results.
+    """
+    edges = edges.sort_values('edge_ix', kind='mergesort')
+    edges = edges.sort_values('similarity', ascending=False, kind='mergesort')
+    return edges.reset_index(drop=True)
@@ -0,0 +1,178 @@
+"""Aggregate the similarity judgments of all the raters.
+
+Each rater's csv in data/judgments is reduced to their final rating of
+each edge, dropping repeated trials and trials with errors. Edges are
+keyed by (min id, max id) so ratings of the same pair in either order are
+combined. The reduced ratings of each csv are cached in cache/ratings, and
+a csv is only read again when it changes.
+"""
+import importlib.util
+import logging
+import sys
+
+from invoke import task
+import numpy
+import pandas
+from unipath import Path
+
+from .edges.edge import edge_keys, message_ids
+from .edges.messages import hash_file
+from .transfer import read_manifest, write_manifest
+from .settings import *
+
+logger = logging.getLogger(__name__)
+
+# Ratings are read the same way as the experiment reads them. It runs from
+# the judgments dir without this package, so the reader lives there.
+JUDGMENTS_ENGINE = Path(PROJ_ROOT, 'judgments', 'engine.py')
+_engine = None
+
+
+@task(help=dict(
+    restart="Read every judgment csv again, ignoring the cache.",
+))
+def aggregate_judgments(ctx, restart=False):
+    """Combine the ratings of all raters and compare them to acoustic similarity.
+
+    Writes the mean rating of each edge to data/edge_ratings.csv, along
+    with its acoustic similarity, and prints the agreement between raters
+    (Krippendorff's alpha) and the correlation of the mean ratings with
+    the acoustic similarities.
+    """
+    ratings = read_all_ratings(JUDGMENTS_DIR.listdir('*.csv'),
+                               restart=restart)
+    edges = edge_ratings(ratings)
+    edges['acoustic_similarity'] = read_acoustic_similarities().reindex(
+        edges.index).values
+    edges.insert(0, 'sound_x', edges.index.values >> 32)
+    edges.insert(1, 'sound_y', edges.index.values & 0xFFFFFFFF)
+    edges.to_csv(Path(DATA_DIR, 'edge_ratings.csv'), index=False)
+
+    scored = edges[edges.acoustic_similarity.notnull()]
+    summary = pandas.DataFrame([dict(
+        n_raters=ratings['name'].nunique(),
+        n_ratings=len(ratings),
+        n_edges=len(edges),
+        alpha=krippendorff_alpha(ratings),
+        pearson=scored.similarity.corr(scored.acoustic_similarity),
+        spearman=scored.similarity.rank().corr(
+            scored.acoustic_similarity.rank()),
+    )], columns=['n_raters', 'n_ratings', 'n_edges', 'alpha', 'pearson',
+                 'spearman'])
+    summary.to_csv(sys.stdout, index=False)
+
+
+def read_all_ratings(judgments, cache_dir=RATINGS_DIR, restart=False):
+    """Read the final ratings in each judgment csv, reusing cached ones."""
+    manifest_path = Path(cache_dir, 'manifest.json')
+    manifest = {} if restart else read_manifest(manifest_path)
+
+    ratings = []
+    n_read = 0
+    for src in sorted(judgments):
+        key = Path(src).name
+        cached = Path(cache_dir, key)
+        source_hash = hash_file(src)
+        if manifest.get(key) == source_hash and cached.exists():
+            ratings.append(pandas.read_csv(cached))
+            continue
+        rater_ratings = read_ratings(src)
+        rater_ratings.to_csv(cached, index=False)
+        manifest[key] = source_hash
+        ratings.append(rater_ratings)
+        n_read += 1
+    logger.info('Read {} of {} judgment files'.format(n_read,
+                                                      len(ratings)))
+
+    # Forget the files that are gone.
+    names = {Path(src).name for src in judgments}
+    manifest = {key: value for key, value in manifest.items()
+                if key in names}
+    write_manifest(manifest_path, manifest)
+
+    if not ratings:
+        return pandas.DataFrame(columns=['name', 'edge', 'similarity'])
+    ratings = pandas.concat(ratings, ignore_index=True)
+    # Raters are identified by name, which may span more than one file.
+    return ratings.drop_duplicates(['name', 'edge'], keep='last')
+
+
+def read_ratings(src, chunksize=10000):
+    """Read the final rating of each edge by each rater in a judgment csv.
+
+    Edges are keyed like edge_keys. See read_final_ratings.
+    """
+    ratings = read_final_ratings(src, chunksize=chunksize)
+    return pandas.DataFrame({
+        'name': ratings['name'].values,
+        'edge': edge_keys(ratings.edge_x.values, ratings.edge_y.values),
+        'similarity': ratings.similarity.values,
+    }, columns=['name', 'edge', 'similarity'])
+
+
+def read_final_ratings(src, chunksize=10000):
+    """Read a judgment csv with the experiment's read_final_ratings."""
+    return judgments_engine().read_final_ratings(src, chunksize=chunksize)
+
+
+def judgments_engine():
+    """Load judgments/engine.py by path, without adding it to sys.path."""
+    global _engine
+    if _engine is None:
+        spec = importlib.util.spec_from_file_location('judgments_engine',
+                                                      str(JUDGMENTS_ENGINE))
+        _engine = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(_engine)
+    return _engine
+
+
+def edge_ratings(ratings):
+    """Summarize the ratings of each edge, indexed by edge key."""
+    edges = ratings.groupby('edge').similarity.agg(['count', 'mean', 'std'])
+    edges.columns = ['n_ratings', 'similarity', 'similarity_std']
+    return edges
+
+
+def read_acoustic_similarities():
+    """Get the acoustic similarity of each scored edge, by edge key."""
+    scored = pandas.concat([
+        pandas.read_csv(Path(SIMILARITIES_DIR, '{}.csv'.format(edge_type)))
+        for edge_type in ['within', 'between']
+    ], ignore_index=True)
+    similarities = pandas.Series(
+        scored.similarity.values,
+        index=edge_keys(message_ids(scored.sound_x),
+                        message_ids(scored.sound_y)))
+    return similarities[~similarities.index.duplicated()]
+
+
+def krippendorff_alpha(ratings):
+    """Get the agreement of raters, as Krippendorff's alpha for intervals.
+
+    Args:
+        ratings: A DataFrame with at most one rating of each edge by each
+            rater, with columns edge and similarity. Raters can rate any
+            number of the edges.
+
+    Alpha is 1 - D_o / D_e, where D_o is the mean squared difference
+    between ratings of the same edge and D_e is the mean squared
+    difference between any two ratings. Only edges with at least two
+    ratings are counted. The sums over pairs of ratings are computed from
+    the sums and sums of squares of the ratings of each edge.
+    """
+    values = ratings.similarity.astype(numpy.float64)
+    units = pandas.DataFrame({'edge': ratings.edge.values,
+                              'total': values.values,
+                              'squares': values.values**2})
+    units = units.groupby('edge').agg(['count', 'sum'])
+    units = units[units['total']['count'] >= 2]
+    m = units['total']['count']
+    total = units['total']['sum']
+    squares = units['squares']['sum']
+
+    n = float(m.sum())
+    if n < 2:
+        return numpy.nan
+    observed = (2 * (m * squares - total**2) / (m - 1)).sum() / n
+    expected = 2 * (n * squares.sum() - total.sum()**2) / (n * (n - 1))
+    return 1 - observed / expected
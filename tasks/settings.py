@@ -2,12 +2,23 @@ from unipath import Path
 
 PROJ_ROOT = Path(__file__).ancestor(2).absolute()
 DOWNLOAD_DIR = Path(PROJ_ROOT, 'downloads')
+DOWNLOAD_MANIFEST = Path(DOWNLOAD_DIR, 'manifest.json')
 DATA_DIR = Path(PROJ_ROOT, 'data')
 SOUNDS_DIR = Path(DATA_DIR, 'sounds')
+SOUNDS_MANIFEST = Path(DOWNLOAD_DIR, 'sounds.json')
 WORDS_DIR = Path(DATA_DIR, 'words')
 SIMILARITIES_DIR = Path(DATA_DIR, 'similarities')
+JUDGMENTS_DIR = Path(DATA_DIR, 'judgments')
+CACHE_DIR = Path(PROJ_ROOT, 'cache')
+FEATURES_DIR = Path(CACHE_DIR, 'features')
+SIMILARITIES_JOURNAL = Path(CACHE_DIR, 'similarities.sqlite')
+MATRICES_DIR = Path(CACHE_DIR, 'matrices')
+AUDIO_STORE = Path(CACHE_DIR, 'audio.f32')
+AUDIO_INDEX = Path(CACHE_DIR, 'audio.csv')
+RATINGS_DIR = Path(CACHE_DIR, 'ratings')
 
-expected_dirs = [DOWNLOAD_DIR, DATA_DIR, SOUNDS_DIR, SIMILARITIES_DIR]
+expected_dirs = [DOWNLOAD_DIR, DATA_DIR, SOUNDS_DIR, SIMILARITIES_DIR,
+                 CACHE_DIR, FEATURES_DIR, MATRICES_DIR, RATINGS_DIR]
 for expected_dir in expected_dirs:
     if not expected_dir.isdir():
         expected_dir.mkdir()
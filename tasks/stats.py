@@ -0,0 +1,197 @@
+"""Confidence intervals and permutation tests for the edge similarities.
+
+Resamples are drawn a batch at a time as a matrix of indices into the
+similarities, one resample per row, so a whole batch is summarized with a
+single numpy reduction. Batches are spread over a pool of processes. Each
+batch gets its own seed, drawn from the seed of the task, so the results
+are the same however many processes there are.
+"""
+import logging
+import multiprocessing
+import sys
+
+from invoke import task
+import numpy
+import pandas
+from unipath import Path
+
+from .settings import *
+
+logger = logging.getLogger(__name__)
+
+EDGE_TYPES = ['linear', 'within_chain', 'within_seed', 'within_category',
+              'between_fixed', 'between_consecutive']
+
+# Most indices to draw in one batch, to bound the memory of each process.
+MAX_BATCH_SIZE = 2**22
+
+
+@task(help=dict(
+    n_resamples="Number of bootstrap resamples and permutations. Defaults to 10000.",
+    ci="Width of the confidence intervals. Defaults to 0.95.",
+    within="Edge type to compare to the between edges.",
+    between="Edge type to compare to the within edges.",
+    seed="Seed for the resamples, to make the results reproducible.",
+    processes="Number of processes to resample with. Defaults to all cores.",
+))
+def similarity_stats(ctx, n_resamples=10000, ci=0.95,
+                     within='within_category', between='between_fixed',
+                     seed=None, processes=None):
+    """Bootstrap the mean similarity of each edge type and test within vs between.
+
+    Run after edge_types. Each edge type gets a bootstrap confidence
+    interval for its mean similarity. The difference between the within
+    and between edges is tested by permuting the edge type labels, for
+    all the edges and then for the edges within each generation.
+
+        $ inv similarity_stats --seed 100
+    """
+    kwargs = dict(n_resamples=int(n_resamples), ci=float(ci),
+                  seed=int(seed) if seed is not None else None,
+                  processes=int(processes) if processes else None)
+
+    generations = pandas.read_csv(Path(DATA_DIR, 'sounds.csv'),
+                                  index_col='message_id').generation
+    edges = {edge_type: read_edges(edge_type, generations)
+             for edge_type in EDGE_TYPES}
+
+    results = [describe(edge_type, edges[edge_type].similarity, **kwargs)
+               for edge_type in EDGE_TYPES]
+
+    comparison = '{}-{}'.format(within, between)
+    results.append(compare(comparison, edges[within].similarity,
+                           edges[between].similarity, **kwargs))
+    for generation in sorted(edges[between].generation.dropna().unique()):
+        x = edges[within].similarity[edges[within].generation == generation]
+        y = edges[between].similarity[edges[between].generation == generation]
+        if len(x) == 0 or len(y) == 0:
+            continue
+        results.append(compare(comparison, x, y, generation=int(generation),
+                               **kwargs))
+
+    stats = pandas.DataFrame(results, columns=[
+        'edge_type', 'generation', 'n', 'statistic', 'ci_lower', 'ci_upper',
+        'p_value'])
+    stats.to_csv(Path(DATA_DIR, 'similarity_stats.csv'), index=False)
+    stats.to_csv(sys.stdout, index=False)
+
+
+def read_edges(edge_type, generations):
+    """Read the similarities of an edge type made by the edge_types task.
+
+    Edges between sounds of the same generation are labeled with that
+    generation. Edges across generations have no generation.
+    """
+    edges = pandas.read_csv(Path(DATA_DIR, '{}.csv'.format(edge_type)))
+    generation_x = generations.reindex(edges.sound_x).values
+    generation_y = generations.reindex(edges.sound_y).values
+    edges['generation'] = numpy.where(generation_x == generation_y,
+                                      generation_x, numpy.nan)
+    return edges
+
+
+def describe(edge_type, similarities, n_resamples=10000, ci=0.95, seed=None,
+             processes=None):
+    similarities = numpy.asarray(similarities, dtype=numpy.float64)
+    means = bootstrap_means(similarities, n_resamples, seed, processes)
+    lower, upper = percentile_interval(means, ci)
+    return dict(edge_type=edge_type, generation='all', n=len(similarities),
+                statistic=similarities.mean(), ci_lower=lower,
+                ci_upper=upper, p_value=numpy.nan)
+
+
+def compare(edge_type, x, y, generation='all', n_resamples=10000, ci=0.95,
+            seed=None, processes=None):
+    """Compare the mean similarity of two groups of edges.
+
+    The interval is for the difference in means, from bootstrapping each
+    group separately. The p value is from a two-sided permutation test.
+    """
+    x = numpy.asarray(x, dtype=numpy.float64)
+    y = numpy.asarray(y, dtype=numpy.float64)
+    random = numpy.random.RandomState(seed)
+    seeds = random.randint(2**31 - 1, size=3)
+    differences = (bootstrap_means(x, n_resamples, seeds[0], processes) -
+                   bootstrap_means(y, n_resamples, seeds[1], processes))
+    lower, upper = percentile_interval(differences, ci)
+    return dict(edge_type=edge_type, generation=generation,
+                n=len(x) + len(y), statistic=x.mean() - y.mean(),
+                ci_lower=lower, ci_upper=upper,
+                p_value=permutation_test(x, y, n_resamples, seeds[2],
+                                         processes))
+
+
+def bootstrap_means(values, n_resamples=10000, seed=None, processes=None):
+    """Get the mean of each of n_resamples bootstrap resamples of values."""
+    values = numpy.asarray(values, dtype=numpy.float64)
+    return resample(bootstrap_batch, values, len(values), n_resamples, seed,
+                    processes)
+
+
+def permutation_test(x, y, n_permutations=10000, seed=None, processes=None):
+    """Get the two-sided p value for a difference in the means of x and y.
+
+    The labels of x and y are shuffled in each permutation, and the p value
+    is the proportion of permutations with a difference in means at least
+    as large as the observed one, counting the observed labels as one.
+    """
+    x = numpy.asarray(x, dtype=numpy.float64)
+    y = numpy.asarray(y, dtype=numpy.float64)
+    values = numpy.concatenate([x, y])
+    differences = resample(permutation_batch, (values, len(x)), len(values),
+                           n_permutations, seed, processes)
+    observed = abs(x.mean() - y.mean())
+    # Allow for rounding in the shuffled sums of the observed labels.
+    n_extreme = (numpy.abs(differences) >= observed * (1 - 1e-12)).sum()
+    return (n_extreme + 1) / float(n_permutations + 1)
+
+
+def percentile_interval(estimates, ci=0.95):
+    tail = (1 - ci) / 2 * 100
+    return tuple(numpy.percentile(estimates, [tail, 100 - tail]))
+
+
+def resample(batch, data, n_values, n_resamples, seed=None, processes=None):
+    """Run n_resamples resamples of data in batches, on a pool of processes.
+
+    Args:
+        batch: Function that takes (data, n_resamples, seed) and returns
+            an array with a statistic for each of n_resamples resamples.
+        data: Data to resample, passed to each batch.
+        n_values: Number of values in each resample.
+        n_resamples: Total number of resamples.
+        seed: Seed for the seeds of the batches.
+        processes: Number of processes. Defaults to all cores.
+    """
+    batch_size = max(1, MAX_BATCH_SIZE // max(1, n_values))
+    sizes = [min(batch_size, n_resamples - start)
+             for start in range(0, n_resamples, batch_size)]
+    seeds = numpy.random.RandomState(seed).randint(2**31 - 1, size=len(sizes))
+    jobs = [(data, size, batch_seed) for size, batch_seed in zip(sizes, seeds)]
+
+    if processes == 1 or len(jobs) == 1:
+        statistics = list(map(batch, jobs))
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            statistics = pool.map(batch, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    return numpy.concatenate(statistics)
+
+
+def bootstrap_batch(job):
+    values, n_resamples, seed = job
+    random = numpy.random.RandomState(seed)
+    indices = random.randint(len(values), size=(n_resamples, len(values)))
+    return values[indices].mean(axis=1)
+
+
+def permutation_batch(job):
+    (values, n_x), n_permutations, seed = job
+    random = numpy.random.RandomState(seed)
+    indices = random.rand(n_permutations, len(values)).argsort(axis=1)
+    sum_x = values[indices[:, :n_x]].sum(axis=1)
+    n_y = len(values) - n_x
+    return sum_x / n_x - (values.sum() - sum_x) / n_y
@@ -0,0 +1,173 @@
+"""Time the stages of a task.
+
+Stages are timed with nested spans:
+
+    with timing.span('score', pairs=len(edges)):
+        ...
+
+When a span ends, its duration, its counts (with a rate for pairs) and the
+peak memory of the process so far are logged at INFO to the tasks.timing
+logger. They are only shown once the task being timed calls
+timing.show_timings, which lets its tasks logger log at INFO. Counts
+can be added to the innermost open span from anywhere with timing.count,
+e.g. the cache hits and misses of the feature store.
+
+Wrapping a whole task in timing.instrumented also writes the spans as a
+Chrome trace (viewable in chrome://tracing or https://ui.perfetto.dev)
+and optionally profiles the task with cProfile.
+"""
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+_events = []
+_events_lock = threading.Lock()
+
+
+class Span(object):
+    def __init__(self, name, depth, counts):
+        self.name = name
+        self.depth = depth
+        self.counts = dict(counts)
+        self.start = time.time()
+        self.duration = None
+
+    def count(self, **counts):
+        for key, n in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + n
+
+    def describe(self):
+        details = []
+        for key in sorted(self.counts):
+            if key in ('cache_hits', 'cache_misses'):
+                continue
+            details.append('{}={}'.format(key, self.counts[key]))
+            if key == 'pairs' and self.duration > 0:
+                details.append('{:.0f} pairs/s'.format(
+                    self.counts[key] / self.duration))
+        hits = self.counts.get('cache_hits', 0)
+        misses = self.counts.get('cache_misses', 0)
+        if hits + misses:
+            details.append('cache hits {}/{} ({:.0%})'.format(
+                hits, hits + misses, hits / float(hits + misses)))
+        rss = peak_rss()
+        if rss is not None:
+            details.append('peak RSS {:.0f} MB'.format(rss / 2.0**20))
+        return '{}{}: {:.3f}s ({})'.format('  ' * self.depth, self.name,
+                                           self.duration, ', '.join(details))
+
+
+def open_spans():
+    if not hasattr(_local, 'spans'):
+        _local.spans = []
+    return _local.spans
+
+
+@contextmanager
+def span(name, **counts):
+    """Time a stage, logging how long it took when it's done."""
+    spans = open_spans()
+    current = Span(name, len(spans), counts)
+    spans.append(current)
+    try:
+        yield current
+    finally:
+        spans.pop()
+        current.duration = time.time() - current.start
+        logger.info(current.describe())
+        with _events_lock:
+            _events.append(dict(
+                name=name, ph='X', pid=os.getpid(),
+                tid=threading.current_thread().ident,
+                ts=int(current.start * 1e6),
+                dur=int(current.duration * 1e6),
+                args=current.counts,
+            ))
+
+
+def show_timings():
+    """Show the spans, and the rest of the tasks logged at INFO."""
+    logging.getLogger('tasks').setLevel(logging.INFO)
+
+
+def count(**counts):
+    """Add to the counts of the innermost open span, if there is one."""
+    spans = open_spans()
+    if spans:
+        spans[-1].count(**counts)
+
+
+def peak_rss():
+    """Get the peak resident memory of this process, in bytes."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes.
+    return peak if os.uname()[0] == 'Darwin' else peak * 1024
+
+
+def write_trace(path):
+    """Write the finished spans in the Chrome trace event format."""
+    with _events_lock:
+        events = list(_events)
+    with open(path, 'w') as f:
+        json.dump(dict(traceEvents=events, displayTimeUnit='ms'), f)
+
+
+def timed_iter(name, iterable):
+    """Time getting each item from an iterable, like a generator."""
+    iterator = iter(iterable)
+    while True:
+        with span(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+@contextmanager
+def instrumented(name, trace=None, profile=None):
+    """Time a whole task, optionally writing a trace and a profile.
+
+    Args:
+        name: Name of the outermost span.
+        trace: Path to write a Chrome trace of the task's spans to.
+        profile: Path to dump cProfile stats to. The slowest functions
+            are also logged.
+    """
+    with _events_lock:
+        del _events[:]
+
+    profiler = cProfile.Profile() if profile else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        with span(name) as task_span:
+            yield task_span
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile)
+            logger.info('Wrote profile to {}'.format(profile))
+            output = io.StringIO()
+            stats = pstats.Stats(profiler, stream=output)
+            stats.sort_stats('cumulative').print_stats(20)
+            logger.info(output.getvalue())
+        if trace:
+            write_trace(trace)
+            logger.info('Wrote trace to {}'.format(trace))
@@ -0,0 +1,213 @@
+"""Download objects from S3 in parallel, resuming partial downloads.
+
+Objects are fetched in parts with range requests on a thread pool. Each
+finished part is recorded next to the partial file, so an interrupted
+download only fetches the parts it's missing when it's run again. A
+manifest of the ETag and size of each downloaded object is used to skip
+objects that haven't changed.
+
+Anything with the interface of a boto3 Bucket's Object(key) can be
+downloaded from, such as the LocalBucket stand-in used for tests.
+"""
+import io
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from unipath import Path
+
+logger = logging.getLogger(__name__)
+
+PART_SIZE = 8 * 1024 * 1024
+
+
+def download_objects(bucket, keys, dst_dir, manifest_path, jobs=8,
+                     part_size=PART_SIZE, retries=3, overwrite=False):
+    """Download objects into dst_dir, skipping ones that haven't changed.
+
+    Returns the keys that were downloaded.
+    """
+    manifest = read_manifest(manifest_path)
+
+    downloads = []
+    for key in keys:
+        obj = bucket.Object(key)
+        name = Path(key).name
+        dst = Path(dst_dir, name)
+        expected = dict(e_tag=obj.e_tag, size=obj.content_length)
+        if (not overwrite and manifest.get(name) == expected and
+                dst.exists() and os.path.getsize(dst) == expected['size']):
+            logger.info('Skipping unchanged {}'.format(key))
+            continue
+        downloads.append(PartialDownload(obj, dst, expected, part_size))
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = []
+        for download in downloads:
+            for part in download.missing_parts():
+                futures.append(pool.submit(fetch_part, download, part,
+                                           retries))
+        for future in futures:
+            future.result()
+
+    for download in downloads:
+        download.finish()
+        manifest[download.dst.name] = download.expected
+    write_manifest(manifest_path, manifest)
+    return [download.obj.key for download in downloads]
+
+
+class PartialDownload(object):
+    """A download written to dst.part, with finished parts in dst.parts."""
+    def __init__(self, obj, dst, expected, part_size):
+        self.obj = obj
+        self.dst = dst
+        self.expected = expected
+        self.part_size = part_size
+        self.tmp = Path('{}.part'.format(dst))
+        self.progress = Path('{}.parts'.format(dst))
+        self.lock = threading.Lock()
+
+        self.finished = set()
+        if self.tmp.exists() and self.progress.exists():
+            with open(self.progress) as f:
+                progress = json.load(f)
+            if progress['expected'] == expected:
+                self.finished = set(progress['finished'])
+                logger.info('Resuming {} with {} parts done'.format(
+                    obj.key, len(self.finished)))
+
+        if not self.finished:
+            with open(self.tmp, 'wb') as f:
+                f.truncate(expected['size'])
+
+    def parts(self):
+        size = self.expected['size']
+        n_parts = max(1, -(-size // self.part_size))
+        return range(n_parts)
+
+    def missing_parts(self):
+        return [part for part in self.parts() if part not in self.finished]
+
+    def byte_range(self, part):
+        start = part * self.part_size
+        stop = min(start + self.part_size, self.expected['size']) - 1
+        return start, stop
+
+    def write_part(self, part, data):
+        start, _ = self.byte_range(part)
+        with open(self.tmp, 'r+b') as f:
+            f.seek(start)
+            f.write(data)
+        with self.lock:
+            self.finished.add(part)
+            with open(self.progress, 'w') as f:
+                json.dump(dict(expected=self.expected,
+                               finished=sorted(self.finished)), f)
+
+    def finish(self):
+        assert not self.missing_parts(), 'download is incomplete'
+        os.rename(self.tmp, self.dst)
+        if self.progress.exists():
+            self.progress.remove()
+
+
+def fetch_part(download, part, retries):
+    """Fetch a part of an object, as long as it still has the same ETag.
+
+    Parts are only fetched with IfMatch, so parts of two versions of an
+    object are never mixed. If the object changed, ObjectChanged is
+    raised without retrying, and the next download starts it over.
+    """
+    start, stop = download.byte_range(part)
+    for attempt in range(retries + 1):
+        try:
+            if stop < start:  # empty object
+                data = b''
+            else:
+                response = download.obj.get(
+                    Range='bytes={}-{}'.format(start, stop),
+                    IfMatch=download.expected['e_tag'])
+                data = response['Body'].read()
+            assert len(data) == stop - start + 1, 'incomplete part'
+        except Exception as e:
+            if is_precondition_failed(e):
+                raise ObjectChanged('{} changed during the download'.format(
+                    download.obj.key))
+            if attempt == retries:
+                raise
+            logger.warning('Retrying part {} of {}: {!r}'.format(
+                part, download.obj.key, e))
+            time.sleep(2 ** attempt)
+        else:
+            download.write_part(part, data)
+            return
+
+
+class ObjectChanged(Exception):
+    pass
+
+
+def is_precondition_failed(error):
+    """Whether an error is S3's response to an IfMatch that failed."""
+    response = getattr(error, 'response', None) or {}
+    return response.get('Error', {}).get('Code') == 'PreconditionFailed'
+
+
+def read_manifest(path):
+    if not Path(path).exists():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(path, manifest):
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+
+class LocalBucket(object):
+    """A stand-in for an S3 bucket that serves files from a local dir."""
+    def __init__(self, root):
+        self.root = root
+
+    def Object(self, key):
+        return LocalObject(Path(self.root, key), key)
+
+
+class LocalObject(object):
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+
+    @property
+    def content_length(self):
+        return os.path.getsize(self.path)
+
+    @property
+    def e_tag(self):
+        stat = os.stat(self.path)
+        return '"{}-{}"'.format(int(stat.st_mtime * 1e6), stat.st_size)
+
+    def get(self, Range=None, IfMatch=None):
+        if IfMatch is not None and IfMatch != self.e_tag:
+            raise PreconditionFailed(self.key)
+        with open(self.path, 'rb') as f:
+            if Range is None:
+                data = f.read()
+            else:
+                start, stop = map(int, Range.split('=')[1].split('-'))
+                f.seek(start)
+                data = f.read(stop - start + 1)
+        return {'Body': io.BytesIO(data)}
+
+
+class PreconditionFailed(Exception):
+    """Raised by LocalObject like botocore's ClientError for a 412."""
+    def __init__(self, key):
+        super(PreconditionFailed, self).__init__(
+            'At least one of the pre-conditions you specified did not hold')
+        self.response = {'Error': {'Code': 'PreconditionFailed', 'Key': key}}
@@ -1,11 +1,37 @@
+import importlib
+import json
+import logging
+import os
+import zipfile
+
+import numpy
 import pandas
+import pytest
 from unipath import Path
 
-from tasks.edges.messages import collapse_branches, expand_message_list
+from tasks.edges.messages import (collapse_branches, expand_message_list,
+                                  parse_downloaded_messages,
+                                  get_message_ids_for_edge)
+from tasks.edges.tree import MessageTree
+from tasks.edges.lineage import LineageIndex
+from tasks.edges.stream import iter_pair_blocks
 from tasks.edges.within import get_linear_edges
 from tasks.edges.between import get_between_category_fixed_edges
-from tasks.compare_sounds import calculate_similarities
-from tasks.edges.edge import create_single_edge
+from tasks.compare_sounds import (DEFAULT_KWARGS, calculate_similarities,
+                                  merge_similarities, record_chunks,
+                                  score_chunk, score_chunks, scoring_configs,
+                                  similarity_columns)
+from tasks.edges.edge import (create_single_edge, edge_keys, message_ids,
+                              remove_duplicate_edges)
+from tasks.features import representation_fingerprint
+from tasks.dtw import dtw_distances, lb_kim, lb_keogh, lb_rows
+from tasks.query import SimilarityQuery
+from tasks.journal import SimilarityJournal
+from tasks.transfer import download_objects, LocalBucket
+from tasks.audio_store import AudioStore, build_audio_store, trim_silence
+from tasks.matrix import SimilarityMatrix
+from tasks.nearest import BruteForceIndex, LSHIndex
+from tasks import ratings, stats, timing
 
 
 def test_collapse_single_branch():
@@ -22,6 +48,57 @@ def test_collapse_multiple_branches():
     assert len(collapsed) == 2
     assert collapsed == expected
 
+def test_message_tree():
+    messages = pandas.DataFrame(dict(
+        message_id=[1, 2, 3, 4, 5],
+        parent=[None, 1, 1, 3, None],
+    ))
+    tree = MessageTree(messages)
+    assert tree.branches() == [[4, 3, 1], [2, 1], [5]]
+    assert tree.seed_ids() == {1: 1, 2: 1, 3: 1, 4: 1, 5: 5}
+    assert tree.generations() == {1: 0, 2: 1, 3: 1, 4: 2, 5: 0}
+
+def test_parse_downloaded_messages(tmpdir):
+    dump = tmpdir.join('grunt.Message.json')
+    dump.write(json.dumps([
+        {'model': 'grunt.message', 'pk': pk, 'fields': {
+            'parent': None, 'generation': 0, 'rejected': False,
+            'audio': '{}/tear/{}.wav'.format(game, pk)}}
+        for pk, game in [(1, 'words-in-transition'), (2, 'other-game')]
+    ]))
+    messages = parse_downloaded_messages(str(dump), 'words-in-transition')
+    assert messages.message_id.tolist() == [1]
+    assert messages.category.dtype.name == 'category'
+    assert messages.generation.dtype == numpy.int8
+    assert messages.rejected.dtype == bool
+
+def test_message_table_sidecar_is_only_written_on_a_miss(tmpdir,
+                                                          monkeypatch):
+    messages_module = importlib.import_module('tasks.edges.messages')
+    monkeypatch.setattr(messages_module, 'DOWNLOAD_DIR', str(tmpdir))
+    dump = tmpdir.join('grunt.Message.json')
+    dump.write(json.dumps([
+        {'model': 'grunt.message', 'pk': pk, 'fields': {
+            'parent': parent, 'generation': generation, 'rejected': False,
+            'audio': 'words-in-transition/tear/{}.wav'.format(pk)}}
+        for pk, parent, generation in [(1, None, 0), (2, 1, 1)]
+    ]))
+    # A sidecar left truncated by an interrupted write is a miss.
+    sidecar = tmpdir.join('grunt.Message.words-in-transition.pickle')
+    sidecar.write_binary(b'\x80\x04')
+    version = (os.path.getmtime(str(dump)), os.path.getsize(str(dump)))
+    table = messages_module.load_message_table(str(dump),
+                                               'words-in-transition', version)
+    assert table['messages'].message_id.tolist() == [1, 2]
+
+    def fail(sidecar, table):
+        raise AssertionError('rewrote the sidecar on a hit')
+
+    monkeypatch.setattr(messages_module, 'write_sidecar', fail)
+    table = messages_module.load_message_table(str(dump),
+                                               'words-in-transition', version)
+    assert table['messages'].message_id.tolist() == [1, 2]
+
 def test_expand_branch():
     branch = pandas.Series(dict(branch_id=1, message_list=[1,2,3,4]))
     expanded = expand_message_list(branch)
@@ -44,11 +121,74 @@ def test_get_linear_edges():
     first_edge = edges.iloc[0, 1:3].tolist()
     assert first_edge == ['1.wav', '2.wav']
 
-def test_calculate_similarities():
+def test_remove_duplicate_edges_ignores_direction():
+    edges = pandas.DataFrame(dict(
+        sound_x=['sounds/1.wav', 'sounds/2.wav', 'sounds/1.wav'],
+        sound_y=['sounds/2.wav', 'sounds/1.wav', 'sounds/3.wav'],
+    ))
+    unique = remove_duplicate_edges(edges)
+    assert unique.values.tolist() == [['sounds/1.wav', 'sounds/2.wav'],
+                                      ['sounds/1.wav', 'sounds/3.wav']]
+
+def test_get_message_ids_for_edge():
+    edges = pandas.DataFrame({'sound_x': ['/data/sounds/12.wav', '3.wav'],
+                              'sound_y': ['/data/sounds/4.wav', '45.wav']})
+    edges = get_message_ids_for_edge(edges)
+    assert edges.values.tolist() == [[12, 4], [3, 45]]
+
+def test_pair_blocks_cover_all_combinations_in_order():
+    blocks = list(iter_pair_blocks(6, batch_size=4))
+    x = numpy.concatenate([x for x, _ in blocks])
+    y = numpy.concatenate([y for _, y in blocks])
+    expected_x, expected_y = numpy.triu_indices(6, k=1)
+    assert x.tolist() == expected_x.tolist()
+    assert y.tolist() == expected_y.tolist()
+    assert max(len(x) for x, _ in blocks) <= 5
+
+def test_calculate_similarities(tmpdir, monkeypatch):
+    from tasks import features
+    monkeypatch.setattr(features, 'FEATURES_DIR', str(tmpdir))
     edges = create_single_edge('fixtures/1.wav', 'fixtures/2.wav')
     similarities = calculate_similarities(edges)
     assert len(similarities) == 1
 
+def test_truncated_wav_is_left_out_of_features(tmpdir, monkeypatch):
+    from tasks import features
+    monkeypatch.setattr(features, 'FEATURES_DIR', str(tmpdir))
+    with open('fixtures/1.wav', 'rb') as f:
+        tmpdir.join('3.wav').write_binary(f.read()[:30])
+    wavs = ['fixtures/1.wav', str(tmpdir.join('3.wav'))]
+    loaded = features.load_features(wavs, **DEFAULT_KWARGS)
+    assert list(loaded) == ['fixtures/1.wav']
+
+def test_failed_chunk_is_reported_not_raised():
+    chunk = (3, [('fixtures/missing.wav', 'fixtures/1.wav')], {}, {})
+    chunk_ix, records, error = score_chunk(chunk)
+    assert chunk_ix == 3
+    assert records is None
+    assert error is not None
+
+def crash_on_chunk_3(chunk):
+    chunk_ix = chunk[0]
+    if chunk_ix == 3:
+        os._exit(1)
+    return chunk_ix, [chunk_ix], None
+
+def test_crashed_worker_only_loses_its_own_chunk():
+    chunks = [(chunk_ix, [], {}, {}) for chunk_ix in range(8)]
+    scored = sorted(score_chunks(chunks, jobs=3, score=crash_on_chunk_3))
+    assert [chunk_ix for chunk_ix, _, _ in scored] == list(range(8))
+    lost = [chunk_ix for chunk_ix, records, error in scored
+            if error is not None]
+    assert lost == [3]
+
+def test_configs_are_named_by_how_they_differ():
+    configs = scoring_configs('[{"num_coeffs": 12}, {"num_coeffs": 20}]')
+    assert [config['rep'] for config in configs] == ['mfcc', 'mfcc']
+    assert similarity_columns(configs) == ['similarity_num_coeffs_12',
+                                           'similarity_num_coeffs_20']
+    assert similarity_columns(configs[:1]) == ['similarity']
+
 def test_between_category_edges():
     messages = pandas.DataFrame({
         'category': ['a', 'b'],
@@ -57,3 +197,522 @@ def test_between_category_edges():
     })
     edges = get_between_category_fixed_edges(messages)
     assert edges.iloc[0, 0:2].tolist() == ['1.wav', '2.wav']
+
+def test_representation_fingerprint_ignores_match_kwargs():
+    mfcc = representation_fingerprint(rep='mfcc', num_coeffs=12)
+    assert mfcc == representation_fingerprint(rep='mfcc', num_coeffs=12,
+                                              output_sim=True)
+    assert mfcc != representation_fingerprint(rep='mfcc', num_coeffs=20)
+
+def test_representation_fingerprint_changes_with_acousticsim(monkeypatch):
+    mfcc = representation_fingerprint(rep='mfcc', num_coeffs=12)
+    monkeypatch.setattr('acousticsim.__version__', 'a newer version')
+    assert mfcc != representation_fingerprint(rep='mfcc', num_coeffs=12)
+
+def test_batched_dtw_matches_cell_by_cell_dtw():
+    def dtw(x, y):
+        cost = numpy.sqrt(((x[:, None] - y[None, :])**2).sum(axis=2))
+        total = numpy.full((len(x)+1, len(y)+1), numpy.inf)
+        total[1, 1] = cost[0, 0]
+        for i in range(len(x)):
+            for j in range(len(y)):
+                if i or j:
+                    total[i+1, j+1] = min(total[i, j] + 2*cost[i, j],
+                                          total[i, j+1] + cost[i, j],
+                                          total[i+1, j] + cost[i, j])
+        return total[-1, -1] / (len(x) + len(y))
+
+    random = numpy.random.RandomState(100)
+    queries = [random.randn(random.randint(1, 30), 12) for _ in range(10)]
+    references = [random.randn(random.randint(1, 30), 12) for _ in range(10)]
+    expected = [dtw(x, y) for x, y in zip(queries, references)]
+    distances = dtw_distances(queries, references, batch_size=3)
+    assert numpy.allclose(distances, expected)
+
+def test_dtw_lower_bounds_are_below_dtw():
+    random = numpy.random.RandomState(0)
+    queries = [random.randn(random.randint(1, 20), 12) for _ in range(20)]
+    references = [random.randn(random.randint(1, 20), 12) for _ in range(20)]
+    distances = dtw_distances(queries, references)
+    for lower_bound in [lb_kim, lb_keogh, lb_rows]:
+        assert (lower_bound(queries, references) <= distances + 1e-12).all()
+
+def test_pruned_query_matches_exhaustive_top_k(monkeypatch):
+    random = numpy.random.RandomState(0)
+    features = {'{}.wav'.format(i): random.randn(random.randint(5, 20), 12) +
+                random.randn(12) for i in range(30)}
+    monkeypatch.setattr('tasks.query.load_features',
+                        lambda wavs, **kwargs: features)
+    x, y = numpy.triu_indices(30, k=1)
+    wavs = numpy.array(sorted(features, key=lambda wav: int(wav[:-4])))
+    edges = pandas.DataFrame({'sound_x': wavs[x], 'sound_y': wavs[y]})
+
+    query = SimilarityQuery(top_k=10, output_sim=True, chunk_size=16)
+    query.add(edges)
+    similarities = 1/dtw_distances([features[wav] for wav in wavs[x]],
+                                   [features[wav] for wav in wavs[y]])
+    expected = numpy.argsort(-similarities, kind='mergesort')[:10]
+    assert query.results().sound_x.tolist() == x[expected].tolist()
+    assert query.results().sound_y.tolist() == y[expected].tolist()
+    assert sum(query.n_pruned.values()) > 0
+
+    min_similarity = similarities[expected[-1]]
+    query = SimilarityQuery(min_similarity=min_similarity, output_sim=True,
+                            chunk_size=16)
+    query.add(edges[:200])
+    query.add(edges[200:])
+    assert query.results().sound_x.tolist() == x[expected].tolist()
+    assert query.results().sound_y.tolist() == y[expected].tolist()
+
+def test_journal_finds_edges_scored_in_either_order(tmpdir):
+    wavs = {}
+    for message_id in [1, 2, 3]:
+        wavs[message_id] = str(tmpdir.join('{}.wav'.format(message_id)))
+        tmpdir.join('{}.wav'.format(message_id)).write(str(message_id))
+    path = str(tmpdir.join('journal.sqlite'))
+    journal = SimilarityJournal(path, rep='mfcc')
+    journal.record([(wavs[1], wavs[2], 0.5)])
+    found = journal.lookup([wavs[2], wavs[1], wavs[3]],
+                           [wavs[1], wavs[2], wavs[1]])
+    assert found.values.tolist() == [[2, 1, 0.5], [1, 2, 0.5]]
+    assert found.index.tolist() == [0, 1]
+    other_kwargs = SimilarityJournal(path, rep='envelopes')
+    assert len(other_kwargs.lookup([wavs[1]], [wavs[2]])) == 0
+
+def test_journal_rescores_changed_wavs(tmpdir):
+    wav_x, wav_y = str(tmpdir.join('1.wav')), str(tmpdir.join('2.wav'))
+    tmpdir.join('1.wav').write('x')
+    tmpdir.join('2.wav').write('y')
+    path = str(tmpdir.join('journal.sqlite'))
+    SimilarityJournal(path, rep='mfcc').record([(wav_x, wav_y, 0.5)])
+    tmpdir.join('2.wav').write('changed')
+    journal = SimilarityJournal(path, rep='mfcc')
+    assert len(journal.lookup([wav_x], [wav_y])) == 0
+    journal.record([(wav_y, wav_x, 0.25)])
+    assert journal.lookup([wav_x], [wav_y]).similarity.tolist() == [0.25]
+
+def test_journal_records_input_paths_and_skips_missing_wavs(tmpdir):
+    wavs = {}
+    for message_id in [1, 2, 3]:
+        wavs[message_id] = str(tmpdir.join('{}.wav'.format(message_id)))
+    tmpdir.join('1.wav').write('1')
+    tmpdir.join('2.wav').write('2')
+    journal = SimilarityJournal(str(tmpdir.join('journal.sqlite')),
+                                rep='mfcc', match_function='xcorr')
+    # acousticsim scores chunks by the basenames of the wavs.
+    chunk = (0, [(wavs[1], wavs[2]), (wavs[1], wavs[3])], {}, {})
+    scored = [(0, [('2.wav', '1.wav', 0.5), ('1.wav', '3.wav', 0.25)], None)]
+    assert len(record_chunks(scored, [chunk], journal)) == 1
+    found = journal.lookup([wavs[1], wavs[1]], [wavs[2], wavs[3]])
+    assert found.values.tolist() == [[1, 2, 0.5]]
+
+def test_similarity_matrix_is_symmetric_and_grows(tmpdir):
+    matrix = SimilarityMatrix(str(tmpdir), rep='mfcc')
+    matrix.record([1, 5], [2, 1], [0.5, 0.25])
+    matrix.record([9], [2], [0.125])
+    matrix = SimilarityMatrix(str(tmpdir), rep='mfcc')
+    similarities = matrix.lookup([2, 1, 2, 9, 3], [1, 5, 9, 5, 1])
+    assert similarities[:3].tolist() == [0.5, 0.25, 0.125]
+    assert numpy.isnan(similarities[3:]).all()
+    assert not SimilarityMatrix(str(tmpdir), rep='envelopes').exists()
+
+def test_similarity_matrix_grows_in_place(tmpdir):
+    matrix = SimilarityMatrix(str(tmpdir), rep='mfcc')
+    matrix.record([10, 20], [20, 30], [0.5, 0.25])
+    assert matrix.capacity == 3
+    matrix.record([5], [30], [0.125])
+    assert matrix.capacity == 6
+    matrix.record([40], [10], [1.0])
+    assert matrix.capacity == 6
+    matrix = SimilarityMatrix(str(tmpdir), rep='mfcc')
+    similarities = matrix.lookup([20, 30, 5, 10, 5], [10, 20, 30, 40, 40])
+    assert similarities[:4].tolist() == [0.5, 0.25, 0.125, 1.0]
+    assert numpy.isnan(similarities[4])
+
+def test_similarity_matrix_clears_sounds_with_changed_wavs(tmpdir):
+    matrix = SimilarityMatrix(str(tmpdir), rep='mfcc')
+    matrix.record([1, 1], [2, 3], [0.5, 0.25], hashes={1: 'a', 2: 'b'})
+    # 3 had no hash, so taking one doesn't clear it.
+    matrix.record([2], [3], [0.125], hashes={2: 'b', 3: 'c'})
+    assert matrix.lookup([1, 1, 2], [2, 3, 3]).tolist() == [0.5, 0.25, 0.125]
+    matrix.record([2], [4], [1.0], hashes={2: 'changed'})
+    matrix = SimilarityMatrix(str(tmpdir), rep='mfcc')
+    similarities = matrix.lookup([1, 1, 2, 2], [2, 3, 3, 4])
+    assert numpy.isnan(similarities[[0, 2]]).all()
+    assert similarities[[1, 3]].tolist() == [0.25, 1.0]
+
+def test_merge_similarities_groups_duplicate_edges_like_merge(tmpdir):
+    # Linear edges from branches 5, 60, 5, 60 share their first two edges.
+    edges = pandas.DataFrame(dict(
+        branch_id=[5, 5, 60, 60, 5, 60],
+        sound_x=[1, 2, 1, 2, 3, 4],
+        sound_y=[2, 3, 2, 3, 6, 7],
+    ))
+    scored = pandas.DataFrame(dict(
+        sound_x=[1, 3, 2, 4],
+        sound_y=[2, 2, 6, 7],
+        similarity=[0.5, 0.25, 0.125, 1.0],
+    ))
+    matrix = SimilarityMatrix(str(tmpdir), rep='mfcc')
+    matrix.record(scored.sound_x, scored.sound_y, scored.similarity)
+
+    def create_edge_set(frame):
+        frame = frame.copy()
+        frame['edge_set'] = [frozenset({r.sound_x, r.sound_y})
+                             for r in frame.itertuples()]
+        return frame
+
+    expected = create_edge_set(edges).merge(
+        create_edge_set(scored)[['edge_set', 'similarity']])
+    del expected['edge_set']
+    merged = merge_similarities(edges, matrix)
+    assert merged.branch_id.tolist() == [5, 60, 5, 60, 60]
+    assert merged.values.tolist() == expected.values.tolist()
+
+def test_lsh_index_finds_nearest_in_clusters():
+    random = numpy.random.RandomState(0)
+    centers = random.randn(5, 24) * 10
+    embeddings = numpy.repeat(centers, 20, axis=0) + random.randn(100, 24)
+    labels = numpy.repeat(numpy.arange(5), 20)
+    query = centers[3] + random.randn(24)
+    assert BruteForceIndex(embeddings, labels).query(query, 10) == [3] * 10
+    assert LSHIndex(embeddings, labels).query(query, 10) == [3] * 10
+
+def test_download_objects_from_local_bucket(tmpdir):
+    bucket_dir = tmpdir.mkdir('bucket')
+    bucket_dir.mkdir('words-in-transition').join('a.zip').write_binary(
+        bytes(bytearray(range(256))) * 10)
+    dst_dir = tmpdir.mkdir('downloads')
+    manifest = str(dst_dir.join('manifest.json'))
+    bucket = LocalBucket(str(bucket_dir))
+    keys = ['words-in-transition/a.zip']
+
+    downloaded = download_objects(bucket, keys, str(dst_dir), manifest,
+                                  jobs=4, part_size=100)
+    assert downloaded == keys
+    assert dst_dir.join('a.zip').read_binary() == \
+        bytes(bytearray(range(256))) * 10
+    assert download_objects(bucket, keys, str(dst_dir), manifest) == []
+
+def test_download_stops_if_object_changes(tmpdir, monkeypatch):
+    from tasks import transfer
+    bucket_dir = tmpdir.mkdir('bucket')
+    src = bucket_dir.mkdir('words-in-transition').join('a.zip')
+    src.write_binary(b'a' * 1000)
+    dst_dir = tmpdir.mkdir('downloads')
+    manifest = str(dst_dir.join('manifest.json'))
+    keys = ['words-in-transition/a.zip']
+
+    # Change the object after its ETag is read, before its parts are.
+    fetch_part = transfer.fetch_part
+    def change_then_fetch(download, part, retries):
+        src.write_binary(b'b' * 1001)
+        return fetch_part(download, part, retries)
+    monkeypatch.setattr(transfer, 'fetch_part', change_then_fetch)
+    with pytest.raises(transfer.ObjectChanged):
+        download_objects(LocalBucket(str(bucket_dir)), keys, str(dst_dir),
+                         manifest, part_size=100)
+
+    monkeypatch.setattr(transfer, 'fetch_part', fetch_part)
+    download_objects(LocalBucket(str(bucket_dir)), keys, str(dst_dir),
+                     manifest, part_size=100)
+    assert dst_dir.join('a.zip').read_binary() == b'b' * 1001
+
+def test_unpack_exports_sounds_and_skips_bad_ones(tmpdir, monkeypatch):
+    from pydub.generators import Sine
+    # The download task shadows its module in tasks.
+    download = importlib.import_module('tasks.download')
+    messages_module = importlib.import_module('tasks.edges.messages')
+
+    sound = str(tmpdir.join('sound.wav'))
+    Sine(440).to_audio_segment(duration=500).export(sound, format='wav')
+    game_dir = tmpdir.mkdir('bucket').mkdir('words-in-transition')
+    with zipfile.ZipFile(str(game_dir.join('words-in-transition.zip')),
+                         'w') as archive:
+        archive.write(sound, 'webapps/telephone/media/a.wav')
+        archive.writestr('webapps/telephone/media/b.wav', b'not a sound')
+    downloads = tmpdir.mkdir('downloads')
+    download_objects(LocalBucket(str(tmpdir.join('bucket'))),
+                     ['words-in-transition/words-in-transition.zip'],
+                     str(downloads), str(downloads.join('manifest.json')))
+
+    sounds = tmpdir.mkdir('sounds')
+    manifest = sounds.join('manifest.json')
+    monkeypatch.setattr(download, 'DOWNLOAD_DIR', str(downloads))
+    monkeypatch.setattr(download, 'SOUNDS_MANIFEST', str(manifest))
+    monkeypatch.setattr(messages_module, 'SOUNDS_DIR', str(sounds))
+    monkeypatch.setattr(download, 'read_downloaded_messages',
+                        lambda: pandas.DataFrame({
+                            'message_id': [1, 2, 3],
+                            'audio': ['a.wav', 'b.wav', 'c.wav'],
+                            'start_at': [100, None, None],
+                            'end_at': [None, None, None],
+                        }))
+
+    download.unpack_and_cleanup_zip(processes=2)
+    assert list(json.loads(manifest.read())) == ['1']
+    assert sounds.join('1.wav').exists()
+    assert not sounds.join('2.wav').exists()
+    assert not sounds.join('3.wav').exists()
+
+    exported = sounds.join('1.wav').mtime()
+    download.unpack_and_cleanup_zip(processes=2)
+    assert sounds.join('1.wav').mtime() == exported
+
+def test_trim_silence_keeps_loud_windows():
+    samples = numpy.zeros(1600, dtype=numpy.float32)
+    samples[480:960] = 0.5
+    trimmed = trim_silence(samples, rate=16000, window=0.01)
+    assert len(trimmed) == 480
+    assert (trimmed == 0.5).all()
+
+def test_audio_store_leaves_out_sounds_that_fail_to_decode(tmpdir):
+    wavs = [str(tmpdir.join('1.wav')), str(tmpdir.join('2.wav'))]
+    Path('fixtures/1.wav').copy(wavs[0])
+    tmpdir.join('2.wav').write('not a sound')
+    store, index = str(tmpdir.join('audio.f32')), str(tmpdir.join('audio.csv'))
+    build_audio_store(wavs, store=store, index=index, processes=1)
+    audio = AudioStore(store, index)
+    assert 1 in audio and 2 not in audio
+    assert len(audio[1]) > 0
+
+def test_timing_writes_nested_spans_to_trace(tmpdir):
+    trace = str(tmpdir.join('trace.json'))
+    with timing.instrumented('task', trace=trace):
+        with timing.span('score', pairs=10):
+            timing.count(cache_hits=3, cache_misses=1)
+        for _ in timing.timed_iter('batch', range(2)):
+            pass
+    with open(trace) as f:
+        events = json.load(f)['traceEvents']
+    assert [event['name'] for event in events] == \
+        ['score', 'batch', 'batch', 'batch', 'task']
+    assert events[0]['args'] == dict(pairs=10, cache_hits=3, cache_misses=1)
+    task = events[-1]
+    assert all(task['ts'] <= event['ts'] and
+               event['ts'] + event['dur'] <= task['ts'] + task['dur']
+               for event in events)
+
+def test_spans_are_logged_once_timings_are_shown(caplog):
+    tasks_logger = logging.getLogger('tasks')
+    level = tasks_logger.level
+    tasks_logger.setLevel(logging.NOTSET)
+    try:
+        with timing.span('hidden'):
+            pass
+        assert 'hidden' not in caplog.text
+        timing.show_timings()
+        with timing.instrumented('task'):
+            with timing.span('score', pairs=10):
+                pass
+    finally:
+        tasks_logger.setLevel(level)
+    assert '  score: ' in caplog.text
+    assert 'pairs=10' in caplog.text
+    assert 'task: ' in caplog.text
+
+def test_resampling_is_the_same_on_any_number_of_processes(monkeypatch):
+    monkeypatch.setattr(stats, 'MAX_BATCH_SIZE', 200)
+    random = numpy.random.RandomState(0)
+    x = random.normal(1.0, 1, size=50)
+    y = random.normal(0.0, 1, size=40)
+    means = stats.bootstrap_means(x, 100, seed=1, processes=1)
+    assert len(means) == 100
+    assert (stats.bootstrap_means(x, 100, seed=1, processes=2) == means).all()
+    assert stats.permutation_test(x, y, 99, seed=1, processes=2) == \
+        stats.permutation_test(x, y, 99, seed=1, processes=1) == 0.01
+    assert stats.permutation_test(x, x, 99, seed=1) == 1.0
+
+def test_lineage_of_siblings_cousins_and_descendants():
+    # 1 -> 2 -> (3, 4), 3 -> 5, 4 -> 6; 7 is another seed.
+    messages = pandas.DataFrame({'message_id': [1, 2, 3, 4, 5, 6, 7],
+                                 'parent': [None, 1, 2, 2, 3, 4, None]})
+    lineage = LineageIndex(messages).relationships([3, 5, 5, 1, 7],
+                                                   [4, 6, 1, 6, 3])
+    assert lineage.generation_gap.tolist() == [0, 0, 3, 3, 2]
+    assert lineage.lca_depth.tolist()[:4] == [1, 1, 0, 0]
+    assert numpy.isnan(lineage.lca_depth[4])
+    assert lineage.same_seed.tolist() == [True, True, True, True, False]
+    assert lineage.same_branch.tolist() == [False, False, True, True, False]
+
+@pytest.fixture
+def judgments(monkeypatch):
+    """Import judgments/judgments.py, run from its dir like the experiment."""
+    judgments_dir = Path(__file__).absolute().parent.child('judgments')
+    monkeypatch.chdir(judgments_dir)
+    monkeypatch.syspath_prepend(judgments_dir)
+    return importlib.import_module('judgments')
+
+def edge_set(edges):
+    """Get the edges of a frame as keys that ignore edge direction."""
+    return set(edge_keys(message_ids(edges.sound_x),
+                         message_ids(edges.sound_y)))
+
+def test_headless_session_resumes_where_it_left_off(tmpdir, judgments):
+    from engine import HeadlessPresenter, SimulatedResponder
+
+    store = judgments.JudgmentStore(str(tmpdir.join('sim.sqlite')),
+                                    judgments.SimilarityJudgments.DATA_COLS)
+    trials = judgments.Trials(seed=0, store=store)
+    responder = SimulatedResponder(seed=0, p_repeat=0.1, p_error=0.1,
+                                   p_quit=0.01)
+    exported = []
+    engine = judgments.JudgmentEngine(
+        dict(name='sim', datetime='now'), store, trials,
+        HeadlessPresenter(responder),
+        after_block=lambda: exported.append(engine.cur_trial_index))
+    engine.run()
+    assert 0 < engine.cur_trial_index < trials.n_trials
+    # The block the participant quit in is exported too.
+    assert exported and exported[-1] == engine.cur_trial_index
+
+    store.export_csv(str(tmpdir.join('sim.csv')))
+    judged = pandas.read_csv(str(tmpdir.join('sim.csv')),
+                             keep_default_na=False)
+    assert set(judged.notes) == {'None', 'simulated error'}
+    assert (judged.similarity[judged.repeat == 1] == -1).all()
+    resumed = judgments.Trials(seed=1, store=store)
+    assert not edge_set(resumed.trials) & edge_set(judged)
+    assert edge_set(resumed.trials) | edge_set(judged) == \
+        edge_set(trials.trials)
+
+def test_judgment_store_round_trips_through_csv(tmpdir, judgments):
+    from engine import HeadlessPresenter, SimulatedResponder
+    columns = judgments.SimilarityJudgments.DATA_COLS
+
+    store = judgments.JudgmentStore(str(tmpdir.join('sim.sqlite')), columns)
+    trials = judgments.Trials(seed=0, store=store)
+    responder = SimulatedResponder(seed=0, p_repeat=0.1, p_error=0.1,
+                                   p_quit=0.02)
+    judgments.JudgmentEngine(dict(name='sim', datetime='now'), store, trials,
+                             HeadlessPresenter(responder)).run()
+    exported = tmpdir.join('sim.csv')
+    store.export_csv(str(exported))
+
+    imported = judgments.JudgmentStore(str(tmpdir.join('imported.sqlite')),
+                                       columns, import_csv=str(exported))
+    imported.export_csv(str(tmpdir.join('imported.csv')))
+    assert tmpdir.join('imported.csv').read() == exported.read()
+
+    judged = pandas.read_csv(str(exported))
+    assert len(judged) > 0
+    resumed = judgments.Trials(seed=1, store=imported)
+    assert not edge_set(resumed.trials) & edge_set(judged)
+    assert edge_set(resumed.trials) == \
+        edge_set(judgments.Trials(seed=1, store=store).trials)
+
+def test_judgment_store_imports_csv_when_new_or_asked(tmpdir, judgments):
+    columns = judgments.SimilarityJudgments.DATA_COLS
+
+    def judgment(sound_x, sound_y):
+        return dict(name='sim', datetime='now', block_ix=1, trial_ix=1,
+                    sound_x=sound_x, sound_y=sound_y, reversed=0,
+                    category='tear', similarity=4, notes='', repeat=0)
+
+    path = str(tmpdir.join('sim.sqlite'))
+    store = judgments.JudgmentStore(path, columns)
+    store.add(judgment(1, 2))
+    store.close()
+    # The csv has a judgment made on another machine.
+    csv = str(tmpdir.join('sim.csv'))
+    pandas.DataFrame([judgment(1, 2), judgment(3, 4)],
+                     columns=columns).to_csv(csv, index=False)
+
+    # The csv is only imported into a new database unless asked to.
+    store = judgments.JudgmentStore(path, columns, import_csv=csv)
+    assert len(store.unfinished(pandas.DataFrame(
+        dict(sound_x=[1, 3], sound_y=[2, 4])))) == 1
+    for _ in range(2):
+        store.import_csv(csv)
+    store.add(judgment(5, 6))
+    store.export_csv(csv)
+    judged = pandas.read_csv(csv)
+    assert judged[['sound_x', 'sound_y']].values.tolist() == \
+        [[1, 2], [3, 4], [5, 6]]
+
+def test_sound_pool_keeps_most_recently_used_sounds(judgments):
+    loaded = []
+    def load(name):
+        if name == 'missing':
+            raise IOError(name)
+        loaded.append(name)
+        return name.upper()
+
+    pool = judgments.SoundPool(size=2, load=load)
+    pool.prefetch(['a', 'b'])
+    assert pool.get('b') == 'B'
+    assert pool.get('a') == 'A'  # a is now the most recently used
+    assert loaded == ['a', 'b']  # prefetched sounds aren't loaded again
+
+    assert pool.get('c') == 'C'
+    assert list(pool.sounds) == ['a', 'c']
+    assert pool.get('b') == 'B'
+    assert loaded == ['a', 'b', 'c', 'b']
+
+    with pytest.raises(IOError):
+        pool.get('missing')
+    assert 'missing' not in pool.sounds
+
+    pool.prefetch(['d'])
+    pool.close()
+    assert not pool.worker.is_alive()
+    assert loaded[-1] == 'd'
+
+def test_adaptive_trials_run_most_informative_edges_first(judgments):
+    canonical_edges = judgments.canonical_edges
+    edge_priorities = judgments.edge_priorities
+
+    # All glass, so they make a single block.
+    edges = pandas.DataFrame({'sound_x': [34, 34, 35, 36],
+                              'sound_y': [35, 36, 37, 37]})
+    ratings = pandas.DataFrame({'sound_x': [34, 35, 34, 35, 37, 36],
+                                'sound_y': [35, 34, 35, 37, 35, 37],
+                                'similarity': [4, 4, 4, 1, 7, 4]})
+    ratings['edge_x'], ratings['edge_y'] = canonical_edges(ratings.sound_x,
+                                                           ratings.sound_y)
+    similarities = pandas.DataFrame({'sound_x': [34, 34, 35, 36],
+                                     'sound_y': [35, 36, 37, 37],
+                                     'similarity': [0.1, 0.2, 0.3, 0.4]})
+
+    by_count = dict(disagreement=0, variance=0, count=1)
+    assert edge_priorities(edges, ratings, similarities, by_count).tolist() \
+        == [0.25, 1.0, 1 / 3.0, 0.5]
+    by_variance = dict(disagreement=0, variance=1, count=0)
+    # Only (35, 37) has ratings that vary. Edges with fewer than two
+    # ratings get the mean variance of the others.
+    assert edge_priorities(edges, ratings, similarities,
+                           by_variance).tolist() == [0, 1, 2, 1]
+
+    def picked(**kwargs):
+        trials = judgments.AdaptiveTrials(seed=0, edges=edges,
+                                          ratings=ratings,
+                                          similarities=similarities, **kwargs)
+        block, = trials.blocks()
+        edge_x, edge_y = canonical_edges([trial.sound_x for trial in block],
+                                         [trial.sound_y for trial in block])
+        return list(zip(edge_x, edge_y)), trials.n_trials
+
+    assert picked(weights=by_count) == \
+        ([(34, 36), (36, 37), (35, 37), (34, 35)], 4)
+    assert picked(weights=by_count, block_size=2) == \
+        ([(34, 36), (36, 37)], 2)
+
+def test_read_ratings_keeps_final_rating_of_each_edge(tmpdir):
+    src = tmpdir.join('rater.csv')
+    src.write('name,datetime,block_ix,trial_ix,sound_x,sound_y,reversed,'
+              'category,similarity,notes,repeat\n'
+              'a,now,1,1,1,2,0,glass,-1,None,1\n'
+              'a,now,1,1,1,2,0,glass,3,None,0\n'
+              'a,now,1,2,3,4,0,glass,-1,no sound,0\n'
+              'a,now,2,1,2,1,1,glass,5,None,0\n')
+    rated = ratings.read_ratings(str(src), chunksize=2)
+    assert rated.edge.tolist() == [(1 << 32) | 2]
+    assert rated.similarity.tolist() == [5]
+
+def test_krippendorff_alpha():
+    agree = pandas.DataFrame({'edge': [1, 1, 2, 2, 3, 3],
+                              'similarity': [1, 1, 4, 4, 7, 7]})
+    assert ratings.krippendorff_alpha(agree) == 1.0
+    # Ratings of the same edge differ as much as any two ratings.
+    random = pandas.DataFrame({'edge': [1, 1, 2, 2], 'similarity': [1, 7, 7, 1]})
+    assert ratings.krippendorff_alpha(random) < 0